@@ -0,0 +1,134 @@
+"""
+Cache semântico de respostas do /query
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL
+
+
+class CachedAnswer:
+    """Resposta gerada para uma pergunta de um chat e o contexto (ids dos chunks) usado"""
+
+    def __init__(self, chat_id: str, query_vector: np.ndarray, chunk_ids: FrozenSet[int],
+                 file_names: Set[str], answer: str, created_at: float):
+        self.chat_id = chat_id
+        self.query_vector = query_vector
+        self.chunk_ids = chunk_ids
+        self.file_names = file_names
+        self.answer = answer
+        self.created_at = created_at
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class AnswerCache:
+    """
+    Cache de respostas por similaridade da pergunta e contexto recuperado.
+
+    Reaproveita a resposta de uma pergunta do mesmo chat (o histórico também entra na
+    resposta) com similaridade de cosseno acima de ``threshold`` e os mesmos ids de chunks.
+    Ids não são reutilizados, então reenviar ou remover um documento já muda o contexto.
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_SIMILARITY,
+        ttl: float = ANSWER_CACHE_TTL,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        # Entradas agrupadas por (chat, contexto) e pelo arquivo de origem
+        self.by_context: Dict[Tuple[str, FrozenSet[int]], Set[int]] = {}
+        self.by_file: Dict[str, Set[int]] = {}
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+        self._next_key = itertools.count()
+        self._lock = threading.Lock()
+
+    def _remove(self, key: int):
+        entry = self.entries.pop(key)
+        context_key = (entry.chat_id, entry.chunk_ids)
+        context = self.by_context[context_key]
+        context.discard(key)
+        if not context:
+            del self.by_context[context_key]
+        for file_name in entry.file_names:
+            keys = self.by_file[file_name]
+            keys.discard(key)
+            if not keys:
+                del self.by_file[file_name]
+
+    def _expired(self, entry: CachedAnswer) -> bool:
+        return self.clock() - entry.created_at > self.ttl
+
+    def get(self, chat_id: str, query_vector: List[float], chunk_ids: Iterable[int]) -> Optional[str]:
+        """Retorna a resposta em cache para a pergunta do chat e o contexto, se houver"""
+        query = _normalize(query_vector)
+        with self._lock:
+            best_key, best_similarity = None, self.threshold
+            for key in list(self.by_context.get((chat_id, frozenset(chunk_ids)), ())):
+                entry = self.entries[key]
+                if self._expired(entry):
+                    self._remove(key)
+                    self.counters["expirations"] += 1
+                    continue
+                similarity = float(entry.query_vector @ query)
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(best_key)
+            self.counters["hits"] += 1
+            return self.entries[best_key].answer
+
+    def put(self, chat_id: str, query_vector: List[float], chunk_ids: Iterable[int],
+            file_names: Iterable[str], answer: str):
+        """Guarda a resposta gerada para a pergunta do chat e o contexto usado"""
+        entry = CachedAnswer(
+            chat_id, _normalize(query_vector), frozenset(chunk_ids), set(file_names), answer, self.clock()
+        )
+        with self._lock:
+            key = next(self._next_key)
+            self.entries[key] = entry
+            self.by_context.setdefault((entry.chat_id, entry.chunk_ids), set()).add(key)
+            for file_name in entry.file_names:
+                self.by_file.setdefault(file_name, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+
+    def invalidate(self, file_name: str) -> int:
+        """Remove as respostas que usaram chunks do arquivo; retorna quantas foram removidas"""
+        with self._lock:
+            keys = list(self.by_file.get(file_name, ()))
+            for key in keys:
+                self._remove(key)
+            self.counters["invalidations"] += len(keys)
+            return len(keys)
+
+    def stats(self) -> Dict[str, float]:
+        """Retorna os contadores e a taxa de acerto do cache"""
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+            }
@@ -0,0 +1,71 @@
+"""
+Agrupamento de chamadas concorrentes em lotes (micro-batching)
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from config import QUERY_EMBEDDING_BATCH_WINDOW, QUERY_EMBEDDING_MAX_BATCH
+
+
+class MicroBatcher:
+    """
+    Junta os itens enviados dentro de uma janela curta em uma única chamada em lote.
+
+    O primeiro item de um lote abre a janela de ``window`` segundos; o lote sai
+    quando a janela fecha ou quando atinge ``max_size`` itens, e cada chamador
+    recebe o resultado (ou o erro) correspondente ao seu item. Com ``window`` 0
+    cada item vira uma chamada própria, sem espera.
+    """
+
+    def __init__(self, func: Callable[[List[Any]], Awaitable[List[Any]]],
+                 window: float = QUERY_EMBEDDING_BATCH_WINDOW, max_size: int = QUERY_EMBEDDING_MAX_BATCH):
+        self.func = func
+        self.window = window
+        self.max_size = max_size
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Referências aos lotes em andamento (o event loop guarda só referências fracas às tasks)
+        self._running: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        if self.window <= 0:
+            return (await self.func([item]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.func([item for item, future in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Lote com {len(batch)} itens retornou {len(results)} resultados")
+        except Exception as e:
+            for item, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            # Chamador que desistiu (cliente desconectado) já tem o future cancelado
+            for (item, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            for item, future in batch:
+                if not future.done():
+                    future.cancel()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline e determinístico dos caminhos de ingestão e consulta da API
+
+Exemplos:
+    python benchmark.py --chunks 1000
+    python benchmark.py --chunks 100000 --dim 768 --embed-latency 0.05 --llm-latency 0.5
+    python benchmark.py --chunks 1000000 --upload-docs 0 --output bench-0.1.0.json
+
+Os embeddings e o LLM do Google são trocados por substitutos locais determinísticos
+(dimensão e latência configuráveis): nenhuma chamada de rede é feita. O corpus
+sintético de contratos é gerado a partir de ``--seed`` e gravado direto na coleção
+(``--chunks``); ``--upload-docs`` PDFs passam pelo caminho completo de ``/upload``.
+
+Cada endpoint é medido pela API em processo (TestClient): latência p50/p95/p99 e
+throughput, ao lado da memória (RSS) e do tamanho em disco lidos ao fim do seu bloco,
+em JSON, para comparar versões.
+O relatório inclui as etapas da inicialização e a reabertura dos índices com o corpus.
+Tudo roda em um diretório de trabalho temporário (ou ``--workdir``), sem tocar em ``data/``.
+"""
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+from langchain_community.chat_models.fake import FakeListChatModel
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from chunking import content_hash
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TERM_PATTERN = re.compile(r"\w+")
+
+WORDS = (
+    "contrato contratante contratada prestacao servicos prazo vigencia rescisao multa "
+    "pagamento parcela reajuste indice foro comarca obrigacoes partes clausula anexo "
+    "confidencialidade garantia seguro responsabilidade indenizacao notificacao aditivo "
+    "fornecimento entrega aceite medicao fatura nota fiscal tributos retencao penalidade "
+    "inadimplemento juros correcao monetaria arbitragem mediacao sigilo propriedade "
+    "intelectual licenca software suporte manutencao nivel servico disponibilidade "
+    "rescindir renovacao automatica aviso previo dias uteis corridos assinatura testemunhas"
+).split()
+
+
+class DeterministicEmbeddings(Embeddings):
+    """
+    Embeddings locais: soma de vetores aleatórios fixos por termo, normalizada.
+
+    Textos com termos em comum ficam próximos, então a busca tem vizinhos com
+    sentido, e o mesmo texto sempre gera o mesmo vetor. ``latency`` simula o
+    tempo de cada chamada à API.
+    """
+
+    def __init__(self, dim: int = 768, latency: float = 0.0, **kwargs):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+        # Cache por instância: no método, o lru_cache manteria todas as instâncias vivas
+        self._term_vector = functools.lru_cache(maxsize=100000)(self._random_vector)
+
+    def _random_vector(self, term: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+    def vector(self, text: str) -> List[float]:
+        terms = TERM_PATTERN.findall(text.lower()) or [""]
+        vector = np.sum([self._term_vector(term) for term in terms], axis=0)
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class SlowFakeChatModel(FakeListChatModel):
+    """Modelo de chat falso com latência fixa por resposta (também sem streaming)"""
+
+    latency: float = 0.0
+
+    def _call(self, *args, **kwargs) -> str:
+        time.sleep(self.latency)
+        return super()._call(*args, **kwargs)
+
+
+# ----------------------------------------------------------------------
+# Corpus sintético
+# ----------------------------------------------------------------------
+
+def synthetic_text(rng: np.random.Generator, words: int) -> str:
+    """Texto de contrato com identificadores (cláusulas, CNPJs, valores) entre as palavras"""
+    parts = [WORDS[i] for i in rng.integers(len(WORDS), size=words)]
+    rolls = rng.random(words)
+    for position in np.flatnonzero(rolls < 0.06):
+        a, b, c, d = rng.integers(0, 1000, size=4)
+        if rolls[position] < 0.03:
+            parts[position] = f"clausula {a % 40 + 1}.{b % 9 + 1}"
+        elif rolls[position] < 0.04:
+            parts[position] = f"CNPJ {a % 90 + 10}.{b % 900 + 100}.{c % 900 + 100}/0001-{d % 90 + 10}"
+        else:
+            parts[position] = f"R$ {a % 999 + 1}.{b % 900 + 100},00"
+    for position in np.flatnonzero(rng.random(words) < 0.08):
+        parts[position] += "."
+    return " ".join(parts)
+
+
+def make_pdf(pages: List[str], line_chars: int = 90) -> bytes:
+    """PDF mínimo (texto ASCII, Helvetica) com uma página por texto, sem dependências externas"""
+    count = len(pages)
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{4 + 2 * i} 0 R" for i in range(count)), count),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(pages):
+        escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        lines = [escaped[start:start + line_chars] for start in range(0, len(escaped), line_chars)] or [""]
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    data += (f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+             f"startxref\n{xref}\n%%EOF\n").encode("latin-1")
+    return data
+
+
+def seed_corpus(collection, embeddings: DeterministicEmbeddings, chunks: int, chunks_per_doc: int,
+                words_per_chunk: int, seed: int, batch_size: int = 5000) -> List[str]:
+    """Grava ``chunks`` chunks sintéticos direto na coleção; retorna uma amostra dos textos"""
+    rng = np.random.default_rng(seed)
+    sample: List[str] = []
+    for start in range(0, chunks, batch_size):
+        documents = []
+        for position in range(start, min(start + batch_size, chunks)):
+            text = synthetic_text(rng, words_per_chunk)
+            documents.append(Document(page_content=text, metadata={
+                "file_name": f"seed-{position // chunks_per_doc:06d}.pdf",
+                "file_hash": f"seed-{position // chunks_per_doc:06d}",
+                "page_number": position % chunks_per_doc + 1,
+                "chunk_index": position % chunks_per_doc,
+                "start_index": 0,
+                "end_index": len(text),
+                "content_hash": content_hash(text),
+            }))
+            if len(sample) < 1000:
+                sample.append(text)
+        collection.add_embeddings(documents, [embeddings.vector(doc.page_content) for doc in documents])
+        collection.commit()
+    return sample
+
+
+# ----------------------------------------------------------------------
+# Medições
+# ----------------------------------------------------------------------
+
+def summarize(samples: List[float], wall_seconds: float) -> Dict[str, float]:
+    """Percentis em milissegundos e throughput (operações por segundo de relógio)"""
+    if not samples:
+        return {"count": 0}
+    latencies = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "max_ms": round(float(latencies.max()), 3),
+        "throughput_per_s": round(len(samples) / wall_seconds, 3) if wall_seconds else None,
+    }
+
+
+def rss_mb() -> Dict[str, float]:
+    """Memória residente atual e de pico do processo, em MB"""
+    usage = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    usage["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux informa em KB, macOS em bytes
+        usage["peak_rss_mb"] = round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    return usage
+
+
+def disk_mb(path: str) -> Dict[str, float]:
+    """Tamanho em disco de cada item de ``path`` (e o total), em MB"""
+    sizes = {}
+    for entry in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        full = os.path.join(path, entry)
+        total = os.path.getsize(full) if os.path.isfile(full) else sum(
+            os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(full) for name in names
+        )
+        sizes[entry] = round(total / (1024 * 1024), 3)
+    sizes["total"] = round(sum(sizes.values()), 3)
+    return sizes
+
+
+def footprint(path: str) -> Dict[str, Dict[str, float]]:
+    """Memória (RSS) e tamanho em disco medidos ao fim de uma etapa"""
+    return {"rss": rss_mb(), "disk_mb": disk_mb(path)}
+
+
+def timed(samples: List[float], func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# ----------------------------------------------------------------------
+# Execução
+# ----------------------------------------------------------------------
+
+def load_app(embeddings: DeterministicEmbeddings, llm_latency: float, load: bool = True):
+    """Importa a API com os substitutos locais no lugar do Google (antes de ``main`` criar os objetos)"""
+    import langchain_google_genai
+    import ia
+
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    langchain_google_genai.GoogleGenerativeAIEmbeddings = lambda *args, **kwargs: embeddings
+    ia.llm_google = lambda: SlowFakeChatModel(responses=["Resposta sintética do benchmark."], latency=llm_latency)
+    import main as api
+    # Clientes e índices normalmente carregam em segundo plano; o corpus é gravado antes do TestClient
+    if load:
+        api.load_services()
+    return api
+
+
+def run(args) -> Dict:
+    rng = np.random.default_rng(args.seed + 1)
+    embeddings = DeterministicEmbeddings(args.dim, args.embed_latency)
+    api = load_app(embeddings, args.llm_latency)
+    from fastapi.testclient import TestClient
+    from config import DATA_DIR
+
+    report: Dict = {
+        "meta": {
+            "api_version": api.API_VERSION,
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {key: value for key, value in vars(args).items() if key not in ("workdir", "output")},
+        },
+        "endpoints": {},
+    }
+
+    start = time.perf_counter()
+    sample = seed_corpus(api.db, embeddings, args.chunks, args.chunks_per_doc,
+                         args.words_per_chunk, args.seed)
+    seed_seconds = time.perf_counter() - start
+    report["seed"] = {
+        "chunks": args.chunks,
+        "seconds": round(seed_seconds, 3),
+        "chunks_per_s": round(args.chunks / seed_seconds, 1) if seed_seconds else None,
+        **footprint(DATA_DIR),
+    }
+
+    # Inicialização: etapas medidas pela API (o import já encontra parte das dependências
+    # carregada pelo benchmark) e a reabertura dos índices com o corpus gravado
+    start = time.perf_counter()
+    api.open_collections(read_only=True)
+    report["startup"] = {
+        **{step: round(seconds, 3) for step, seconds in api.startup_seconds.items()},
+        "indexes_seeded": round(time.perf_counter() - start, 3),
+    }
+
+    with TestClient(api.app) as client:
+        # /upload: da requisição até o job terminar (extração, embedding e commit)
+        requests, ingests, uploaded = [], [], []
+        start = time.perf_counter()
+        for number in range(args.upload_docs):
+            pages = [synthetic_text(rng, args.words_per_page) for _ in range(args.pages_per_doc)]
+            file_name = f"upload-{number:04d}.pdf"
+            began = time.perf_counter()
+            response = timed(requests, client.post, "/upload",
+                             files={"file": (file_name, make_pdf(pages), "application/pdf")})
+            job_id = response.json()["job_id"]
+            while client.get(f"/upload/{job_id}").json()["status"] not in ("done", "failed", "skipped"):
+                time.sleep(0.005)
+            ingests.append(time.perf_counter() - began)
+            uploaded.append(file_name)
+        wall = time.perf_counter() - start
+        report["endpoints"]["POST /upload"] = {
+            **summarize(requests, wall), "ingest": summarize(ingests, wall), **footprint(DATA_DIR),
+        }
+
+        # /query: perguntas distintas (sem acerto no cache de respostas) montadas a partir do corpus
+        queries = [" ".join(rng.choice(text.split(), size=6)) for text in sample or [synthetic_text(rng, 40)]]
+        latencies = []
+        start = time.perf_counter()
+        for number in range(args.queries):
+            query = f"{queries[number % len(queries)]} {number}"
+            timed(latencies, client.post, "/query", json={"query": query, "chat_id": f"bench-{number % 50}"})
+        report["endpoints"]["POST /query"] = {
+            **summarize(latencies, time.perf_counter() - start), **footprint(DATA_DIR),
+        }
+
+        # /query/batch: as mesmas perguntas (com outro sufixo) em uma única requisição. O TestClient
+        # entrega a resposta inteira de uma vez, então mede-se a requisição e o throughput por item
+        items = [
+            {"query": f"{queries[number % len(queries)]} lote {number}", "chat_id": f"bench-{number % 50}"}
+            for number in range(args.queries)
+        ]
+        latencies = []
+        start = time.perf_counter()
+        if items:
+            timed(latencies, client.post, "/query/batch", json={"items": items})
+        wall = time.perf_counter() - start
+        report["endpoints"]["POST /query/batch"] = {
+            **summarize(latencies, wall), "items": len(items),
+            "items_per_s": round(len(items) / wall, 3) if latencies else None, **footprint(DATA_DIR),
+        }
+
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.list_requests):
+            timed(latencies, client.get, "/documents")
+        report["endpoints"]["GET /documents"] = {
+            **summarize(latencies, time.perf_counter() - start), **footprint(DATA_DIR),
+        }
+
+        # DELETE /documents: documentos enviados e, se faltar, documentos do corpus
+        targets = uploaded + [f"seed-{i:06d}.pdf" for i in range(max(0, args.deletes - len(uploaded)))]
+        latencies = []
+        start = time.perf_counter()
+        for file_name in targets[:args.deletes]:
+            timed(latencies, client.delete, f"/documents/{file_name}")
+        report["endpoints"]["DELETE /documents/{file_name}"] = {
+            **summarize(latencies, time.perf_counter() - start), **footprint(DATA_DIR),
+        }
+
+    report["final"] = {**footprint(DATA_DIR), "embedding_calls": embeddings.calls}
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline dos endpoints de ingestão e consulta")
+    parser.add_argument("--chunks", type=int, default=1000, help="Chunks do corpus sintético gravado antes das medições")
+    parser.add_argument("--chunks-per-doc", type=int, default=50, help="Chunks por documento do corpus")
+    parser.add_argument("--words-per-chunk", type=int, default=180)
+    parser.add_argument("--dim", type=int, default=768, help="Dimensão dos embeddings falsos")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Segundos por chamada de embedding")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Segundos por resposta do LLM")
+    parser.add_argument("--upload-docs", type=int, default=5, help="PDFs enviados por /upload")
+    parser.add_argument("--pages-per-doc", type=int, default=20)
+    parser.add_argument("--words-per-page", type=int, default=350)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--list-requests", type=int, default=50)
+    parser.add_argument("--deletes", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="Diretório de trabalho (padrão: temporário)")
+    parser.add_argument("--output", help="Arquivo JSON do relatório (padrão: saída padrão)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag-benchmark-")
+    output = os.path.abspath(args.output) if args.output else None
+    # DATA_DIR é relativo: a API grava os índices dentro do diretório de trabalho
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    # As mensagens da API vão para stderr: a saída padrão fica só com o JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+    report["meta"]["workdir"] = workdir
+    payload = json.dumps(report, ensure_ascii=False, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
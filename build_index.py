@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Treina e reconstrói o índice FAISS de uma coleção a partir dos vetores gravados
+
+Exemplos:
+    python build_index.py my_docs
+    python build_index.py my_docs --type ivf_pq --nlist 1024 --m 16 --nprobe 16
+    python build_index.py my_docs --type hnsw --M 32 --ef-search 64
+
+Nenhum embedding é recalculado. Ao final, o recall@k do novo índice é medido contra
+a busca exata (flat) usando vetores da própria coleção como consultas.
+
+Execute com a API parada: a reconstrução grava um novo checkpoint da coleção e por isso
+precisa do lock do escritor (WRITER_LOCK_PATH); se ele estiver em uso, o script termina com erro.
+Coleções divididas em shards (FAISS_SHARDS) têm cada shard reconstruído e medido.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from config import FAISS_COLLECTION_OPTIONS, FAISS_INDEX_DIR, FAISS_INDEX_TYPES, FAISS_SHARDS, WRITER_LOCK_PATH
+from faiss_store import FaissCollection, FLAT_INDEX_SPEC
+from shared_index import WriterLock
+from sharded_store import ShardedCollection
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reconstrói o índice FAISS de uma coleção")
+    parser.add_argument("collection", help="Nome da coleção (ex.: my_docs)")
+    parser.add_argument("--type", choices=["flat", "ivf_flat", "ivf_pq", "hnsw"],
+                        help="Tipo do índice (padrão: FAISS_INDEX_TYPES da coleção)")
+    parser.add_argument("--nlist", type=int, help="Listas invertidas (IVF)")
+    parser.add_argument("--nprobe", type=int, help="Listas visitadas por busca (IVF)")
+    parser.add_argument("--m", type=int, help="Subquantizadores (IVF-PQ)")
+    parser.add_argument("--nbits", type=int, help="Bits por subquantizador (IVF-PQ)")
+    parser.add_argument("--M", type=int, help="Vizinhos por nó (HNSW)")
+    parser.add_argument("--ef-construction", type=int, help="efConstruction (HNSW)")
+    parser.add_argument("--ef-search", type=int, help="efSearch (HNSW)")
+    parser.add_argument("--k", type=int, default=10, help="k usado no recall@k")
+    parser.add_argument("--queries", type=int, default=200, help="Consultas usadas no recall@k")
+    return parser.parse_args()
+
+
+def build_spec(args) -> dict:
+    """Combina a especificação de config.py com os parâmetros da linha de comando"""
+    spec = dict(FAISS_INDEX_TYPES.get(args.collection, FLAT_INDEX_SPEC))
+    if args.type and args.type != spec.get("type"):
+        spec = {"type": args.type}
+    overrides = {
+        "nlist": args.nlist, "nprobe": args.nprobe, "m": args.m, "nbits": args.nbits,
+        "M": args.M, "efConstruction": args.ef_construction, "efSearch": args.ef_search,
+    }
+    spec.update({key: value for key, value in overrides.items() if value is not None})
+    return spec
+
+
+def exact_search(collection: FaissCollection, queries: np.ndarray, k: int, batch_size: int = 100000):
+    """Busca exata em lotes (memória limitada pelo lote, não pela coleção)"""
+    ids = np.asarray(sorted(collection.rows), dtype=np.int64)
+    heap = faiss.ResultHeap(len(queries), k)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        distances, positions = faiss.knn(queries, collection.get_vectors(batch.tolist()), min(k, len(batch)))
+        if positions.shape[1] < k:
+            pad = k - positions.shape[1]
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+            positions = np.pad(positions, ((0, 0), (0, pad)), constant_values=-1)
+        heap.add_result(distances, np.where(positions >= 0, batch[positions], -1))
+    heap.finalize()
+    return heap.I
+
+
+def measure_recall(collection: FaissCollection, k: int, n_queries: int) -> dict:
+    ids = sorted(collection.rows)
+    sample = np.random.default_rng(0).choice(len(ids), size=min(n_queries, len(ids)), replace=False)
+    queries = collection.get_vectors([ids[i] for i in sample])
+    k = min(k, len(ids))
+
+    start = time.perf_counter()
+    exact = exact_search(collection, queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    approx = [[vector_id for vector_id, distance in collection.search_ids(query, k)] for query in queries]
+    approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = sum(len(set(expected) & set(found)) for expected, found in zip(exact.tolist(), approx))
+    return {
+        f"recall@{k}": hits / (len(queries) * k),
+        "queries": len(queries),
+        "exact_ms_per_query": round(exact_ms, 3),
+        "index_ms_per_query": round(approx_ms, 3),
+    }
+
+
+def rebuild_collection(collection: FaissCollection, spec: dict, args) -> dict:
+    start = time.perf_counter()
+    collection.rebuild(spec)
+    build_seconds = time.perf_counter() - start
+    return {
+        "vectors": collection.ntotal,
+        "built_spec": collection.index_spec,
+        "build_seconds": round(build_seconds, 3),
+        **measure_recall(collection, args.k, args.queries),
+    }
+
+
+def open_shards(name: str, directory: str = FAISS_INDEX_DIR):
+    """Abre a coleção com as mesmas opções da API, preservando o índice BM25 no checkpoint"""
+    options = FAISS_COLLECTION_OPTIONS.get(name, {})
+    if name in FAISS_SHARDS:
+        return ShardedCollection.open(name, None, **FAISS_SHARDS[name], directory=directory, **options).shards
+    return [FaissCollection.open(name, embeddings=None, directory=directory, **options)]
+
+
+def main():
+    args = parse_args()
+    writer_lock = WriterLock(WRITER_LOCK_PATH)
+    if not writer_lock.try_acquire():
+        print(f"Lock do escritor em uso ({WRITER_LOCK_PATH}): pare a API antes de reconstruir.",
+              file=sys.stderr)
+        return 1
+    try:
+        return rebuild(args)
+    finally:
+        writer_lock.release()
+
+
+def rebuild(args) -> int:
+    shards = open_shards(args.collection)
+    if sum(shard.ntotal for shard in shards) == 0:
+        print(f"Coleção {args.collection} vazia: nada a reconstruir.")
+        return 1
+
+    spec = build_spec(args)
+    report = {"collection": args.collection, "requested_spec": spec}
+    if len(shards) == 1:
+        report.update(rebuild_collection(shards[0], spec, args))
+    else:
+        report["shards"] = [
+            {"shard": position, **rebuild_collection(shard, spec, args)}
+            for position, shard in enumerate(shards) if shard.ntotal
+        ]
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Histórico de chat em SQLite (modo WAL): append O(1), leitura paginada por cursor
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import CHAT_HISTORY_DB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    ai TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_by_chat ON turns (chat_id, id);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    turns INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class ChatHistoryStore:
+    """
+    Turnos de conversa em uma tabela append-only indexada por (chat_id, id).
+
+    O id autoincremental segue a ordem de gravação, então a ordem por id é a
+    ordem cronológica e serve de cursor: cada página é uma busca no índice a
+    partir do último id lido, sem carregar nem ordenar a conversa inteira. A
+    tabela ``chats`` mantém um registro por conversa para listar os ids por cursor.
+
+    Cada thread usa sua própria conexão; o modo WAL permite leitores (inclusive
+    de outros processos) em paralelo com o escritor.
+    """
+
+    def __init__(self, path: str = CHAT_HISTORY_DB):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def append(self, chat_id: str, user_message: str, ai_response: str,
+               timestamp: Optional[str] = None) -> Dict[str, Any]:
+        """Grava um turno no fim da conversa"""
+        turn = {
+            "user": user_message,
+            "ai": ai_response,
+            "timestamp": timestamp or datetime.now().isoformat(),
+        }
+        self._insert(chat_id, [turn])
+        return turn
+
+    def _insert(self, chat_id: str, turns: List[Dict[str, Any]]):
+        # Turnos e contador da conversa na mesma transação
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO turns (chat_id, user, ai, timestamp) VALUES (?, ?, ?, ?)",
+                [(chat_id, turn["user"], turn["ai"], turn["timestamp"]) for turn in turns]
+            )
+            connection.execute(
+                "INSERT INTO chats (chat_id, created_at, updated_at, turns) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET updated_at = excluded.updated_at, "
+                "turns = turns + excluded.turns",
+                (chat_id, turns[0]["timestamp"], turns[-1]["timestamp"], len(turns))
+            )
+
+    def history(self, chat_id: str, limit: Optional[int] = None,
+                cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Turnos em ordem cronológica após ``cursor``; retorna (turnos, cursor da próxima página)"""
+        after = int(cursor) if cursor else 0
+        query = "SELECT id, user, ai, timestamp FROM turns WHERE chat_id = ? AND id > ? ORDER BY id"
+        params: List[Any] = [chat_id, after]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        rows = self._connection().execute(query, params).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = str(rows[-1]["id"])
+        turns = [{"user": row["user"], "ai": row["ai"], "timestamp": row["timestamp"]} for row in rows]
+        return turns, next_cursor
+
+    def chat_ids(self, limit: Optional[int] = None,
+                 cursor: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        """Ids das conversas em ordem alfabética após ``cursor``; retorna (ids, próximo cursor)"""
+        query = "SELECT chat_id FROM chats WHERE chat_id > ? ORDER BY chat_id"
+        params: List[Any] = [cursor or ""]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        chat_ids = [row["chat_id"] for row in self._connection().execute(query, params)]
+
+        next_cursor = None
+        if limit is not None and len(chat_ids) > limit:
+            chat_ids = chat_ids[:limit]
+            next_cursor = chat_ids[-1]
+        return chat_ids, next_cursor
+
+    def clear(self, chat_id: str) -> bool:
+        """Remove todos os turnos de uma conversa"""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM turns WHERE chat_id = ?", (chat_id,))
+            removed = connection.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,)).rowcount
+        return removed > 0
+
+    def migrate_json(self, directory: str) -> int:
+        """Importa os arquivos ``<chat_id>.json`` do formato antigo; retorna quantas conversas"""
+        if not os.path.isdir(directory):
+            return 0
+        migrated = 0
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".json"):
+                continue
+            file_path = os.path.join(directory, file_name)
+            with open(file_path, "r", encoding="utf-8") as f:
+                turns = sorted(json.load(f), key=lambda turn: turn["timestamp"])
+            if turns:
+                self._insert(file_name[:-len(".json")], turns)
+            # Renomear em vez de apagar: o arquivo original continua disponível, mas não é reimportado
+            os.replace(file_path, f"{file_path}.migrated")
+            migrated += 1
+        return migrated
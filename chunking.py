@@ -0,0 +1,108 @@
+"""
+Divisão de páginas em chunks e montagem do contexto do prompt dentro de um orçamento de tokens
+"""
+
+import hashlib
+import math
+from typing import Dict, List, Tuple
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+from config import (
+    CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS, CHARS_PER_TOKEN, CONTEXT_TOKEN_BUDGET
+)
+
+# Parágrafos, linhas, fim de frase e, em último caso, palavras
+SENTENCE_SEPARATORS = ["\n\n", "\n", r"(?<=[.!?;:])\s+", " ", ""]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa de tokens pelo número de caracteres (sem depender do tokenizer do modelo)"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def content_hash(text: str) -> str:
+    """Identificador do conteúdo de um chunk (sha256 do texto já limpo)"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_documents(
+    pages: List[Document],
+    chunk_size: int = CHUNK_SIZE_TOKENS,
+    chunk_overlap: int = CHUNK_OVERLAP_TOKENS,
+    first_chunk_index: int = 0,
+) -> List[Document]:
+    """
+    Divide cada página em chunks com sobreposição, respeitando fronteiras de frase.
+
+    Os chunks nunca cruzam páginas e herdam os metadados da página, acrescidos de
+    ``chunk_index`` (posição no arquivo), ``start_index`` e ``end_index`` (offsets
+    de caracteres dentro da página) e ``content_hash`` (sha256 do texto, para
+    reconhecer chunks já indexados). Com as páginas chegando aos poucos,
+    ``first_chunk_index`` continua a numeração das chamadas anteriores.
+    """
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=estimate_tokens,
+        separators=SENTENCE_SEPARATORS,
+        is_separator_regex=True,
+        add_start_index=True,
+    )
+    chunks = splitter.split_documents(pages)
+    for chunk_index, chunk in enumerate(chunks, first_chunk_index):
+        chunk.metadata["chunk_index"] = chunk_index
+        chunk.metadata["end_index"] = chunk.metadata["start_index"] + len(chunk.page_content)
+        chunk.metadata["content_hash"] = content_hash(chunk.page_content)
+    return chunks
+
+
+def _span(document: Document) -> Tuple[Tuple, int, int]:
+    metadata = document.metadata
+    key = (metadata.get("file_name"), metadata.get("page_number"))
+    start = metadata.get("start_index", 0)
+    return key, start, metadata.get("end_index", start + len(document.page_content))
+
+
+def assemble_context(
+    results: List[Tuple[Document, float]],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> List[Document]:
+    """
+    Seleciona os chunks mais relevantes que cabem no orçamento de tokens.
+
+    Os resultados são percorridos na ordem recebida (mais relevantes primeiro). Trechos
+    que se sobrepõem a um chunk já escolhido da mesma página são cortados, e um
+    chunk totalmente coberto é descartado, para o mesmo texto não entrar duas vezes.
+    """
+    selected: List[Document] = []
+    spans: Dict[Tuple, List[Tuple[int, int]]] = {}
+    used_tokens = 0
+
+    for document, score in results:
+        key, start, end = _span(document)
+        text = document.page_content
+        for taken_start, taken_end in spans.get(key, []):
+            # Cortar o início ou o fim que já está no contexto
+            if taken_start <= start < taken_end:
+                text = text[min(taken_end - start, len(text)):]
+                start = min(taken_end, end)
+            if taken_start < end <= taken_end:
+                text = text[:max(0, len(text) - (end - taken_start))]
+                end = max(taken_start, start)
+        if not text.strip():
+            continue
+
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > token_budget:
+            continue
+
+        used_tokens += tokens
+        spans.setdefault(key, []).append((start, end))
+        selected.append(Document(
+            page_content=text,
+            metadata={**document.metadata, "start_index": start, "end_index": end}
+        ))
+
+    return selected
@@ -23,7 +23,9 @@ def get_google_api_key():
 # Configurações de diretórios
 DATA_DIR = "data"
 FAISS_INDEX_DIR = os.path.join(DATA_DIR, "faiss_indexes")
-CHAT_HISTORY_DIR = os.path.join(DATA_DIR, "chat_history")
+CHAT_HISTORY_DB = os.path.join(DATA_DIR, "chat_history.sqlite3")
+CHAT_HISTORY_DIR = os.path.join(DATA_DIR, "chat_history")  # Formato antigo (JSON por chat), só para migração
+EMBEDDING_CACHE_DIR = os.path.join(DATA_DIR, "embedding_cache")
 
 # Configurações do FAISS
 FAISS_COLLECTIONS = {
@@ -31,10 +33,109 @@ FAISS_COLLECTIONS = {
     "chat_history": "chat_history"
 }
 
+# Tipo de índice por coleção. Coleções começam como "flat" (busca exata); os demais tipos
+# são aplicados com `python build_index.py <coleção>`, que treina e reconstrói o índice
+# a partir dos vetores gravados. nprobe/efSearch podem ser alterados sem reconstruir.
+#   {"type": "flat"}
+#   {"type": "ivf_flat", "nlist": 1024, "nprobe": 16}
+#   {"type": "ivf_pq", "nlist": 1024, "m": 16, "nbits": 8, "nprobe": 16}
+#   {"type": "hnsw", "M": 32, "efConstruction": 200, "efSearch": 64}
+FAISS_INDEX_TYPES = {
+    "my_docs": {"type": "flat"},
+    "chat_history": {"type": "flat"},
+}
+
+# Coleções divididas em shards (FaissCollection independentes). Cada documento vai para o
+# shard do hash do valor de "key": escritas e compactação tocam só esse shard, e as buscas
+# consultam todos em paralelo. O número de shards fica gravado na criação da coleção
+FAISS_SHARDS = {
+    "my_docs": {"shards": 4, "key": "file_name"},
+}
+FAISS_SEARCH_THREADS = 4  # Threads que executam as buscas dos shards em paralelo
+
+# Opções de abertura de cada coleção (campos com índice de metadados e índice BM25).
+# Usadas pela API e pelo build_index.py: abrir com opções diferentes descartaria o
+# índice de palavras-chave no próximo checkpoint
+FAISS_COLLECTION_OPTIONS = {
+    "my_docs": {"indexed_fields": ("file_name", "file_hash"), "keyword_index": True},
+    "chat_history": {"indexed_fields": ("chat_id",)},
+}
+
+# Registros do segmento após os quais o índice é gravado em formato nativo (checkpoint)
+FAISS_CHECKPOINT_INTERVAL = 5000
+# Compactação: reescrever a coleção quando os vetores removidos (tombstones) passarem
+# do mínimo absoluto e da fração do total de linhas gravadas
+FAISS_COMPACTION_MIN_TOMBSTONES = 1000
+FAISS_COMPACTION_TOMBSTONE_RATIO = 0.3
+
+# Configurações do cache de embeddings
+EMBEDDING_CACHE_MEMORY_SIZE = 10000  # Vetores mantidos no LRU em memória
+
+# Configurações do cache semântico de respostas (/query)
+ANSWER_CACHE_SIMILARITY = 0.95  # Similaridade de cosseno mínima entre as perguntas
+ANSWER_CACHE_TTL = 3600  # Segundos
+ANSWER_CACHE_MAX_ENTRIES = 1000
+
+# Threads para o trabalho bloqueante das requisições (PDF, busca FAISS, gravação em disco)
+BLOCKING_EXECUTOR_WORKERS = 8
+
+# Vários processos (uvicorn --workers): o dono do lock grava nos índices; os demais leem
+# o último snapshot confirmado e enviam as escritas pela fila em disco
+WRITER_LOCK_PATH = os.path.join(DATA_DIR, "writer.lock")
+WRITE_SPOOL_DIR = os.path.join(DATA_DIR, "write_spool")
+INGESTION_STATUS_DIR = os.path.join(DATA_DIR, "ingestion_jobs")
+INDEX_SYNC_INTERVAL = 0.5  # Segundos entre verificações da fila/versão dos índices
+
+# Configurações da fila de ingestão (/upload)
+INGESTION_WORKERS = 2  # Jobs de upload processados em paralelo
+EMBEDDING_BATCH_SIZE = 32  # Chunks por chamada de embedding
+EMBEDDING_MAX_RETRIES = 3
+EMBEDDING_RETRY_BACKOFF = 1.0  # Segundos; dobra a cada nova tentativa
+
+# Extração de PDF em paralelo: faixas de páginas processadas em um pool de processos
+PDF_PARSER_WORKERS = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 8
+PDF_PREFETCH_TASKS = 2 * PDF_PARSER_WORKERS  # Faixas extraídas à frente do embedding (limita a memória)
+
+# Embeddings de perguntas concorrentes agrupados em uma chamada em lote
+QUERY_EMBEDDING_BATCH_WINDOW = 0.01  # Segundos que a primeira pergunta espera por outras (0 desativa)
+QUERY_EMBEDDING_MAX_BATCH = 32  # Perguntas por chamada; um lote cheio sai antes da janela fechar
+
+# /query/batch: várias perguntas em uma requisição
+BATCH_QUERY_MAX_ITEMS = 1000
+BATCH_QUERY_LLM_CONCURRENCY = 8  # Perguntas do lote em geração (LLM) ao mesmo tempo
+
+# Paginação do histórico de chat
+HISTORY_PAGE_SIZE = 100  # Turnos por página em /history/{chat_id}
+CHAT_IDS_PAGE_SIZE = 1000  # Ids por página em /all_chat_ids
+
 # Configurações de busca
-DEFAULT_SEARCH_K = 10
+DEFAULT_SEARCH_K = 6  # Chunks recuperados por pergunta (após a fusão vetorial + BM25)
 CHAT_HISTORY_SEARCH_K = 3
 
+# Busca híbrida: candidatos de cada busca (vetorial e BM25) combinados por reciprocal rank fusion
+HYBRID_CANDIDATES_K = 20
+RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# MMR (maximal marginal relevance): dos MMR_FETCH_K resultados da busca híbrida ficam MMR_K
+# relevantes e pouco parecidos entre si (ex.: páginas quase iguais do mesmo modelo de contrato)
+MMR_ENABLED = True
+MMR_FETCH_K = 12
+MMR_K = 4
+MMR_LAMBDA = 0.5  # 1 = só relevância, 0 = só diversidade
+
+# Configurações de chunking e contexto (tokens estimados por CHARS_PER_TOKEN)
+CHUNK_SIZE_TOKENS = 300
+CHUNK_OVERLAP_TOKENS = 50
+CHARS_PER_TOKEN = 4
+CONTEXT_TOKEN_BUDGET = 3000  # Tokens de documentos enviados ao LLM por pergunta
+
+# Logs: as mensagens por requisição (documentos recuperados, respostas) são DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
 # Configurações de CORS
 CORS_ORIGINS = ["*"]
 CORS_CREDENTIALS = True
@@ -53,6 +154,6 @@ def validate_config():
     # Criar diretórios se não existirem
     os.makedirs(DATA_DIR, exist_ok=True)
     os.makedirs(FAISS_INDEX_DIR, exist_ok=True)
-    os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
     
     return True
@@ -0,0 +1,236 @@
+"""
+Cache persistente de embeddings endereçado por conteúdo
+"""
+
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MEMORY_SIZE
+
+KEY_SIZE = 64  # sha256 em hexadecimal
+
+
+def normalize_text(text: str) -> str:
+    """Normaliza o texto (unicode NFC e espaços) antes de calcular a chave"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_key(model_name: str, kind: str, text: str) -> str:
+    """Gera a chave do cache a partir do modelo, tipo de embedding e texto normalizado"""
+    payload = f"{model_name}\x00{kind}\x00{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskVectorStore:
+    """
+    Armazenamento append-only de vetores em disco, lido via mmap.
+
+    Com ``read_only``, apenas lê o que já estava gravado ao abrir (outro processo
+    é quem escreve): nada é truncado nem anexado.
+    """
+
+    def __init__(self, directory: str, read_only: bool = False):
+        self.directory = directory
+        self.read_only = read_only
+        os.makedirs(directory, exist_ok=True)
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.dim: Optional[int] = None
+        self.rows: Dict[str, int] = {}
+        self._mmap: Optional[np.memmap] = None
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        if self.dim is None or not os.path.exists(self.keys_path):
+            return
+
+        with open(self.keys_path, "r", encoding="ascii") as f:
+            keys = [line.strip() for line in f if len(line.strip()) == KEY_SIZE]
+        vector_rows = 0
+        if os.path.exists(self.vectors_path):
+            vector_rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+
+        # Uma escrita interrompida pode deixar uma chave sem vetor: ignorar a sobra
+        self.rows = {key: row for row, key in enumerate(keys[:vector_rows])}
+        if not self.read_only:
+            self._truncate(len(self.rows))
+
+    def _truncate(self, rows: int):
+        """Descarta registros parciais deixados por uma escrita interrompida"""
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(rows * self.dim * 4)
+        with open(self.keys_path, "ab") as f:
+            f.truncate(rows * (KEY_SIZE + 1))
+
+    def _vectors(self) -> np.memmap:
+        if self._mmap is None or self._mmap.shape[0] < len(self.rows):
+            self._mmap = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r",
+                shape=(len(self.rows), self.dim)
+            )
+        return self._mmap
+
+    def get(self, key: str) -> Optional[List[float]]:
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        return self._vectors()[row].tolist()
+
+    def put_many(self, items: Dict[str, List[float]]):
+        items = {key: vector for key, vector in items.items() if key not in self.rows}
+        if not items or self.read_only:
+            return
+        if self.dim is None:
+            self.dim = len(next(iter(items.values())))
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim}, f)
+
+        keys = list(items.keys())
+        matrix = np.asarray([items[key] for key in keys], dtype=np.float32)
+        # Vetores primeiro, chaves depois: a chave só "existe" quando o vetor já está em disco
+        with open(self.vectors_path, "ab") as f:
+            f.write(matrix.tobytes())
+        # Binário: uma linha tem sempre KEY_SIZE + 1 bytes (sem \r\n no Windows), como _truncate espera
+        with open(self.keys_path, "ab") as f:
+            f.write("".join(f"{key}\n" for key in keys).encode("ascii"))
+
+        start = len(self.rows)
+        for offset, key in enumerate(keys):
+            self.rows[key] = start + offset
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings com cache em dois níveis: LRU em memória e armazenamento mmap em disco"""
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model_name: str,
+        directory: str = EMBEDDING_CACHE_DIR,
+        memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE,
+        read_only: bool = False,
+        query_underlying: Optional[Embeddings] = None,
+    ):
+        self.underlying = underlying
+        # Mesmo modelo configurado para perguntas: embed_documents dele calcula várias perguntas
+        # em uma única chamada (o embed_query do modelo base aceita só um texto por chamada)
+        self.query_underlying = query_underlying
+        self.model_name = model_name
+        self.memory_size = memory_size
+        self.memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.disk = DiskVectorStore(directory, read_only)
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def enable_writes(self):
+        """Reabre o cache em disco para escrita (o processo passou a ser o escritor)"""
+        with self._lock:
+            self.disk = DiskVectorStore(self.disk.directory)
+
+    def _remember(self, key: str, vector: List[float]):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.memory.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return vector
+        vector = self.disk.get(key)
+        if vector is not None:
+            self._remember(key, vector)
+            self.counters["disk_hits"] += 1
+        return vector
+
+    def _partition(self, texts: List[str], kind: str):
+        """Separa os textos já presentes no cache dos que precisam ser calculados"""
+        keys = [embedding_key(self.model_name, kind, text) for text in texts]
+        results: Dict[str, List[float]] = {}
+        missing: Dict[str, str] = {}
+
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in results or key in missing:
+                    continue
+                vector = self._lookup(key)
+                if vector is None:
+                    missing[key] = text
+                else:
+                    results[key] = vector
+            self.counters["misses"] += len(missing)
+        return keys, results, missing
+
+    def _store(self, results: Dict[str, List[float]], missing: Dict[str, str], computed: List[List[float]]):
+        new_items = dict(zip(missing.keys(), computed))
+        with self._lock:
+            self.disk.put_many(new_items)
+            for key, vector in new_items.items():
+                self._remember(key, vector)
+        results.update(new_items)
+
+    def _embed(self, texts: List[str], kind: str) -> List[List[float]]:
+        keys, results, missing = self._partition(texts, kind)
+        if missing:
+            missing_texts = list(missing.values())
+            if kind == "query":
+                computed = [self.underlying.embed_query(text) for text in missing_texts]
+            else:
+                computed = self.underlying.embed_documents(missing_texts)
+            self._store(results, missing, computed)
+        return [results[key] for key in keys]
+
+    async def _aembed(self, texts: List[str], kind: str) -> List[List[float]]:
+        keys, results, missing = self._partition(texts, kind)
+        if missing:
+            missing_texts = list(missing.values())
+            if kind == "query" and self.query_underlying is not None:
+                computed = await self.query_underlying.aembed_documents(missing_texts)
+            elif kind == "query":
+                computed = [await self.underlying.aembed_query(text) for text in missing_texts]
+            else:
+                computed = await self.underlying.aembed_documents(missing_texts)
+            self._store(results, missing, computed)
+        return [results[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document")
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], "query")[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed(texts, "document")
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self._aembed([text], "query"))[0]
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embeddings de várias perguntas, com as ausentes do cache calculadas em lote"""
+        return await self._aembed(texts, "query")
+
+    def stats(self) -> Dict[str, int]:
+        """Retorna os contadores de acertos/falhas do cache"""
+        with self._lock:
+            return {
+                **self.counters,
+                "memory_entries": len(self.memory),
+                "disk_entries": len(self.disk),
+            }
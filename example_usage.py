@@ -5,6 +5,7 @@ Exemplo de uso da API RAG com FAISS local
 
 import requests
 import json
+import time
 import uuid
 
 # Configuração da API
@@ -18,13 +19,24 @@ def upload_document(file_path: str):
         files = {'file': f}
         response = requests.post(f"{API_BASE_URL}/upload", files=files)
     
-    if response.status_code == 200:
-        print("✅ Documento carregado com sucesso!")
-        return response.json()
+    if response.status_code in (200, 202):
+        job = response.json()
+        print(f"✅ Documento enfileirado! Job: {job['job_id']}")
+        return job
     else:
         print(f"❌ Erro no upload: {response.text}")
         return None
 
+def wait_for_upload(job_id: str, interval: float = 1.0):
+    """Aguarda o processamento de um upload enfileirado"""
+    while True:
+        response = requests.get(f"{API_BASE_URL}/upload/{job_id}")
+        status = response.json()
+        if status["status"] in ("done", "failed", "skipped"):
+            print(f"📦 Job {job_id}: {status['status']} ({status['chunks_embedded']}/{status['chunks_total']} chunks)")
+            return status
+        time.sleep(interval)
+
 def query_document(query: str, chat_id: str):
     """Consulta de documentos"""
     print(f"🔍 Fazendo consulta: {query}")
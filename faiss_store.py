@@ -0,0 +1,1067 @@
+"""
+Armazenamento incremental (append-only) de coleções FAISS
+"""
+
+import functools
+import json
+import os
+import shutil
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from config import (
+    FAISS_INDEX_DIR, FAISS_CHECKPOINT_INTERVAL, FAISS_COMPACTION_MIN_TOMBSTONES,
+    FAISS_COMPACTION_TOMBSTONE_RATIO, FAISS_INDEX_TYPES, HYBRID_CANDIDATES_K
+)
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+from rwlock import ReadWriteLock
+from utils import atomic_write_json, load_faiss_index
+
+FORMAT_VERSION = 1
+FLAT_INDEX_SPEC = {"type": "flat"}
+SEARCH_PARAMS = ("nprobe", "efSearch")
+IVF_TYPES = ("ivf_flat", "ivf_pq")
+FLAT_SEARCH_BLOCK_ROWS = 65536  # Linhas de vectors.f32 comparadas por vez na busca flat
+
+
+def create_index(dim: int, spec: Dict):
+    """Cria um índice FAISS vazio, endereçado por id, a partir de uma especificação de FAISS_INDEX_TYPES"""
+    kind = spec.get("type", "flat")
+    if kind == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+    if kind == "ivf_flat":
+        return faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, spec["nlist"])
+    if kind == "ivf_pq":
+        return faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, spec["nlist"], spec["m"], spec.get("nbits", 8))
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, spec["M"])
+        index.hnsw.efConstruction = spec.get("efConstruction", 40)
+        return faiss.IndexIDMap2(index)
+    raise ValueError(f"Tipo de índice FAISS desconhecido: {kind}")
+
+
+class MappedFlatIndex:
+    """
+    Índice flat (L2 exato) sem cópia dos vetores: as buscas percorrem ``vectors.f32``
+    em blocos pelo mmap da coleção e, depois, os vetores ainda não gravados.
+
+    Em memória fica só o id de cada linha do arquivo (-1 se removida). Processos que
+    abrem a mesma coleção compartilham os vetores pelo cache de páginas do sistema, em
+    vez de cada um carregar um ``IndexFlatL2`` próprio. Segue a parte da interface dos
+    índices FAISS usada pela coleção (``add_with_ids``, ``remove_ids``, ``search``).
+    """
+
+    is_trained = True
+
+    def __init__(self, collection: "FaissCollection", ids: Sequence[int] = (),
+                 block_rows: int = FLAT_SEARCH_BLOCK_ROWS):
+        self.collection = collection
+        self.d = collection.dim
+        self.block_rows = block_rows
+        self.row_ids = np.full(0, -1, dtype=np.int64)
+        self.ntotal = 0
+        self.add_with_ids(None, ids)
+
+    def add_with_ids(self, vectors, ids):
+        """Registra ids cuja linha já está em ``collection.rows`` (os vetores vêm da coleção)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        rows = np.fromiter((self.collection.rows[int(vector_id)] for vector_id in ids), dtype=np.int64, count=len(ids))
+        if rows.max() >= len(self.row_ids):
+            row_ids = np.full(max(int(rows.max()) + 1, 2 * len(self.row_ids)), -1, dtype=np.int64)
+            row_ids[:len(self.row_ids)] = self.row_ids
+            self.row_ids = row_ids
+        self.row_ids[rows] = ids
+        self.ntotal += len(ids)
+
+    def remove_ids(self, ids):
+        """Marca as linhas como removidas (chamado antes de a coleção descartar as linhas)"""
+        rows = [self.collection.rows[int(vector_id)] for vector_id in ids if int(vector_id) in self.collection.rows]
+        rows = [row for row in rows if row < len(self.row_ids) and self.row_ids[row] >= 0]
+        self.row_ids[rows] = -1
+        self.ntotal -= len(rows)
+
+    def search(self, queries: np.ndarray, k: int):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        heap = faiss.ResultHeap(len(queries), k)
+        mapped = self.collection._map_vectors()
+        stored = min(len(mapped) if mapped is not None else 0, len(self.row_ids))
+        for start in range(0, stored, self.block_rows):
+            end = min(start + self.block_rows, stored)
+            self._search_block(heap, queries, mapped[start:end], self.row_ids[start:end], k)
+        pending = self.row_ids[stored:]
+        pending = pending[pending >= 0]
+        if len(pending):
+            vectors = np.stack([self.collection._pending_vectors[int(vector_id)] for vector_id in pending])
+            self._search_block(heap, queries, vectors, pending, k)
+        heap.finalize()
+        return heap.D, heap.I
+
+    @staticmethod
+    def _search_block(heap, queries: np.ndarray, vectors: np.ndarray, ids: np.ndarray, k: int):
+        # Mesmo cálculo do IndexFlatL2 (faiss.knn); linhas removidas ocupam posições e são descartadas
+        removed = int((ids < 0).sum())
+        if removed == len(ids):
+            return
+        distances, positions = faiss.knn(queries, np.ascontiguousarray(vectors, dtype=np.float32),
+                                         min(k + removed, len(ids)))
+        found = np.where(positions >= 0, ids[positions], -1)
+        heap.add_result(np.where(found >= 0, distances, np.inf).astype(np.float32), found)
+
+
+class MappedIVFIndex:
+    """
+    IVF de um processo leitor: as listas invertidas do checkpoint são abertas com
+    ``IO_FLAG_MMAP`` e ficam no arquivo (compartilhadas pelo cache de páginas). Essas
+    listas são somente leitura (adicionar a elas aborta o processo), então os vetores
+    anexados depois do checkpoint vão para um flat pequeno em memória e as remoções
+    ficam como tombstones da coleção.
+    """
+
+    is_trained = True
+
+    def __init__(self, path: str, dim: int, spec: Dict):
+        self.d = dim
+        self.base = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+        apply_search_params(self.base, spec)
+        self.tail = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + self.tail.ntotal
+
+    def add_with_ids(self, vectors, ids):
+        self.tail.add_with_ids(np.asarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+
+    def search(self, queries: np.ndarray, k: int):
+        heap = faiss.ResultHeap(len(queries), k)
+        for index in (self.base, self.tail):
+            if index.ntotal:
+                heap.add_result(*index.search(queries, min(k, index.ntotal)))
+        heap.finalize()
+        return heap.D, heap.I
+
+
+def training_points(spec: Dict) -> int:
+    """Mínimo de vetores para treinar o índice (0 quando não há treino)"""
+    kind = spec.get("type", "flat")
+    if kind == "ivf_flat":
+        return spec["nlist"]
+    if kind == "ivf_pq":
+        return max(spec["nlist"], 2 ** spec.get("nbits", 8))
+    return 0
+
+
+def apply_search_params(index, spec: Dict):
+    """Aplica os parâmetros de busca (nprobe, efSearch), que não exigem reconstruir o índice"""
+    parameter_space = faiss.ParameterSpace()
+    for param in SEARCH_PARAMS:
+        if param in spec:
+            parameter_space.set_index_parameter(index, param, spec[param])
+
+
+def fuse_candidates(dense: List[Tuple[int, float]], lexical: List[Tuple[int, float]],
+                    distances: Dict[int, float], k: int) -> List[Tuple[int, float]]:
+    """Reciprocal rank fusion dos candidatos vetoriais e BM25: pares (id, distância L2) na ordem da fusão"""
+    fused = reciprocal_rank_fusion([
+        [vector_id for vector_id, distance in dense],
+        [vector_id for vector_id, score in lexical],
+    ])[:k]
+    return [(vector_id, float(distances[vector_id])) for vector_id in fused]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr_select_batch(query_vectors, candidate_vectors: np.ndarray, valid: np.ndarray,
+                     k: int, lambda_mult: float) -> List[List[int]]:
+    """
+    Maximal marginal relevance de várias perguntas de uma vez.
+
+    ``candidate_vectors`` tem forma (perguntas, candidatos, dim) e ``valid`` marca as
+    posições preenchidas (perguntas com menos candidatos). As similaridades (cosseno)
+    com a pergunta e entre os candidatos saem de multiplicações de matrizes; a cada
+    passo escolhe-se, em todas as perguntas juntas, o candidato com maior
+    ``lambda * relevância - (1 - lambda) * similaridade máxima com os já escolhidos``.
+    Retorna, por pergunta, as posições escolhidas na ordem de seleção.
+    """
+    count, size = valid.shape
+    if not count or not size:
+        return [[] for _ in range(count)]
+    queries = _normalize(np.asarray(query_vectors, dtype=np.float32))
+    candidates = _normalize(np.asarray(candidate_vectors, dtype=np.float32))
+    relevance = np.einsum("qcd,qd->qc", candidates, queries)
+    similarity = candidates @ candidates.transpose(0, 2, 1)
+
+    rows = np.arange(count)
+    available = valid.copy()
+    redundancy = np.zeros((count, size), dtype=np.float32)
+    picks = []
+    for _ in range(min(k, size)):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        choice = scores.argmax(axis=1)
+        # Pergunta sem candidatos restantes: argmax cai em uma posição indisponível
+        picks.append(np.where(available[rows, choice], choice, -1))
+        available[rows, choice] = False
+        redundancy = np.maximum(redundancy, similarity[rows, choice])
+    return [[int(position) for position in row if position >= 0] for row in np.stack(picks, axis=1)]
+
+
+def _synchronized(method):
+    """Serializa os escritores da coleção entre si (as buscas não esperam por este lock)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.read_only:
+            raise RuntimeError(f"Coleção {self.name} aberta somente para leitura (outro processo é o escritor)")
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _reading(method):
+    """Busca sob o lock de leitura: nunca vê o índice no meio de uma alteração"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._rw_lock.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class FaissCollection:
+    """
+    Coleção de vetores FAISS persistida de forma incremental.
+
+    Layout em disco (``<FAISS_INDEX_DIR>/<nome>/``):
+    - ``vectors[.<geração>].f32``: vetores float32 brutos, append-only (lidos via mmap)
+    - ``segment[.<geração>].jsonl``: registros append-only de documentos/metadados, atualizações de metadados e remoções
+    - ``index-<geração>-<offset>.faiss``: checkpoint nativo do índice FAISS (IVF e HNSW; o flat
+      busca direto em ``vectors.f32`` e não tem arquivo de índice)
+    - ``manifest.json``: arquivos e tamanhos confirmados, trocado atomicamente
+
+    Cada commit apenas anexa o delta pendente aos arquivos e depois troca o
+    manifesto. Bytes além do que o manifesto registra são lixo de um commit
+    interrompido e são descartados ao abrir a coleção.
+
+    Remoções ficam como tombstones nos arquivos append-only; quando passam do
+    limite configurado, ``compact`` grava uma nova geração só com os vetores vivos
+    (os ids são preservados) e reconstrói a estrutura FAISS.
+
+    ``indexed_fields`` lista campos de metadados com índice invertido em memória
+    (valor -> ids), usado para listar e remover por metadado sem busca vetorial.
+
+    Com ``keyword_index``, o texto dos documentos também é indexado em BM25
+    (``KeywordIndex``); o snapshot das postings (``keywords-<geração>-<offset>/``)
+    é gravado junto com cada checkpoint e o resto do segmento é reaplicado ao abrir.
+
+    O tipo do índice (flat, ivf_flat, ivf_pq, hnsw) fica registrado no manifesto.
+    Coleções novas começam como flat; ``rebuild`` treina e reconstrói o índice no
+    tipo configurado em ``FAISS_INDEX_TYPES`` a partir dos vetores já gravados.
+
+    Concorrência no processo: escritores são serializados entre si (``_write_lock``)
+    e as buscas compartilham ``_rw_lock``. O acesso exclusivo é tomado só pelo tempo
+    de alterar as estruturas em memória; gravações em disco, checkpoints,
+    compactação e reconstruções preparam a nova versão fora dele e a publicam
+    trocando as referências, então nenhuma busca espera por um salvamento inteiro.
+
+    Memória: o flat (``MappedFlatIndex``) e as listas invertidas de um IVF aberto
+    por um leitor (``MappedIVFIndex``) ficam nos arquivos, compartilhados entre os
+    processos pelo cache de páginas. O HNSW, o IVF do escritor, o docstore e os
+    metadados (lidos do segmento inteiro na abertura) são cópias privadas de cada processo.
+
+    Com ``read_only``, a coleção é um snapshot da versão confirmada no manifesto:
+    nada é gravado (nem o descarte de bytes não confirmados) e as escritas falham.
+    Processos leitores comparam ``version`` com ``manifest_version`` e, quando o
+    escritor confirma uma versão nova, ``reopen`` aplica só os registros anexados
+    (ou reabre a coleção, após uma compactação ou reconstrução).
+    """
+
+    def __init__(self, name: str, embeddings: Embeddings, directory: str = FAISS_INDEX_DIR,
+                 indexed_fields: Sequence[str] = (), keyword_index: bool = False, read_only: bool = False):
+        self.name = name
+        self.read_only = read_only
+        self.embeddings = embeddings
+        self.indexed_fields = tuple(indexed_fields)
+        self.field_index: Dict[str, Dict[object, Set[int]]] = {field: {} for field in self.indexed_fields}
+        self.keywords: Optional[KeywordIndex] = KeywordIndex() if keyword_index else None
+        self.path = os.path.join(directory, name)
+        self.manifest_path = os.path.join(self.path, "manifest.json")
+        self.generation = 0
+        self.version = 0  # Incrementada a cada troca do manifesto
+        self.vectors_file = "vectors.f32"
+        self.segment_file = "segment.jsonl"
+
+        self.dim: Optional[int] = None
+        self.index = None
+        self.index_spec: Dict = dict(FLAT_INDEX_SPEC)
+        # Índices sem remove_ids (HNSW, IVF via mmap): ids removidos ficam marcados até a compactação
+        self.index_tombstones: Set[int] = set()
+        self.docstore: Dict[int, Document] = {}
+        self.rows: Dict[int, int] = {}  # id do vetor -> linha em vectors.f32
+        self.next_id = 0
+        self.vector_rows = 0
+        self.segment_bytes = 0
+        self.checkpoint: Optional[Dict] = None
+        self.records_since_checkpoint = 0
+        self.checkpoint_interval = FAISS_CHECKPOINT_INTERVAL
+
+        self._pending_vectors: Dict[int, np.ndarray] = {}
+        self._pending_rows = 0
+        self._pending_records: List[Dict] = []
+        self._vectors_mmap: Optional[np.memmap] = None
+        self._write_lock = threading.RLock()
+        self._rw_lock = ReadWriteLock()
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.path, self.vectors_file)
+
+    @property
+    def segment_path(self) -> str:
+        return os.path.join(self.path, self.segment_file)
+
+    @property
+    def tombstones(self) -> int:
+        """Linhas gravadas em disco que pertencem a vetores já removidos"""
+        return self.vector_rows + self._pending_rows - len(self.rows)
+
+    @classmethod
+    def open(cls, name: str, embeddings: Embeddings, directory: str = FAISS_INDEX_DIR,
+             indexed_fields: Sequence[str] = (), keyword_index: bool = False,
+             read_only: bool = False, migrate: bool = True) -> "FaissCollection":
+        """Abre uma coleção existente (ou migra o .pkl antigo) ou cria uma vazia"""
+        collection = cls(name, embeddings, directory, indexed_fields, keyword_index, read_only)
+        os.makedirs(collection.path, exist_ok=True)
+        if os.path.exists(collection.manifest_path):
+            collection._load()
+        elif migrate and not read_only:
+            collection._migrate_legacy_pickle()
+        return collection
+
+    def manifest_version(self) -> int:
+        """Versão confirmada em disco (pode estar à frente desta instância em um leitor)"""
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("version", 0)
+        except FileNotFoundError:
+            return 0
+
+    def reopen(self) -> "FaissCollection":
+        """
+        Última versão confirmada pelo escritor.
+
+        Em um leitor, se a geração e o tipo do índice não mudaram, só os registros
+        anexados ao segmento desde a versão atual são aplicados, nesta mesma instância:
+        o custo acompanha o que mudou, não o tamanho da coleção. Compactação e
+        reconstrução (ou uma coleção ainda vazia) abrem uma instância nova.
+        """
+        if self.read_only and self.index is not None:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if (manifest.get("generation", 0) == self.generation
+                    and manifest.get("index_spec", self.index_spec) == self.index_spec
+                    and manifest["segment_bytes"] >= self.segment_bytes):
+                self._apply_committed_tail(manifest)
+                return self
+        return type(self).open(
+            self.name, self.embeddings, os.path.dirname(self.path), self.indexed_fields,
+            self.keywords is not None, self.read_only
+        )
+
+    # ------------------------------------------------------------------
+    # Carregamento
+    # ------------------------------------------------------------------
+
+    def _load(self):
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        self.dim = manifest["dim"]
+        self.next_id = manifest["next_id"]
+        self.vector_rows = manifest["vector_rows"]
+        self.segment_bytes = manifest["segment_bytes"]
+        self.checkpoint = manifest.get("checkpoint")
+        self.generation = manifest.get("generation", 0)
+        self.version = manifest.get("version", 0)
+        self.vectors_file = manifest.get("vectors_file", self.vectors_file)
+        self.segment_file = manifest.get("segment_file", self.segment_file)
+        self.index_spec = manifest.get("index_spec", self.index_spec)
+        if not self.read_only:
+            self._truncate_uncommitted()
+
+        replay_from = self.checkpoint["segment_bytes"] if self.checkpoint else 0
+        tail_adds: List[int] = []
+        tail_deletes: List[int] = []
+        for offset, record in self._read_segment():
+            in_tail = offset >= replay_from
+            if record["op"] == "add":
+                # Gravados a partir de Documents já validados: construct evita revalidar cada um
+                self.docstore[record["id"]] = Document.construct(
+                    page_content=record["page_content"], metadata=record["metadata"]
+                )
+                self.rows[record["id"]] = record["row"]
+                self._index_metadata(record["id"], record["metadata"])
+                if in_tail:
+                    tail_adds.append(record["id"])
+            elif record["op"] == "update":
+                self._replace_metadata(record["id"], record["metadata"])
+            elif record["op"] == "delete":
+                for vector_id in record["ids"]:
+                    self._unindex_metadata(vector_id)
+                    self.docstore.pop(vector_id, None)
+                    self.rows.pop(vector_id, None)
+                if in_tail:
+                    tail_deletes.extend(record["ids"])
+            if in_tail:
+                self.records_since_checkpoint += 1
+
+        self._load_keywords(tail_adds, tail_deletes)
+        if self.dim is None:
+            return
+        if self.read_only:
+            # Mapear já na abertura: uma compactação do escritor pode remover o arquivo depois
+            self._map_vectors()
+        if self.index_spec["type"] == "flat" or not (self.checkpoint or {}).get("file"):
+            # Flat: só o mapa linha -> id; os vetores continuam no arquivo
+            self._install_index(*self._build_index(list(self.rows.keys()), self.index_spec))
+            return
+        checkpoint_path = os.path.join(self.path, self.checkpoint["file"])
+        live_tail = [vector_id for vector_id in tail_adds if vector_id in self.rows]
+        if self.read_only and self.index_spec["type"] in IVF_TYPES:
+            # IO_FLAG_MMAP só vale para as listas invertidas do IVF (no flat e no HNSW não tem
+            # efeito) e as deixa somente leitura: o escritor, que adiciona ao índice, lê sem ele
+            self.index = MappedIVFIndex(checkpoint_path, self.dim, self._search_spec())
+            self.index_tombstones = set(tail_deletes) - set(tail_adds)
+            self._add_to_index(live_tail)
+            return
+        self.index = faiss.read_index(checkpoint_path)
+        if self.index_spec["type"] == "hnsw":
+            stored_ids = faiss.vector_to_array(self.index.id_map)
+            self.index_tombstones = {int(vector_id) for vector_id in stored_ids} - set(self.rows)
+        self._add_to_index(live_tail)
+        if tail_deletes:
+            self._remove_from_index(tail_deletes)
+        apply_search_params(self.index, self._search_spec())
+
+    def _load_keywords(self, tail_adds: List[int], tail_deletes: List[int]):
+        """Abre o snapshot BM25 do checkpoint e reaplica o resto do segmento (ou indexa tudo)"""
+        if self.keywords is None:
+            return
+        snapshot = (self.checkpoint or {}).get("keywords")
+        if snapshot and os.path.isdir(os.path.join(self.path, snapshot)):
+            self.keywords.load(os.path.join(self.path, snapshot))
+            self.keywords.delete(tail_deletes)
+            live_tail = [vector_id for vector_id in tail_adds if vector_id in self.docstore]
+        else:
+            live_tail = sorted(self.docstore)
+        self.keywords.add(live_tail, [self.docstore[vector_id].page_content for vector_id in live_tail])
+
+    def _apply_committed_tail(self, manifest: Dict):
+        """
+        Leitor: aplica os registros confirmados entre ``segment_bytes`` e o manifesto (mesma geração).
+
+        Leitura e preparação ficam fora do lock; docstore, índice FAISS e BM25 mudam
+        juntos na mesma seção de escrita, então uma busca nunca vê um sem o outro.
+        """
+        records = [record for offset, record in self._read_segment(self.segment_bytes, manifest["segment_bytes"])]
+        deleted = {vector_id for record in records if record["op"] == "delete" for vector_id in record["ids"]}
+        adds = [record for record in records if record["op"] == "add" and record["id"] not in deleted]
+
+        checkpoint = manifest.get("checkpoint")
+        new_snapshot = self.keywords is not None and (checkpoint or {}).get("keywords") not in (
+            None, (self.checkpoint or {}).get("keywords"))
+        new_ivf = isinstance(self.index, MappedIVFIndex) and (checkpoint or {}).get("file") != self.checkpoint["file"]
+        since = since_deleted = since_live = None
+        if new_snapshot or new_ivf:
+            # Checkpoint novo: o estado dele e só o resto do segmento a partir do seu offset
+            since = [record for offset, record in self._read_segment(checkpoint["segment_bytes"],
+                                                                     manifest["segment_bytes"])]
+            since_deleted = {vector_id for record in since if record["op"] == "delete" for vector_id in record["ids"]}
+            since_live = [record for record in since if record["op"] == "add" and record["id"] not in since_deleted]
+
+        keywords = analyzed = None
+        if new_snapshot:
+            keywords = KeywordIndex(self.keywords.k1, self.keywords.b)
+            keywords.load(os.path.join(self.path, checkpoint["keywords"]))
+            keywords.delete(since_deleted)
+            keywords.add([record["id"] for record in since_live], [record["page_content"] for record in since_live])
+        elif self.keywords is not None:
+            analyzed = self.keywords.analyze([record["page_content"] for record in adds])
+        # Listas invertidas do checkpoint novo abertas via mmap; o resto entra no flat em memória
+        index = MappedIVFIndex(os.path.join(self.path, checkpoint["file"]), self.dim,
+                               self._search_spec()) if new_ivf else None
+
+        with self._rw_lock.writing():
+            removed = [vector_id for vector_id in deleted if vector_id in self.rows]
+            if removed:
+                # Antes de aplicar os registros: o flat ainda encontra a linha de cada id
+                self._remove_from_index(removed)
+            self.vector_rows = manifest["vector_rows"]
+            for record in records:
+                if record["op"] == "add":
+                    self.docstore[record["id"]] = Document.construct(
+                        page_content=record["page_content"], metadata=record["metadata"]
+                    )
+                    self.rows[record["id"]] = record["row"]
+                    self._index_metadata(record["id"], record["metadata"])
+                elif record["op"] == "update":
+                    self._replace_metadata(record["id"], record["metadata"])
+                elif record["op"] == "delete":
+                    for vector_id in record["ids"]:
+                        self._unindex_metadata(vector_id)
+                        self.docstore.pop(vector_id, None)
+                        self.rows.pop(vector_id, None)
+            if index is not None:
+                self.index = index
+                self.index_tombstones = since_deleted - {record["id"] for record in since if record["op"] == "add"}
+                self._add_to_index([record["id"] for record in since_live])
+            else:
+                self._add_to_index([record["id"] for record in adds])
+            if keywords is not None:
+                # Buscas em andamento terminam no objeto anterior
+                self.keywords = keywords
+            elif self.keywords is not None:
+                self.keywords.delete(removed)
+                self.keywords.add_analyzed([record["id"] for record in adds], analyzed)
+            self.next_id = manifest["next_id"]
+            self.segment_bytes = manifest["segment_bytes"]
+            self.checkpoint = checkpoint
+            self.version = manifest.get("version", 0)
+
+    def _read_segment(self, start: int = 0, end: Optional[int] = None) -> Iterable[Tuple[int, Dict]]:
+        """Registros entre os offsets ``start`` e ``end`` (padrão: o segmento confirmado inteiro)"""
+        if not os.path.exists(self.segment_path):
+            return
+        with open(self.segment_path, "rb") as f:
+            f.seek(start)
+            data = f.read((self.segment_bytes if end is None else end) - start)
+        lines = data.splitlines(keepends=True)
+        # Um único json.loads para o trecho inteiro (em vez de um por linha)
+        records = json.loads(b"[" + b",".join(lines) + b"]")
+        offset = start
+        for line, record in zip(lines, records):
+            yield offset, record
+            offset += len(line)
+
+    def _truncate_uncommitted(self):
+        """Descarta bytes escritos por um commit que não chegou a trocar o manifesto"""
+        for path, size in (
+            (self.vectors_path, self.vector_rows * (self.dim or 0) * 4),
+            (self.segment_path, self.segment_bytes),
+        ):
+            with open(path, "ab") as f:
+                f.truncate(size)
+
+    def _migrate_legacy_pickle(self):
+        """Importa o índice do formato antigo (VectorStore inteiro serializado em .pkl)"""
+        legacy = load_faiss_index(self.name)
+        if legacy is None:
+            return
+        documents, vectors = [], []
+        for position, docstore_id in legacy.index_to_docstore_id.items():
+            document = legacy.docstore.search(docstore_id)
+            if not isinstance(document, Document) or document.metadata.get("placeholder"):
+                continue
+            documents.append(document)
+            vectors.append(legacy.index.reconstruct(position))
+        if documents:
+            self.add_embeddings(documents, vectors)
+            self.commit()
+
+    def _index_metadata(self, vector_id: int, metadata: Dict):
+        for field in self.indexed_fields:
+            if field in metadata:
+                self.field_index[field].setdefault(metadata[field], set()).add(vector_id)
+
+    def _unindex_metadata(self, vector_id: int):
+        document = self.docstore.get(vector_id)
+        if document is None:
+            return
+        for field in self.indexed_fields:
+            value = document.metadata.get(field)
+            ids = self.field_index[field].get(value)
+            if ids is not None:
+                ids.discard(vector_id)
+                if not ids:
+                    del self.field_index[field][value]
+
+    def _search_spec(self, spec: Optional[Dict] = None) -> Dict:
+        """Especificação construída + parâmetros de busca atuais de FAISS_INDEX_TYPES (mesmo tipo)"""
+        spec = dict(spec or self.index_spec)
+        configured = FAISS_INDEX_TYPES.get(self.name, {})
+        if configured.get("type", "flat") == spec["type"]:
+            spec.update({param: configured[param] for param in SEARCH_PARAMS if param in configured})
+        return spec
+
+    def _build_index(self, ids: List[int], spec: Dict, batch_size: int = 10000):
+        """
+        Cria, treina (se preciso) e popula um índice com os vetores gravados, sem
+        recalcular embeddings. Retorna (índice, especificação usada) sem publicá-lo.
+        """
+        if len(ids) < training_points(spec):
+            # Poucos vetores para treinar: manter flat até o próximo rebuild
+            spec = dict(FLAT_INDEX_SPEC)
+        if spec["type"] == "flat":
+            return MappedFlatIndex(self, ids), spec
+        index = create_index(self.dim, spec)
+        if not index.is_trained:
+            sample_size = min(len(ids), spec.get("train_size", 50 * spec["nlist"]))
+            sample = np.random.default_rng(0).choice(len(ids), size=sample_size, replace=False)
+            index.train(self.get_vectors([ids[i] for i in sorted(sample)]))
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            index.add_with_ids(self.get_vectors(batch), np.asarray(batch, dtype=np.int64))
+
+        apply_search_params(index, self._search_spec(spec))
+        return index, spec
+
+    def _install_index(self, index, spec: Dict):
+        """Publica um índice construído por ``_build_index``"""
+        with self._rw_lock.writing():
+            self.index = index
+            self.index_spec = spec
+            self.index_tombstones = set()
+
+    def _add_to_index(self, ids: List[int], vectors=None):
+        """Adiciona ao índice ids que já têm linha em ``rows`` (o flat lê os vetores do arquivo)"""
+        if not ids:
+            return
+        if vectors is None and not isinstance(self.index, MappedFlatIndex):
+            vectors = self.get_vectors(ids)
+        self.index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+    def _remove_from_index(self, ids: List[int]):
+        """Remove ids ainda presentes em ``rows`` (o flat procura a linha de cada um)"""
+        if self.index_spec["type"] == "hnsw" or isinstance(self.index, MappedIVFIndex):
+            self.index_tombstones.update(ids)
+        else:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    # ------------------------------------------------------------------
+    # Escrita
+    # ------------------------------------------------------------------
+
+    def add_documents(self, documents: List[Document]) -> List[int]:
+        """Gera embeddings e adiciona os documentos ao índice (persistidos no próximo commit)"""
+        vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+        return self.add_embeddings(documents, vectors)
+
+    @_synchronized
+    def add_embeddings(self, documents: List[Document], vectors) -> List[int]:
+        """Adiciona documentos com vetores já calculados"""
+        if not documents:
+            return []
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if self.index is None:
+            self.dim = matrix.shape[1]
+            self._install_index(*self._build_index([], self.index_spec))
+
+        ids = list(range(self.next_id, self.next_id + len(documents)))
+        first_row = self.vector_rows + self._pending_rows
+        analyzed = None
+        if self.keywords is not None:
+            analyzed = self.keywords.analyze([document.page_content for document in documents])
+
+        with self._rw_lock.writing():
+            self.next_id += len(documents)
+            self._pending_rows += len(documents)
+            for offset, (vector_id, document) in enumerate(zip(ids, documents)):
+                self.docstore[vector_id] = document
+                self.rows[vector_id] = first_row + offset
+                self._index_metadata(vector_id, document.metadata)
+                self._pending_vectors[vector_id] = matrix[offset]
+            self._add_to_index(ids, matrix)
+            if analyzed is not None:
+                self.keywords.add_analyzed(ids, analyzed)
+
+        self._pending_records.extend(
+            {
+                "op": "add",
+                "id": vector_id,
+                "row": first_row + offset,
+                "page_content": document.page_content,
+                "metadata": document.metadata,
+            }
+            for offset, (vector_id, document) in enumerate(zip(ids, documents))
+        )
+        return ids
+
+    @_synchronized
+    def update_metadata(self, metadata: Dict[int, Dict]):
+        """Troca os metadados de documentos existentes sem tocar nos vetores (persistido no próximo commit)"""
+        metadata = {vector_id: value for vector_id, value in metadata.items() if vector_id in self.docstore}
+        if not metadata:
+            return
+        with self._rw_lock.writing():
+            for vector_id, value in metadata.items():
+                self._replace_metadata(vector_id, value)
+        self._pending_records.extend(
+            {"op": "update", "id": vector_id, "metadata": value} for vector_id, value in metadata.items()
+        )
+
+    def _replace_metadata(self, vector_id: int, metadata: Dict):
+        document = self.docstore.get(vector_id)
+        if document is None:
+            return
+        self._unindex_metadata(vector_id)
+        # Documento novo em vez de alterar o atual: buscas em andamento continuam com a versão lida
+        self.docstore[vector_id] = Document(page_content=document.page_content, metadata=metadata)
+        self._index_metadata(vector_id, metadata)
+
+    @_synchronized
+    def delete(self, ids: List[int]):
+        """Remove vetores pelo id (persistido no próximo commit como registro de remoção)"""
+        ids = [vector_id for vector_id in ids if vector_id in self.docstore]
+        if not ids:
+            return
+        with self._rw_lock.writing():
+            self._remove_from_index(ids)
+            if self.keywords is not None:
+                self.keywords.delete(ids)
+            for vector_id in ids:
+                self._unindex_metadata(vector_id)
+                self.docstore.pop(vector_id)
+                self.rows.pop(vector_id)
+                self._pending_vectors.pop(vector_id, None)
+        self._pending_records.append({"op": "delete", "ids": ids})
+
+    @_synchronized
+    def commit(self):
+        """Persiste apenas o delta pendente e confirma atomicamente pelo manifesto"""
+        if not self._pending_records:
+            return
+        self._truncate_uncommitted()
+
+        # Vetores removidos antes do commit ainda ocupam sua linha para manter os offsets
+        pending_rows = sorted(
+            (record["row"], record["id"]) for record in self._pending_records if record["op"] == "add"
+        )
+        if pending_rows:
+            matrix = np.stack([
+                self._pending_vectors.get(vector_id, np.zeros(self.dim, dtype=np.float32))
+                for _, vector_id in pending_rows
+            ])
+            with open(self.vectors_path, "ab") as f:
+                f.write(matrix.astype(np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        payload = "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in self._pending_records
+        ).encode("utf-8")
+        with open(self.segment_path, "ab") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Os vetores já estão no arquivo: as buscas passam a lê-los pelo mmap
+        with self._rw_lock.writing():
+            self.vector_rows += len(pending_rows)
+            self._pending_vectors.clear()
+            self._pending_rows = 0
+        self.segment_bytes += len(payload)
+        self.records_since_checkpoint += len(self._pending_records)
+        self._pending_records.clear()
+
+        if self._needs_compaction():
+            self.compact()
+        elif self.records_since_checkpoint >= self.checkpoint_interval:
+            self.write_checkpoint()
+        else:
+            self._write_manifest()
+
+    def _needs_compaction(self) -> bool:
+        return (
+            self.tombstones >= FAISS_COMPACTION_MIN_TOMBSTONES
+            and self.tombstones >= FAISS_COMPACTION_TOMBSTONE_RATIO * self.vector_rows
+        )
+
+    @_synchronized
+    def compact(self, batch_size: int = 10000):
+        """
+        Reescreve a coleção sem os tombstones em uma nova geração de arquivos e,
+        se o índice tiver remoções apenas marcadas (HNSW), reconstrói a estrutura
+        FAISS a partir dos vetores vivos (sem recalcular embeddings).
+        """
+        self.commit()
+        if self.index is None:
+            return
+        if self.index_tombstones:
+            self._install_index(*self._build_index(sorted(self.rows), self.index_spec))
+
+        generation = self.generation + 1
+        vectors_file = f"vectors.{generation}.f32"
+        segment_file = f"segment.{generation}.jsonl"
+        live_ids = sorted(self.rows)
+        new_rows: Dict[int, int] = {}
+        segment_bytes = 0
+
+        with open(os.path.join(self.path, vectors_file), "wb") as vectors_out, \
+                open(os.path.join(self.path, segment_file), "wb") as segment_out:
+            for start in range(0, len(live_ids), batch_size):
+                batch = live_ids[start:start + batch_size]
+                matrix = self.get_vectors(batch)
+                vectors_out.write(matrix.tobytes())
+
+                lines = []
+                for vector_id in batch:
+                    new_rows[vector_id] = len(new_rows)
+                    document = self.docstore[vector_id]
+                    lines.append(json.dumps({
+                        "op": "add",
+                        "id": vector_id,
+                        "row": new_rows[vector_id],
+                        "page_content": document.page_content,
+                        "metadata": document.metadata,
+                    }, ensure_ascii=False) + "\n")
+                payload = "".join(lines).encode("utf-8")
+                segment_out.write(payload)
+                segment_bytes += len(payload)
+            for f in (vectors_out, segment_out):
+                f.flush()
+                os.fsync(f.fileno())
+
+        old_files = [self.vectors_file, self.segment_file]
+        with self._rw_lock.writing():
+            self.generation = generation
+            self.vectors_file = vectors_file
+            self.segment_file = segment_file
+            self.rows = new_rows
+            self.vector_rows = len(new_rows)
+            self._vectors_mmap = None
+            if isinstance(self.index, MappedFlatIndex):
+                self.index = MappedFlatIndex(self, live_ids)
+        self.segment_bytes = segment_bytes
+
+        # O checkpoint troca o manifesto: só a partir daqui a nova geração passa a valer
+        self.write_checkpoint()
+        for file_name in old_files:
+            os.remove(os.path.join(self.path, file_name))
+
+    @_synchronized
+    def rebuild(self, spec: Optional[Dict] = None):
+        """
+        Treina e reconstrói o índice no tipo pedido (padrão: FAISS_INDEX_TYPES da coleção)
+        a partir dos vetores gravados, sem recalcular embeddings, e grava um checkpoint.
+        """
+        self.commit()
+        if self.dim is None:
+            return
+        spec = dict(spec or FAISS_INDEX_TYPES.get(self.name, FLAT_INDEX_SPEC))
+        # O índice novo é treinado fora do lock: as buscas seguem no atual até a troca
+        self._install_index(*self._build_index(sorted(self.rows), spec))
+        self.write_checkpoint()
+
+    @_synchronized
+    def write_checkpoint(self):
+        """Grava o índice FAISS em formato nativo para acelerar a próxima abertura"""
+        if self.index is None:
+            return
+        # O nome carrega o offset do segmento: um checkpoint novo nunca sobrescreve
+        # o que o manifesto atual referencia, e só passa a valer após a troca do manifesto
+        previous = self.checkpoint
+        checkpoint = {"segment_bytes": self.segment_bytes}
+        if not isinstance(self.index, MappedFlatIndex):
+            # O flat já está inteiro em vectors.f32: o checkpoint guarda só o offset (e o BM25)
+            checkpoint["file"] = f"index-{self.generation}-{self.segment_bytes}.faiss"
+            tmp_path = os.path.join(self.path, f"{checkpoint['file']}.tmp")
+            faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, os.path.join(self.path, checkpoint["file"]))
+        if self.keywords is not None:
+            checkpoint["keywords"] = f"keywords-{self.generation}-{self.segment_bytes}"
+            if not previous or previous.get("keywords") != checkpoint["keywords"]:
+                snapshot_path = os.path.join(self.path, checkpoint["keywords"])
+                self.keywords.write(snapshot_path)
+                keywords = KeywordIndex(self.keywords.k1, self.keywords.b)
+                keywords.load(snapshot_path)
+                # Buscas em andamento terminam no objeto anterior
+                self.keywords = keywords
+        self.checkpoint = checkpoint
+        self.records_since_checkpoint = 0
+        self._write_manifest()
+        if previous and previous.get("file") not in (None, checkpoint.get("file")):
+            os.remove(os.path.join(self.path, previous["file"]))
+        if previous and previous.get("keywords") not in (None, checkpoint.get("keywords")):
+            shutil.rmtree(os.path.join(self.path, previous["keywords"]), ignore_errors=True)
+
+    def _write_manifest(self):
+        self.version += 1
+        atomic_write_json(self.manifest_path, {
+            "format": FORMAT_VERSION,
+            "version": self.version,
+            "dim": self.dim,
+            "next_id": self.next_id,
+            "vector_rows": self.vector_rows,
+            "segment_bytes": self.segment_bytes,
+            "checkpoint": self.checkpoint,
+            "generation": self.generation,
+            "vectors_file": self.vectors_file,
+            "segment_file": self.segment_file,
+            "index_spec": self.index_spec,
+        })
+
+    # ------------------------------------------------------------------
+    # Leitura
+    # ------------------------------------------------------------------
+
+    def reading(self):
+        """Seção de leitura: ids e documentos não mudam enquanto estiver aberta (reentrante)"""
+        return self._rw_lock.reading()
+
+    @property
+    @_reading
+    def ntotal(self) -> int:
+        return self.index.ntotal - len(self.index_tombstones) if self.index is not None else 0
+
+    @_reading
+    def get_vectors(self, ids: List[int]) -> np.ndarray:
+        """Retorna os vetores armazenados (sem recalcular embeddings)"""
+        if not ids:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        self._map_vectors()
+        if not any(vector_id in self._pending_vectors for vector_id in ids):
+            # Tudo já gravado: uma única leitura indexada do mmap em vez de uma por linha
+            return np.asarray(self._vectors_mmap[[self.rows[vector_id] for vector_id in ids]], dtype=np.float32)
+        return np.stack([
+            self._pending_vectors[vector_id] if vector_id in self._pending_vectors
+            else self._vectors_mmap[self.rows[vector_id]]
+            for vector_id in ids
+        ]).astype(np.float32)
+
+    @_reading
+    def get_live_vectors(self, ids: List[int]) -> Tuple[List[int], np.ndarray]:
+        """Vetores dos ids ainda ativos: os removidos depois de uma busca ficam de fora"""
+        live = [vector_id for vector_id in ids if vector_id in self.rows]
+        return live, self.get_vectors(live)
+
+    def _map_vectors(self) -> Optional[np.memmap]:
+        if self._vectors_mmap is None or self._vectors_mmap.shape[0] < self.vector_rows:
+            self._vectors_mmap = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r", shape=(self.vector_rows, self.dim)
+            ) if self.vector_rows else None
+        return self._vectors_mmap
+
+    @_reading
+    def ids_where(self, field: str, value) -> List[int]:
+        """Ids dos vetores cujo metadado ``field`` é igual a ``value`` (campo indexado)"""
+        return sorted(self.field_index[field].get(value, ()))
+
+    @_reading
+    def values(self, field: str) -> List:
+        """Valores distintos de um campo de metadado indexado"""
+        return list(self.field_index[field].keys())
+
+    @_reading
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[Dict[str, object]] = None) -> List[Tuple[Document, float]]:
+        """
+        Busca os k documentos mais próximos do vetor (distância L2, como no LangChain).
+
+        Com ``filter`` (campos indexados), a busca é exata e restrita aos ids das
+        listas invertidas correspondentes: o custo depende do tamanho do subconjunto,
+        não da coleção, e nunca há pós-filtragem de um top-k global.
+        """
+        if filter is not None:
+            return self._search_within(embedding, k, self._filter_ids(filter))
+        return [(self.docstore[vector_id], distance) for vector_id, distance in self.search_ids(embedding, k)]
+
+    @_reading
+    def search_ids(self, embedding, k: int = 4) -> List[Tuple[int, float]]:
+        """Busca no índice FAISS e retorna pares (id do vetor, distância)"""
+        return self.search_ids_batch([embedding], k)[0]
+
+    @_reading
+    def search_ids_batch(self, embeddings, k: int = 4) -> List[List[Tuple[int, float]]]:
+        """
+        Busca várias perguntas em uma única chamada ao FAISS (uma linha por pergunta).
+
+        O índice percorre as listas/vetores uma vez para o lote inteiro, em vez de
+        uma vez por pergunta.
+        """
+        if len(embeddings) == 0 or self.ntotal == 0:
+            return [[] for _ in range(len(embeddings))]
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        # Ids apenas marcados como removidos ocupam posições no top-k: buscar a mais e descartá-los
+        search_k = min(k + len(self.index_tombstones), self.index.ntotal)
+        distances, ids = self.index.search(queries, search_k)
+        return [
+            [
+                (int(vector_id), float(distance))
+                for distance, vector_id in zip(row_distances, row_ids)
+                if vector_id != -1 and int(vector_id) not in self.index_tombstones
+            ][:k]
+            for row_distances, row_ids in zip(distances, ids)
+        ]
+
+    @_reading
+    def hybrid_search_ids(self, embedding, query: str, k: int = 4,
+                          candidates: int = HYBRID_CANDIDATES_K) -> List[Tuple[int, float]]:
+        """
+        Busca vetorial e BM25 combinadas por reciprocal rank fusion.
+
+        Retorna pares (id, distância L2) na ordem da fusão; ids encontrados só
+        pelo BM25 têm a distância calculada a partir dos vetores gravados.
+        """
+        return self.hybrid_search_ids_batch([embedding], [query], k, candidates)[0]
+
+    @_reading
+    def hybrid_search_ids_batch(self, embeddings, queries: List[str], k: int = 4,
+                                candidates: int = HYBRID_CANDIDATES_K) -> List[List[Tuple[int, float]]]:
+        """Versão em lote de ``hybrid_search_ids``: a parte vetorial é uma única busca no FAISS"""
+        return [
+            fuse_candidates(dense, lexical, distances, k)
+            for dense, lexical, distances in self.hybrid_candidates_batch(embeddings, queries, k, max(k, candidates))
+        ]
+
+    @_reading
+    def hybrid_candidates_batch(self, embeddings, queries: List[str], k: int = 4,
+                                candidates: int = HYBRID_CANDIDATES_K):
+        """
+        Candidatos de cada pergunta antes da fusão: (id, distância) da busca vetorial,
+        (id, score) do BM25 e as distâncias L2 que a fusão dos k primeiros pode pedir.
+        Usado também para combinar os candidatos de vários shards.
+
+        Um id só do BM25 abaixo da posição k nunca entra no top-k da fusão (os k
+        primeiros de cada lista têm score maior), então só os k primeiros do BM25
+        têm a distância calculada a partir dos vetores gravados.
+        """
+        results = []
+        for embedding, query, dense in zip(embeddings, queries, self.search_ids_batch(embeddings, candidates)):
+            lexical = self.keywords.search(query, candidates) if self.keywords is not None else []
+            distances = dict(dense)
+            missing = [vector_id for vector_id, score in lexical[:k] if vector_id not in distances]
+            if missing:
+                vectors = self.get_vectors(missing)
+                query_vector = np.asarray(embedding, dtype=np.float32)
+                distances.update(zip(missing, ((vectors - query_vector) ** 2).sum(axis=1).tolist()))
+            results.append((dense, lexical, distances))
+        return results
+
+    def _filter_ids(self, filter: Dict[str, object]) -> List[int]:
+        candidates: Optional[Set[int]] = None
+        for field, value in filter.items():
+            ids = self.field_index[field].get(value, set())
+            candidates = set(ids) if candidates is None else candidates & ids
+        return sorted(candidates or ())
+
+    def _search_within(self, embedding: List[float], k: int, ids: List[int]) -> List[Tuple[Document, float]]:
+        if not ids:
+            return []
+        vectors = self.get_vectors(ids)
+        query = np.asarray(embedding, dtype=np.float32)
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        k = min(k, len(ids))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(self.docstore[ids[i]], float(distances[i])) for i in top]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filter: Optional[Dict[str, object]] = None) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k, filter)
@@ -0,0 +1,251 @@
+"""
+Fila de ingestão de documentos em segundo plano
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import Executor
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+from langchain_core.documents import Document
+
+from config import (
+    INGESTION_WORKERS, EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_RETRIES,
+    EMBEDDING_RETRY_BACKOFF
+)
+from utils import atomic_write_json
+
+logger = logging.getLogger("rag.ingestion")
+
+
+async def with_retry(func: Callable[..., Awaitable[Any]], *args,
+                     retries: int = EMBEDDING_MAX_RETRIES,
+                     backoff: float = EMBEDDING_RETRY_BACKOFF):
+    """Executa uma corrotina com novas tentativas e backoff exponencial"""
+    for attempt in range(retries + 1):
+        try:
+            return await func(*args)
+        except Exception:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * (2 ** attempt))
+
+
+class IngestionJob:
+    """Estado e progresso de um upload enfileirado"""
+
+    def __init__(self, file_name: str, payload: Any, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.file_name = file_name
+        self.payload = payload
+        self.status = "queued"
+        self.pages_total = 0
+        self.pages_parsed = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_reused = 0
+        self.chunks_duplicated = 0
+        self.error: Optional[str] = None
+        self.created_at = datetime.now().isoformat()
+        self.finished_at: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "file_name": self.file_name,
+            "status": self.status,
+            "pages_total": self.pages_total,
+            "pages_parsed": self.pages_parsed,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_reused": self.chunks_reused,
+            "chunks_duplicated": self.chunks_duplicated,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionQueue:
+    """
+    Fila assíncrona de ingestão com um pool de workers.
+
+    Cada job passa por: ``parse`` (gera os chunks do payload à medida que são
+    extraídos), ``embed`` (em lotes de ``batch_size``, com retry/backoff, já durante
+    a extração) e ``commit`` (gravar no índice, de uma vez, ao final).
+
+    Chunks com ``content_hash`` repetido dentro do mesmo arquivo são descartados, e
+    os que ``indexed`` informa como já indexados não passam pelo embedding: vão
+    para o ``commit`` sem vetor, para reaproveitar o que já está no índice.
+
+    Com ``status_dir``, o estado de cada job também é gravado em
+    ``<status_dir>/<job_id>.json``, para ser consultado por outros processos. Essas
+    gravações rodam no ``executor`` (padrão: o do event loop), nunca no event loop.
+    """
+
+    def __init__(
+        self,
+        parse: Callable[[IngestionJob], AsyncIterator[Document]],
+        embed: Callable[[List[str]], Awaitable[List[List[float]]]],
+        commit: Callable[[List[Document], List[List[float]], List[Document]], Awaitable[None]],
+        indexed: Optional[Callable[[IngestionJob], Awaitable[Set[str]]]] = None,
+        workers: int = INGESTION_WORKERS,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_finished_jobs: int = 1000,
+        status_dir: Optional[str] = None,
+        executor: Optional[Executor] = None,
+    ):
+        self.parse = parse
+        self.embed = embed
+        self.commit = commit
+        self.indexed = indexed
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_finished_jobs = max_finished_jobs
+        self.status_dir = status_dir
+        self.executor = executor
+        if status_dir:
+            os.makedirs(status_dir, exist_ok=True)
+        self.jobs: Dict[str, IngestionJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _ensure_started(self):
+        # Os workers são criados no primeiro uso, já dentro do event loop do servidor
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, file_name: str, payload: Any, job_id: Optional[str] = None) -> IngestionJob:
+        """Enfileira um novo job e retorna imediatamente"""
+        self._ensure_started()
+        job = IngestionJob(file_name, payload, job_id)
+        self.jobs[job.id] = job
+        await self.record(job)
+        await self._queue.put(job)
+        return job
+
+    async def skip(self, file_name: str) -> IngestionJob:
+        """Registra como concluído, sem processar, um upload cujo conteúdo já está indexado"""
+        job = IngestionJob(file_name, None)
+        job.status = "skipped"
+        job.finished_at = datetime.now().isoformat()
+        self.jobs[job.id] = job
+        await self.record(job)
+        await self._prune()
+        return job
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _status_path(self, job_id: str) -> str:
+        return os.path.join(self.status_dir, f"{job_id}.json")
+
+    async def record(self, job: IngestionJob):
+        """Grava o estado do job em ``status_dir`` (visível para os outros processos)"""
+        if self.status_dir:
+            # O estado é copiado aqui, no event loop; só a escrita (com fsync) vai para o executor
+            await self._run_blocking(atomic_write_json, self._status_path(job.id), job.to_dict())
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Estado do job, deste processo ou gravado em ``status_dir`` por outro"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.status_dir and os.path.basename(job_id) == job_id:
+            try:
+                with open(self._status_path(job_id), "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                pass
+        return None
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+                job.status = "done"
+                logger.info("ingestão concluída job=%s file=%s chunks=%d embedded=%d reused=%d",
+                            job.id, job.file_name, job.chunks_total, job.chunks_embedded, job.chunks_reused)
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                logger.warning("ingestão falhou job=%s file=%s error=%s", job.id, job.file_name, e)
+            finally:
+                job.payload = None
+                job.finished_at = datetime.now().isoformat()
+                try:
+                    await self.record(job)
+                    await self._prune()
+                finally:
+                    self._queue.task_done()
+
+    async def _prune(self):
+        """Descarta os jobs finalizados mais antigos para não crescer sem limite"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at]
+        expired = finished[:max(0, len(finished) - self.max_finished_jobs)]
+        for job_id in expired:
+            del self.jobs[job_id]
+        if self.status_dir and expired:
+            await self._run_blocking(self._remove_status_files, expired)
+
+    def _remove_status_files(self, job_ids: List[str]):
+        for job_id in job_ids:
+            try:
+                os.remove(self._status_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    async def _process(self, job: IngestionJob):
+        job.status = "parsing"
+        await self.record(job)
+        known = await self.indexed(job) if self.indexed else set()
+        seen: Set[str] = set()
+        documents: List[Document] = []
+        vectors: List[List[float]] = []
+        reused: List[Document] = []
+        batch: List[Document] = []
+        # Se o embedding falhar, aclose() encerra a extração (e libera o arquivo) na hora
+        chunks = self.parse(job)
+        try:
+            async for document in chunks:
+                job.chunks_total += 1
+                digest = document.metadata.get("content_hash")
+                if digest is not None:
+                    if digest in seen:
+                        job.chunks_duplicated += 1
+                        continue
+                    seen.add(digest)
+                    if digest in known:
+                        reused.append(document)
+                        job.chunks_reused += 1
+                        continue
+                batch.append(document)
+                if len(batch) == self.batch_size:
+                    await self._embed_batch(job, batch, documents, vectors)
+                    batch = []
+        finally:
+            await chunks.aclose()
+        if batch:
+            await self._embed_batch(job, batch, documents, vectors)
+        if not documents and not reused:
+            raise ValueError("O documento está vazio. Tente novamente com outro arquivo.")
+
+        job.status = "committing"
+        await self.record(job)
+        await self.commit(documents, vectors, reused)
+
+    async def _embed_batch(self, job: IngestionJob, batch: List[Document],
+                           documents: List[Document], vectors: List[List[float]]):
+        # O lote sai assim que completo; as páginas seguintes continuam sendo extraídas
+        job.status = "embedding"
+        vectors.extend(await with_retry(self.embed, [doc.page_content for doc in batch]))
+        documents.extend(batch)
+        job.chunks_embedded = len(vectors)
+        await self.record(job)
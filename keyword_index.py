@@ -0,0 +1,284 @@
+"""
+Índice invertido BM25 para busca por palavras-chave (identificadores, cláusulas, nomes)
+"""
+
+import json
+import math
+import os
+import re
+import shutil
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from config import BM25_K1, BM25_B, RRF_K
+
+# Palavras (e identificadores como "12.345.678/0001-90" ou "3.1") sem acentos
+TOKEN_PATTERN = re.compile(r"\w+(?:[./-]\w+)*")
+TOKEN_SEPARATORS = re.compile(r"[./-]")
+STOPWORDS = {
+    "a", "o", "as", "os", "e", "de", "da", "do", "das", "dos", "em", "na", "no", "nas", "nos",
+    "um", "uma", "por", "para", "com", "que", "se", "ao", "aos", "ou", "qual", "quais",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Normaliza (minúsculas, sem acentos) e divide o texto em termos.
+
+    Identificadores com pontuação geram as partes e a forma sem pontuação, para
+    "12.345.678/0001-90" casar também com "12345678000190".
+    """
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    tokens = []
+    for match in TOKEN_PATTERN.findall(text):
+        parts = TOKEN_SEPARATORS.split(match)
+        if len(parts) > 1:
+            tokens.append("".join(parts))
+        tokens.extend(part for part in parts if part not in STOPWORDS)
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> List[int]:
+    """Combina rankings de ids somando 1 / (k + posição) de cada lista"""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda item: (-scores[item], item))
+
+
+def _save(path: str, array: np.ndarray):
+    with open(path, "wb") as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class KeywordIndex:
+    """
+    Índice BM25 incremental com postings compactas.
+
+    A base é um snapshot imutável de arrays numpy abertos via mmap
+    (``<dir>/``: ``vocab.json``, ``offsets.npy``, ``postings.npy``,
+    ``frequencies.npy``, ``doc_ids.npy``, ``doc_lengths.npy``): as postings de
+    cada termo ficam contíguas em ``postings[offsets[t]:offsets[t + 1]]``.
+    Documentos adicionados depois do snapshot ficam em um delta em memória e
+    remoções em um conjunto de ids; ``write`` funde tudo em um novo snapshot.
+
+    Como no Lucene, documentos removidos ainda contam no df até o próximo
+    snapshot: o IDF fica levemente desatualizado, mas nunca são retornados.
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.path: Optional[str] = None
+        self.vocab: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+        self.frequencies = np.empty(0, dtype=np.uint16)
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.doc_lengths = np.empty(0, dtype=np.int32)
+
+        self.delta: Dict[str, Dict[int, int]] = {}  # termo -> {id: frequência}
+        self.delta_lengths: Dict[int, int] = {}
+        self.delta_terms: Dict[int, List[str]] = {}  # id -> termos distintos (para remover do delta)
+        self.deleted: Set[int] = set()  # ids removidos da base
+        self.total_docs = 0
+        self.total_length = 0
+
+    def __len__(self):
+        return self.total_docs
+
+    # ------------------------------------------------------------------
+    # Snapshot
+    # ------------------------------------------------------------------
+
+    def load(self, path: str):
+        """Abre um snapshot gravado por ``write`` (arrays via mmap) e descarta o delta"""
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            self.terms = json.load(f)
+        self.vocab = {term: index for index, term in enumerate(self.terms)}
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ("offsets", "postings", "frequencies", "doc_ids", "doc_lengths")
+        }
+        self.offsets = arrays["offsets"]
+        self.postings = arrays["postings"]
+        self.frequencies = arrays["frequencies"]
+        self.doc_ids = arrays["doc_ids"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.path = path
+
+        self.delta = {}
+        self.delta_lengths = {}
+        self.delta_terms = {}
+        self.deleted = set()
+        self.total_docs = len(self.doc_ids)
+        self.total_length = int(np.asarray(self.doc_lengths, dtype=np.int64).sum())
+
+    def write(self, path: str):
+        """Funde base, delta e remoções em um novo snapshot em ``path`` (abra com ``load``)"""
+        counts = np.diff(self.offsets)
+        term_of = np.repeat(np.arange(len(self.terms), dtype=np.int64), counts)
+        doc_of = np.asarray(self.doc_ids)[self.postings]
+        frequencies = np.asarray(self.frequencies)
+
+        terms = list(self.terms)
+        vocab = dict(self.vocab)
+        delta_terms, delta_docs, delta_frequencies = [], [], []
+        for term, postings in self.delta.items():
+            term_index = vocab.setdefault(term, len(terms))
+            if term_index == len(terms):
+                terms.append(term)
+            delta_terms.extend([term_index] * len(postings))
+            delta_docs.extend(postings.keys())
+            delta_frequencies.extend(postings.values())
+
+        term_of = np.concatenate([term_of, np.asarray(delta_terms, dtype=np.int64)])
+        doc_of = np.concatenate([doc_of, np.asarray(delta_docs, dtype=np.int64)])
+        frequencies = np.concatenate([frequencies, np.asarray(delta_frequencies, dtype=np.uint16)])
+
+        deleted = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        live = ~np.isin(doc_of, deleted)
+        term_of, doc_of, frequencies = term_of[live], doc_of[live], frequencies[live]
+        order = np.lexsort((doc_of, term_of))
+        term_of, doc_of, frequencies = term_of[order], doc_of[order], frequencies[order]
+
+        base_live = ~np.isin(self.doc_ids, deleted)
+        doc_ids = np.concatenate([
+            np.asarray(self.doc_ids)[base_live], np.fromiter(self.delta_lengths, dtype=np.int64)
+        ])
+        doc_lengths = np.concatenate([
+            np.asarray(self.doc_lengths)[base_live],
+            np.fromiter(self.delta_lengths.values(), dtype=np.int32),
+        ])
+        doc_order = np.argsort(doc_ids, kind="stable")
+        doc_ids, doc_lengths = doc_ids[doc_order], doc_lengths[doc_order]
+
+        # Termos sem nenhuma posting viva saem do vocabulário
+        used_terms, term_of = np.unique(term_of, return_inverse=True)
+        offsets = np.zeros(len(used_terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_of, minlength=len(used_terms)), out=offsets[1:])
+
+        # Sobras de uma gravação interrompida (antes da troca do manifesto) são descartadas
+        tmp_path = f"{path}.tmp"
+        for stale in (tmp_path, path):
+            shutil.rmtree(stale, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump([terms[index] for index in used_terms], f, ensure_ascii=False)
+        _save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        _save(os.path.join(tmp_path, "postings.npy"), np.searchsorted(doc_ids, doc_of).astype(np.int32))
+        _save(os.path.join(tmp_path, "frequencies.npy"), frequencies.astype(np.uint16))
+        _save(os.path.join(tmp_path, "doc_ids.npy"), doc_ids)
+        _save(os.path.join(tmp_path, "doc_lengths.npy"), doc_lengths)
+        os.replace(tmp_path, path)
+
+    # ------------------------------------------------------------------
+    # Escrita
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def analyze(texts: Iterable[str]) -> List[Counter]:
+        """Frequência dos termos de cada texto (pode rodar fora de qualquer lock)"""
+        return [Counter(tokenize(text)) for text in texts]
+
+    def add(self, ids: Iterable[int], texts: Iterable[str]):
+        """Indexa textos novos no delta em memória"""
+        self.add_analyzed(ids, self.analyze(texts))
+
+    def add_analyzed(self, ids: Iterable[int], analyzed: Iterable[Counter]):
+        """Indexa no delta textos já passados por ``analyze``"""
+        for doc_id, counts in zip(ids, analyzed):
+            length = sum(counts.values())
+            for term, frequency in counts.items():
+                self.delta.setdefault(term, {})[doc_id] = min(frequency, np.iinfo(np.uint16).max)
+            self.delta_lengths[doc_id] = length
+            self.delta_terms[doc_id] = list(counts)
+            self.total_docs += 1
+            self.total_length += length
+
+    def delete(self, ids: Iterable[int]):
+        """Remove documentos (do delta, ou marcando os da base até o próximo snapshot)"""
+        for doc_id in ids:
+            length = self.delta_lengths.pop(doc_id, None)
+            if length is None:
+                length = self._base_length(doc_id)
+                if length is None or doc_id in self.deleted:
+                    continue
+                self.deleted.add(doc_id)
+            else:
+                for term in self.delta_terms.pop(doc_id):
+                    postings = self.delta[term]
+                    postings.pop(doc_id)
+                    if not postings:
+                        del self.delta[term]
+            self.total_docs -= 1
+            self.total_length -= length
+
+    def _base_length(self, doc_id: int) -> Optional[int]:
+        position = int(np.searchsorted(self.doc_ids, doc_id))
+        if position < len(self.doc_ids) and self.doc_ids[position] == doc_id:
+            return int(self.doc_lengths[position])
+        return None
+
+    # ------------------------------------------------------------------
+    # Busca
+    # ------------------------------------------------------------------
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
+        """Retorna os k documentos com maior score BM25 como pares (id, score)"""
+        if self.total_docs == 0:
+            return []
+        average_length = max(self.total_length / self.total_docs, 1e-9)
+        base_ordinals, base_scores = [], []
+        scores: Dict[int, float] = {}
+
+        for term in set(tokenize(query)):
+            base_index = self.vocab.get(term)
+            delta_postings = self.delta.get(term, {})
+            start = end = 0
+            if base_index is not None:
+                start, end = int(self.offsets[base_index]), int(self.offsets[base_index + 1])
+            df = (end - start) + len(delta_postings)
+            if df == 0:
+                continue
+            idf = math.log(1 + (self.total_docs - df + 0.5) / (df + 0.5))
+
+            if end > start:
+                ordinals = np.asarray(self.postings[start:end])
+                frequencies = np.asarray(self.frequencies[start:end], dtype=np.float32)
+                lengths = np.asarray(self.doc_lengths)[ordinals]
+                base_ordinals.append(ordinals)
+                base_scores.append(idf * self._saturate(frequencies, lengths, average_length))
+            for doc_id, frequency in delta_postings.items():
+                length = self.delta_lengths[doc_id]
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * float(
+                    self._saturate(frequency, length, average_length)
+                )
+
+        if base_ordinals:
+            # Soma por documento só sobre as postings tocadas, sem array do tamanho da coleção
+            ordinals, inverse = np.unique(np.concatenate(base_ordinals), return_inverse=True)
+            totals = np.bincount(inverse, weights=np.concatenate(base_scores))
+            # Ids removidos ocupam posições no top-k: separar a mais e descartá-los
+            top = min(len(totals), k + len(self.deleted))
+            best = np.argpartition(-totals, top - 1)[:top]
+            for position in best:
+                doc_id = int(self.doc_ids[ordinals[position]])
+                if doc_id not in self.deleted:
+                    scores[doc_id] = scores.get(doc_id, 0.0) + float(totals[position])
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def _saturate(self, frequency, length, average_length):
+        return frequency * (self.k1 + 1) / (
+            frequency + self.k1 * (1 - self.b + self.b * length / average_length)
+        )
@@ -1,35 +1,54 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import time
+
+# Início do import deste módulo: referência das durações em startup_seconds
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from collections import Counter
+from typing import AsyncIterator, List, Dict, Optional, Set
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import asyncio
+import hashlib
+import json
+import logging
+import threading
 import tempfile
-import time
 import os
-from utils import (
-    clean_text_data, save_faiss_index, load_faiss_index, 
-    save_chat_history, get_chat_history, get_all_chat_ids, 
-    clear_chat_history
-)
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from datetime import datetime
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.chains import create_retrieval_chain
 from langchain_core.documents import Document
 from langchain.prompts import PromptTemplate
-from langchain_community.vectorstores import FAISS
-from ia import llm_google
+from embedding_cache import CachedEmbeddings
+from batching import MicroBatcher
+from chat_store import ChatHistoryStore
+from answer_cache import AnswerCache
+from metrics import MetricsRegistry
+from faiss_store import FaissCollection
+from sharded_store import ShardedCollection
+from ingestion import IngestionJob, IngestionQueue
+from shared_index import WriterLock, WriteSpool
+from chunking import chunk_documents, assemble_context
+from pdf_parser import count_pdf_pages, iter_pdf_pages, watch_parent
 from config import (
     API_TITLE, API_DESCRIPTION, API_VERSION, get_google_api_key,
     GOOGLE_EMBEDDING_MODEL, CORS_ORIGINS, CORS_CREDENTIALS,
     CORS_METHODS, CORS_HEADERS, DEFAULT_SEARCH_K, CHAT_HISTORY_SEARCH_K,
-    validate_config
+    BLOCKING_EXECUTOR_WORKERS, WRITER_LOCK_PATH, WRITE_SPOOL_DIR,
+    INGESTION_STATUS_DIR, INDEX_SYNC_INTERVAL, CHAT_HISTORY_DIR, HISTORY_PAGE_SIZE,
+    CHAT_IDS_PAGE_SIZE, PDF_PARSER_WORKERS, FAISS_SHARDS, FAISS_COLLECTION_OPTIONS, FAISS_SEARCH_THREADS,
+    LOG_LEVEL, LOG_FORMAT, QUERY_EMBEDDING_MAX_BATCH,
+    BATCH_QUERY_MAX_ITEMS, BATCH_QUERY_LLM_CONCURRENCY, MMR_ENABLED, MMR_FETCH_K, MMR_K, validate_config
 )
 import uvicorn
 
 # Validar configuração
 validate_config()
 
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+logger = logging.getLogger("rag")
+
 app = FastAPI(
     title=API_TITLE,
     description=API_DESCRIPTION,
@@ -38,6 +57,33 @@ app = FastAPI(
     redoc_url=None
 )
 
+# Rotas atendidas antes de load_services terminar: sondas, métricas e documentação
+UNGATED_PATHS = {"/healthz", "/readyz", "/metrics", "/", "/openapi.json"}
+
+class ReadinessGate:
+    """Recusa as requisições com 503 enquanto os índices e clientes carregam (ou se o carregamento falhou)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] not in UNGATED_PATHS:
+            task = start_services()
+            if not task.done():
+                response = JSONResponse({"detail": "Serviço iniciando: índices em carregamento"},
+                                        status_code=503, headers={"Retry-After": "1"})
+                await response(scope, receive, send)
+                return
+            if task.cancelled() or task.exception() is not None:
+                response = JSONResponse({"detail": "Serviço indisponível: falha ao carregar os índices"},
+                                        status_code=503)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+# Registrado antes do CORS para ficar por dentro dele: as respostas 503 também levam os cabeçalhos
+app.add_middleware(ReadinessGate)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
@@ -49,103 +95,56 @@ app.add_middleware(
 if not get_google_api_key():
     raise HTTPException(status_code=500, detail="Google API key não encontrado. Configure a variável GOOGLE_API_KEY.")
 
-embeddings = GoogleGenerativeAIEmbeddings(model=GOOGLE_EMBEDDING_MODEL)
-
-# Carregar ou criar índices FAISS locais
-def get_or_create_faiss_index(collection_name: str):
-    """Carrega um índice FAISS existente ou cria um novo"""
-    index = load_faiss_index(collection_name)
-    if index is None:
-        # Criar novo índice vazio
-        index = FAISS.from_texts(["placeholder"], embeddings, metadatas=[{"placeholder": True}])
-        # Remover o placeholder
-        index.delete([index.index_to_docstore_id[0]])
-        save_faiss_index(index, collection_name)
-    return index
-
-# Inicializar índices FAISS
-db = get_or_create_faiss_index("my_docs")
-chat_history_db = get_or_create_faiss_index("chat_history")
-
-class QueryRequest(BaseModel):
-    query: str
-    chat_id: str
-
-@app.post("/upload",
-          summary="Carregar um documento para a base de dados do FAISS local",
-          description="Carregar um documento para a base de dados do FAISS local para ser pesquisado posteriormente.",
-          response_description="Mensagem indicando sucesso ou falha."
-          )
-async def upload_document(file: UploadFile = File(...)):
-    if not file.filename.endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Somente arquivos PDF são permitidos.")
-
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(await file.read())
-            tmp_file_path = tmp_file.name
-
-        loader = PyPDFLoader(tmp_file_path)
-        pages = loader.load_and_split()
-        os.remove(tmp_file_path)
-
-        if not pages:
-            raise HTTPException(status_code=400, detail="O documento está vazio. Tente novamente com outro arquivo.")
-
-        documents = [
-            Document(
-                page_content=clean_text_data(page.page_content),
-                metadata={
-                    "page_number": idx + 1,
-                    "file_name": file.filename
-                }
-            )
-            for idx, page in enumerate(pages)
-        ]
-
-        # Adicionar documentos ao índice FAISS
-        db.add_documents(documents)
-        
-        # Salvar índice atualizado
-        save_faiss_index(db, "my_docs")
+# Um único processo grava nos índices (e no cache de embeddings em disco). Com
+# `uvicorn --workers N`, os demais abrem tudo somente para leitura, repassam as escritas
+# pela fila em disco e trocam para cada nova versão confirmada pelo escritor sem reiniciar
+writer_lock = WriterLock(WRITER_LOCK_PATH)
+is_writer = writer_lock.try_acquire()
+write_spool = WriteSpool(WRITE_SPOOL_DIR)
+
+# Clientes do Gemini, chain de resposta e índices: criados por load_services em segundo plano
+# (só os imports de langchain_google_genai e langchain.chains levam segundos), para o
+# uvicorn aceitar conexões logo; /readyz indica quando estão prontos
+embeddings: Optional[CachedEmbeddings] = None
+answer_chain = None
+db: Optional[ShardedCollection] = None
+chat_history_db: Optional[FaissCollection] = None
+
+# Respostas já geradas, reaproveitadas para perguntas equivalentes sobre o mesmo contexto
+answer_cache = AnswerCache()
+
+# Métricas deste processo, expostas em /metrics (com vários workers, cada um tem as suas)
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "rag_stage_seconds", "Duração de cada etapa do pipeline em segundos", ("pipeline", "stage")
+)
+query_batch_size = metrics.histogram(
+    "rag_query_embedding_batch_size", "Perguntas por chamada de embedding em lote",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
 
-        return {"message": "Documento carregado com sucesso com metadados."}
+# Threads das buscas nos shards de my_docs, compartilhadas entre as versões reabertas da coleção
+shard_search_pool = ThreadPoolExecutor(max_workers=FAISS_SEARCH_THREADS, thread_name_prefix="shard-search")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ocorreu um erro: {str(e)}")
+def open_collections(read_only: bool):
+    """Carrega (ou cria vazios) os índices FAISS locais"""
+    return (
+        ShardedCollection.open("my_docs", embeddings, **FAISS_SHARDS["my_docs"],
+                               **FAISS_COLLECTION_OPTIONS["my_docs"], read_only=read_only, pool=shard_search_pool),
+        FaissCollection.open("chat_history", embeddings, **FAISS_COLLECTION_OPTIONS["chat_history"],
+                             read_only=read_only),
+    )
 
-@app.post("/query")
-async def query_document(request: QueryRequest):
-    start_time = time.time()
+# Histórico de chat (SQLite em modo WAL): só o escritor grava, todos os processos leem
+chat_store = ChatHistoryStore()
 
-    try:
-        # Realizar busca de similaridade
-        results = db.similarity_search_with_score(request.query, k=DEFAULT_SEARCH_K)
-
-        files = [result[0].metadata["file_name"] for result in results]
-        pages = [result[0].metadata["page_number"] for result in results]
-        vectors = [result[1] for result in results]
-
-        print(f"Documentos: {files} - Páginas: {pages}")
-        print(f"Vetores das respostas mais próximas: {vectors}")
-        if results:
-            print(f"Documentos próximos: {results[0][0].page_content}")
-
-        context = ""
-        for doc, score in results:
-            context += f"Arquivo: {doc.metadata['file_name']}\nPágina: {doc.metadata['page_number']}\nTexto: {doc.page_content}\n\n"
-
-        # Buscar histórico de chat usando FAISS
-        history = ""
-        if chat_history_db.index.ntotal > 0:  # Verificar se o índice não está vazio
-            conversation_history = chat_history_db.similarity_search_with_score(
-                request.query, k=CHAT_HISTORY_SEARCH_K
-            )
-            for history_doc, score in conversation_history:
-                if "user" in history_doc.metadata and "ai" in history_doc.metadata:
-                    history += f"Usuário: {history_doc.metadata['user']}\nIA: {history_doc.metadata['ai']}\n\n"
+# Formato de cada documento recuperado dentro do {context} do prompt
+DOCUMENT_PROMPT = PromptTemplate.from_template(
+    "Arquivo: {file_name}\nPágina: {page_number}\nTexto: {page_content}\n"
+)
 
-        template = """
+# Prompt usado para gerar as respostas
+QA_TEMPLATE = """
             Você é um assistente cordial e especializado em contratos.
 
             Sua tarefa é usar:
@@ -173,62 +172,698 @@ async def query_document(request: QueryRequest):
             Agora, responda à pergunta com base apenas no que foi fornecido.
         """
 
-        prompt = PromptTemplate.from_template(template)
-
-        combine_docs_chain = create_stuff_documents_chain(llm_google(), prompt)
-        retriever = db.as_retriever(
-            search_kwargs={"k": DEFAULT_SEARCH_K}
+# Duração (segundos) de cada etapa da inicialização, exposta em /readyz e /metrics
+startup_seconds: Dict[str, float] = {}
+services_lock = threading.Lock()
+
+def load_services():
+    """
+    Cria os clientes do Gemini e a chain de resposta e abre os índices (bloqueante).
+
+    Executada em segundo plano na inicialização; chamadas seguintes não fazem nada.
+    """
+    global embeddings, answer_chain, db, chat_history_db
+    with services_lock:
+        if db is not None:
+            return
+        started = time.perf_counter()
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+        from langchain.chains.combine_documents import create_stuff_documents_chain
+        from ia import llm_google
+
+        embeddings = CachedEmbeddings(
+            GoogleGenerativeAIEmbeddings(model=GOOGLE_EMBEDDING_MODEL),
+            model_name=GOOGLE_EMBEDDING_MODEL,
+            read_only=not is_writer,
+            query_underlying=GoogleGenerativeAIEmbeddings(model=GOOGLE_EMBEDDING_MODEL, task_type="retrieval_query")
         )
-        retrieval_chain = create_retrieval_chain(retriever, combine_docs_chain)
-
-        response = retrieval_chain.invoke({"input": request.query, "context": context, "history": history})
-        print(f"Resposta: {response['answer']}")
-
-        # Salvar histórico de chat localmente
-        save_chat_history(request.chat_id, request.query, response['answer'])
-        
-        # Também adicionar ao índice FAISS para busca semântica
-        chat_history_doc = Document(
-            page_content=f"Usuário: {request.query}\nIA: {response['answer']}",
-            metadata={"chat_id": request.chat_id, "user": request.query, "ai": response['answer'], "timestamp": datetime.now().isoformat()}
+        # Cliente do LLM, prompt e chain criados uma única vez: as requisições compartilham
+        # o mesmo cliente (e as conexões dele) em vez de montar tudo a cada pergunta.
+        # Os documentos já recuperados entram direto no prompt, sem uma segunda busca via retriever
+        answer_chain = create_stuff_documents_chain(
+            llm_google(), PromptTemplate.from_template(QA_TEMPLATE), document_prompt=DOCUMENT_PROMPT
         )
-        chat_history_db.add_documents([chat_history_doc])
-        save_faiss_index(chat_history_db, "chat_history")
+        startup_seconds["models"] = time.perf_counter() - started
+
+        # Índice flat servido de vectors.f32 via mmap (sem cópia dos vetores); o segmento é lido
+        # inteiro para montar docstore e metadados, então este tempo cresce com a coleção
+        started = time.perf_counter()
+        db, chat_history_db = open_collections(read_only=not is_writer)
+        if is_writer:
+            chat_store.migrate_json(CHAT_HISTORY_DIR)
+        startup_seconds["indexes"] = time.perf_counter() - started
+
+# Executor limitado para o trabalho bloqueante: o event loop fica livre para outras requisições
+executor = ThreadPoolExecutor(max_workers=BLOCKING_EXECUTOR_WORKERS, thread_name_prefix="rag")
+
+async def run_blocking(func, *args, **kwargs):
+    """Executa uma função bloqueante no executor sem travar o event loop"""
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+# Processos para a extração de texto dos PDFs (trabalho de CPU, fora do GIL do servidor)
+pdf_pool = ProcessPoolExecutor(max_workers=PDF_PARSER_WORKERS, initializer=watch_parent)
+
+def save_upload(content: bytes) -> str:
+    """Grava o PDF recebido em um arquivo temporário e retorna o caminho (bloqueante)"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+        tmp_file.write(content)
+        return tmp_file.name
+
+def file_hash(content: bytes) -> str:
+    """sha256 do arquivo enviado (bloqueante)"""
+    return hashlib.sha256(content).hexdigest()
+
+def is_indexed(file_name: str, digest: str) -> bool:
+    """Se esta versão exata do arquivo já está no índice"""
+    shard = db.shard_for(file_name)
+    return not set(shard.ids_where("file_hash", digest)).isdisjoint(shard.ids_where("file_name", file_name))
+
+def indexed_chunk_hashes(collection: FaissCollection, file_name: str) -> Set[str]:
+    """Hashes dos chunks já indexados de um arquivo"""
+    with collection.reading():
+        hashes = {
+            collection.docstore[vector_id].metadata.get("content_hash")
+            for vector_id in collection.ids_where("file_name", file_name)
+        }
+    hashes.discard(None)
+    return hashes
+
+# Dois uploads do mesmo arquivo não podem intercalar a leitura dos chunks atuais e a gravação.
+# Um lock por shard (pelo caminho, que não muda ao reabrir): arquivos de shards diferentes gravam em paralelo
+commit_locks: Dict[str, threading.Lock] = {}
+
+def commit_lock(collection: FaissCollection) -> threading.Lock:
+    return commit_locks.setdefault(collection.path, threading.Lock())
+
+def replace_file_documents(collection: FaissCollection, file_name: str, documents: List[Document],
+                           vectors: List[List[float]], reused: List[Document]) -> List[Document]:
+    """
+    Grava a nova versão de um arquivo em um único commit (bloqueante).
+
+    Chunks com o mesmo ``content_hash`` de um chunk já indexado mantêm o vetor e o
+    id (só os metadados são atualizados, se mudaram); chunks que não existem mais
+    são removidos e os novos, adicionados. Se chunks reaproveitados sumiram do índice
+    desde o início do job, nada é gravado e eles são retornados: o chamador calcula
+    os embeddings fora do lock e tenta de novo.
+    """
+    with commit_lock(collection):
+        current: Dict[str, int] = {}
+        stale: List[int] = []
+        with collection.reading():
+            for vector_id in collection.ids_where("file_name", file_name):
+                metadata = collection.docstore[vector_id].metadata
+                digest = metadata.get("content_hash")
+                if digest is None or digest in current:
+                    stale.append(vector_id)  # Chunks sem hash (formato antigo) ou duplicados
+                else:
+                    current[digest] = vector_id
+            stored = {vector_id: collection.docstore[vector_id].metadata for vector_id in current.values()}
+
+        new_documents, new_vectors, missing = [], [], []
+        updates: Dict[int, Dict] = {}
+        for document, vector in [*zip(documents, vectors), *((document, None) for document in reused)]:
+            vector_id = current.pop(document.metadata["content_hash"], None)
+            if vector_id is not None:
+                if stored[vector_id] != document.metadata:
+                    updates[vector_id] = document.metadata
+            elif vector is not None:
+                new_documents.append(document)
+                new_vectors.append(vector)
+            else:
+                missing.append(document)
+        if missing:
+            return missing
+
+        collection.add_embeddings(new_documents, new_vectors)
+        collection.update_metadata(updates)
+        collection.delete(stale + list(current.values()))
+        collection.commit()
+        return []
+
+def index_documents(collection: FaissCollection, documents: List[Document], vectors: List[List[float]]):
+    """Adiciona documentos com embeddings já calculados e persiste o delta (bloqueante)"""
+    collection.add_embeddings(documents, vectors)
+    collection.commit()
+
+def remove_documents(collection: FaissCollection, ids: List[int]):
+    """Remove vetores pelo id e persiste o registro de remoção (bloqueante)"""
+    collection.delete(ids)
+    collection.commit()
+
+def delete_file_documents(collection: FaissCollection, file_name: str):
+    """Remove os vetores de um arquivo em um único commit (bloqueante), sob o mesmo lock do upload"""
+    with commit_lock(collection):
+        ids = collection.ids_where("file_name", file_name)
+        if ids:
+            remove_documents(collection, ids)
+
+def persist_chat_turn(chat_id: str, query: str, answer: str, vector: List[float]):
+    """Grava o turno no histórico de chat e no índice FAISS de histórico (bloqueante)"""
+    with stage_seconds.time(pipeline="query", stage="history_persist"):
+        turn = chat_store.append(chat_id, query, answer)
+
+    chat_history_doc = Document(
+        page_content=f"Usuário: {query}\nIA: {answer}",
+        metadata={"chat_id": chat_id, "user": query, "ai": answer, "timestamp": turn["timestamp"]}
+    )
+    with stage_seconds.time(pipeline="query", stage="index_save"):
+        index_documents(chat_history_db, [chat_history_doc], [vector])
 
-        print(f"Tempo: {time.time() - start_time} segundos")
-        return {"answer": response['answer']}
+class QueryRequest(BaseModel):
+    query: str
+    chat_id: str
+
+class BatchQueryRequest(BaseModel):
+    items: List[QueryRequest] = Field(..., min_length=1, max_length=BATCH_QUERY_MAX_ITEMS)
+
+async def parse_upload(job: IngestionJob) -> AsyncIterator[Document]:
+    """Gera os chunks do PDF à medida que as faixas de páginas são extraídas e remove o arquivo temporário"""
+    try:
+        path = job.payload["path"]
+        job.pages_total = await run_blocking(count_pdf_pages, path)
+        pages = iter_pdf_pages(path, job.file_name, pdf_pool, job.pages_total)
+        try:
+            chunk_index = 0
+            while True:
+                # Só a espera por páginas conta: a extração à frente do embedding não aparece aqui
+                with stage_seconds.time(pipeline="upload", stage="parse"):
+                    page = await run_blocking(next, pages, None)
+                if page is None:
+                    break
+                job.pages_parsed += 1
+                page.metadata["file_hash"] = job.payload["file_hash"]
+                chunks = chunk_documents([page], first_chunk_index=chunk_index)
+                chunk_index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            await run_blocking(pages.close)
+    finally:
+        await run_blocking(os.remove, job.payload["path"])
+
+async def indexed_chunks(job: IngestionJob) -> Set[str]:
+    return await run_blocking(indexed_chunk_hashes, db.shard_for(job.file_name), job.file_name)
+
+async def embed_upload_batch(texts: List[str]) -> List[List[float]]:
+    with stage_seconds.time(pipeline="upload", stage="embedding"):
+        return await embeddings.aembed_documents(texts)
+
+async def commit_upload(documents: List[Document], vectors: List[List[float]], reused: List[Document]):
+    # Commit incremental no shard do arquivo: só o delta do documento é gravado
+    file_name = (documents or reused)[0].metadata["file_name"]
+    shard = db.shard_for(file_name)
+    while True:
+        with stage_seconds.time(pipeline="upload", stage="index_save"):
+            missing = await run_blocking(replace_file_documents, shard, file_name, documents, vectors, reused)
+        if not missing:
+            break
+        # Chunks reaproveitados removidos por outra versão gravada durante o job: embeddings
+        # pelo caminho em lote (sem segurar o lock do shard) e nova tentativa com eles como novos
+        missing_hashes = {document.metadata["content_hash"] for document in missing}
+        vectors = [*vectors, *await embed_upload_batch([document.page_content for document in missing])]
+        documents = [*documents, *missing]
+        reused = [document for document in reused if document.metadata["content_hash"] not in missing_hashes]
+    # Um arquivo reenviado muda o contexto: descartar as respostas que usaram a versão anterior
+    answer_cache.invalidate(file_name)
+
+ingestion_queue = IngestionQueue(
+    parse=parse_upload,
+    embed=embed_upload_batch,
+    commit=commit_upload,
+    indexed=indexed_chunks,
+    status_dir=INGESTION_STATUS_DIR,
+    executor=executor
+)
+
+def directory_bytes(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    )
+
+def collection_stats(read) -> Dict:
+    return {(collection.name,): read(collection) for collection in (db, chat_history_db)}
+
+metrics.callback("rag_index_vectors", "Vetores ativos por coleção",
+                 lambda: collection_stats(lambda collection: collection.ntotal), ("collection",))
+metrics.callback("rag_index_disk_bytes", "Tamanho em disco de cada coleção",
+                 lambda: collection_stats(lambda collection: directory_bytes(collection.path)), ("collection",))
+metrics.callback("rag_index_shard_vectors", "Vetores ativos por shard de my_docs",
+                 lambda: {(str(position),): shard.ntotal for position, shard in enumerate(db.shards)}, ("shard",))
+metrics.callback("rag_embedding_cache_lookups_total", "Consultas ao cache de embeddings por resultado",
+                 lambda: {(result,): value for result, value in embeddings.stats().items() if not result.endswith("_entries")},
+                 ("result",), metric_type="counter")
+metrics.callback("rag_embedding_cache_entries", "Vetores no cache de embeddings",
+                 lambda: {(tier,): embeddings.stats()[f"{tier}_entries"] for tier in ("memory", "disk")}, ("tier",))
+metrics.callback("rag_answer_cache_events_total", "Eventos do cache de respostas",
+                 lambda: {(event,): value for event, value in answer_cache.stats().items() if event not in ("hit_rate", "entries")},
+                 ("event",), metric_type="counter")
+metrics.callback("rag_answer_cache_entries", "Respostas no cache", lambda: answer_cache.stats()["entries"])
+metrics.callback("rag_ingestion_jobs", "Jobs de ingestão deste processo por status",
+                 lambda: {(status,): count for status, count in Counter(job.status for job in list(ingestion_queue.jobs.values())).items()},
+                 ("status",))
+metrics.callback("rag_startup_seconds", "Duração de cada etapa da inicialização deste processo",
+                 lambda: {(step,): seconds for step, seconds in startup_seconds.items()}, ("step",))
+metrics.callback("rag_index_writer", "1 se este processo é o escritor dos índices", lambda: int(is_writer))
+
+async def delete_document_vectors(file_name: str):
+    # Remover exatamente os vetores do arquivo pelo id, sem recriar nem re-embeddar o índice;
+    # só o shard dono do arquivo é tocado
+    await run_blocking(delete_file_documents, db.shard_for(file_name), file_name)
+    answer_cache.invalidate(file_name)
+
+async def clear_chat(chat_id: str):
+    # Limpar histórico local
+    await run_blocking(chat_store.clear, chat_id)
+
+    # Remover os vetores do chat do índice FAISS de histórico em uma única remoção;
+    # a compactação é disparada automaticamente quando os tombstones passam do limite
+    chat_vector_ids = chat_history_db.ids_where("chat_id", chat_id)
+    if chat_vector_ids:
+        await run_blocking(remove_documents, chat_history_db, chat_vector_ids)
+
+async def add_chat_turn(chat_id: str, query: str, answer: str, vector: List[float]):
+    await run_blocking(persist_chat_turn, chat_id, query, answer, vector)
+
+async def enqueue_upload(job_id: str, file_name: str, path: str, file_hash: str):
+    await ingestion_queue.submit(file_name, {"path": path, "file_hash": file_hash}, job_id)
+
+# Escritas que os processos leitores repassam ao escritor
+WRITE_HANDLERS = {
+    "upload": enqueue_upload,
+    "delete_document": delete_document_vectors,
+    "clear_chat": clear_chat,
+    "chat_turn": add_chat_turn,
+}
+
+async def apply_write(op: str, **payload):
+    """Aplica a escrita neste processo (escritor) ou a envia ao escritor pela fila em disco"""
+    if is_writer:
+        await WRITE_HANDLERS[op](**payload)
+    else:
+        await run_blocking(write_spool.submit, op, **payload)
+
+async def drain_write_spool():
+    """Escritor: aplica, em ordem, as escritas enviadas pelos processos leitores"""
+    for name in await run_blocking(write_spool.pending):
+        command = await run_blocking(write_spool.read, name)
+        if command is not None:
+            try:
+                await WRITE_HANDLERS[command.pop("op")](**command)
+            except Exception as e:
+                # Um comando inválido não pode travar a fila: registrar e descartar
+                logger.exception("Erro ao aplicar escrita %s: %s", name, e)
+        await run_blocking(write_spool.done, name)
+
+def reopen_latest(collection: FaissCollection) -> FaissCollection:
+    """Abre a última versão da coleção (bloqueante)"""
+    for attempt in range(3):
+        try:
+            return collection.reopen()
+        except FileNotFoundError:
+            # Uma compactação trocou os arquivos durante a leitura: tentar de novo
+            time.sleep(0.1)
+    return collection.reopen()
+
+async def refresh_collections():
+    """Leitor: troca para a versão mais recente confirmada pelo escritor"""
+    global db, chat_history_db
+    # A versão antiga continua válida para as buscas em andamento até a troca da referência
+    if db.manifest_version() != db.version:
+        db = await run_blocking(reopen_latest, db)
+    if chat_history_db.manifest_version() != chat_history_db.version:
+        chat_history_db = await run_blocking(reopen_latest, chat_history_db)
+
+async def index_sync_loop():
+    """Mantém o papel deste processo: escritor aplica a fila em disco, leitor acompanha as versões"""
+    global is_writer, db, chat_history_db
+    while True:
+        try:
+            if not is_writer and writer_lock.try_acquire():
+                # O escritor anterior terminou: este processo assume as escritas
+                db, chat_history_db = await run_blocking(open_collections, False)
+                await run_blocking(embeddings.enable_writes)
+                await run_blocking(chat_store.migrate_json, CHAT_HISTORY_DIR)
+                is_writer = True
+                logger.info("Processo %s assumiu as escritas dos índices", os.getpid())
+            if is_writer:
+                await drain_write_spool()
+            else:
+                await refresh_collections()
+        except Exception as e:
+            logger.exception("Erro na sincronização dos índices: %s", e)
+        await asyncio.sleep(INDEX_SYNC_INTERVAL)
+
+async def load_services_in_background():
+    """Carrega clientes e índices fora do event loop e só então inicia a sincronização dos índices"""
+    try:
+        await run_blocking(load_services)
+    except Exception as e:
+        logger.exception("Falha ao carregar os índices: %s", e)
+        raise
+    startup_seconds["ready"] = time.perf_counter() - IMPORT_STARTED
+    logger.info("Pronto em %.2fs (%s)", startup_seconds["ready"],
+                ", ".join(f"{step}={seconds:.2f}s" for step, seconds in startup_seconds.items()))
+    app.state.index_sync = asyncio.create_task(index_sync_loop())
+
+def start_services() -> asyncio.Task:
+    """Task única de carregamento, criada na inicialização (ou na primeira requisição)"""
+    if getattr(app.state, "services", None) is None:
+        app.state.services = asyncio.create_task(load_services_in_background())
+    return app.state.services
+
+@app.on_event("startup")
+async def start_background_loading():
+    start_services()
+
+@app.on_event("shutdown")
+async def stop_pdf_pool():
+    pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+@app.post("/upload",
+          status_code=202,
+          summary="Carregar um documento para a base de dados do FAISS local",
+          description="Enfileira um documento para ser processado em segundo plano e indexado no FAISS local. "
+                      "Acompanhe o progresso em `GET /upload/{job_id}`. Reenviar o mesmo arquivo sem mudanças "
+                      "não faz nada (status `skipped`); uma nova versão substitui a anterior e só os chunks "
+                      "alterados passam pelo embedding.",
+          response_description="Identificador do job de ingestão."
+          )
+async def upload_document(file: UploadFile = File(...)):
+    if not file.filename.endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Somente arquivos PDF são permitidos.")
+
+    try:
+        content = await file.read()
+        digest = await run_blocking(file_hash, content)
+        if await run_blocking(is_indexed, file.filename, digest):
+            # Mesmo arquivo, mesmo conteúdo: nada a extrair nem a calcular
+            job = await ingestion_queue.skip(file.filename)
+            return {
+                "message": "Documento já indexado com o mesmo conteúdo.",
+                "job_id": job.id,
+                "status": job.status
+            }
+
+        tmp_file_path = await run_blocking(save_upload, content)
+        payload = {"path": tmp_file_path, "file_hash": digest}
+        if is_writer:
+            job = await ingestion_queue.submit(file.filename, payload)
+        else:
+            job = IngestionJob(file.filename, payload)
+            await ingestion_queue.record(job)
+            await apply_write("upload", job_id=job.id, file_name=file.filename, **payload)
+
+        return {
+            "message": "Documento enfileirado para processamento.",
+            "job_id": job.id,
+            "status": job.status
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ocorreu um erro: {str(e)}")
+
+@app.get("/upload/{job_id}",
+         summary="Status de um job de ingestão",
+         description="Retorna o estado (queued, parsing, embedding, committing, done, failed) e o progresso do upload.")
+async def upload_status(job_id: str):
+    job = await run_blocking(ingestion_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} não encontrado.")
+    return job
+
+async def embed_query_batch(queries: List[str]) -> List[List[float]]:
+    query_batch_size.observe(len(queries))
+    return await embeddings.aembed_queries(queries)
+
+query_embedding_batcher = MicroBatcher(embed_query_batch)
+
+def search_documents(query: str, query_vector: List[float]):
+    """Busca híbrida (vetorial + BM25) e retorna também os ids dos vetores (bloqueante)"""
+    return search_documents_batch([query], [query_vector])[0]
+
+def search_documents_batch(queries: List[str], query_vectors: List[List[float]]):
+    """Busca híbrida de várias perguntas com uma única busca matricial no FAISS (bloqueante)"""
+    # Identificadores exatos (cláusulas, CNPJs, nomes) vêm do BM25: um k menor já cobre a pergunta.
+    # Os shards são consultados em paralelo e os top-k combinados
+    if MMR_ENABLED:
+        # Mais candidatos do que vão para o prompt: o MMR descarta os quase repetidos
+        # (páginas do mesmo modelo de contrato) e deixa um contexto menor e variado
+        hits_batch = db.hybrid_search_batch(query_vectors, queries, k=MMR_FETCH_K)
+        hits_batch = db.mmr_batch(query_vectors, hits_batch, k=MMR_K)
+    else:
+        hits_batch = db.hybrid_search_batch(query_vectors, queries, k=DEFAULT_SEARCH_K)
+    return [
+        ([vector_id for vector_id, document, distance in hits],
+         [(document, distance) for vector_id, document, distance in hits])
+        for hits in hits_batch
+    ]
+
+async def retrieve_documents(query: str):
+    """Etapa de recuperação: um único embedding da pergunta e a busca nos documentos"""
+    # Gerar o embedding da pergunta uma única vez e reutilizá-lo em todas as buscas;
+    # perguntas que chegam juntas compartilham a mesma chamada de embedding
+    with stage_seconds.time(pipeline="query", stage="query_embedding"):
+        query_vector = await query_embedding_batcher.submit(query)
+
+    # Realizar busca de similaridade
+    with stage_seconds.time(pipeline="query", stage="doc_search"):
+        chunk_ids, results = await run_blocking(search_documents, query, query_vector)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "documentos recuperados files=%s pages=%s distances=%s",
+            [doc.metadata["file_name"] for doc, distance in results],
+            [doc.metadata["page_number"] for doc, distance in results],
+            [round(float(distance), 4) for doc, distance in results],
+        )
+
+    return query_vector, chunk_ids, results
+
+async def retrieve_history(query_vector: List[float], chat_id: str, pipeline: str = "query") -> str:
+    """Busca os turnos mais próximos da pergunta no histórico deste chat"""
+    # Buscar histórico apenas deste chat: a busca percorre a lista de vetores do chat_id,
+    # então o custo acompanha o tamanho da conversa e turnos de outros usuários nunca entram
+    history = ""
+    if chat_history_db.ids_where("chat_id", chat_id):
+        with stage_seconds.time(pipeline=pipeline, stage="history_search"):
+            conversation_history = await run_blocking(
+                chat_history_db.similarity_search_with_score_by_vector,
+                query_vector, k=CHAT_HISTORY_SEARCH_K, filter={"chat_id": chat_id}
+            )
+        for history_doc, score in conversation_history:
+            if "user" in history_doc.metadata and "ai" in history_doc.metadata:
+                history += f"Usuário: {history_doc.metadata['user']}\nIA: {history_doc.metadata['ai']}\n\n"
+
+    return history
+
+def cache_answer(chat_id: str, query_vector: List[float], chunk_ids: List[int], results, answer: str):
+    """Guarda a resposta no cache semântico do chat, associada aos arquivos do contexto"""
+    file_names = {doc.metadata["file_name"] for doc, score in results}
+    answer_cache.put(chat_id, query_vector, chunk_ids, file_names, answer)
+
+async def save_chat_turn(chat_id: str, query: str, answer: str, pipeline: str = "query"):
+    """Salva o turno no histórico JSON e no índice FAISS para busca semântica"""
+    with stage_seconds.time(pipeline=pipeline, stage="turn_embedding"):
+        turn_vector = await embeddings.aembed_documents([f"Usuário: {query}\nIA: {answer}"])
+    await apply_write("chat_turn", chat_id=chat_id, query=query, answer=answer, vector=list(turn_vector[0]))
+
+def sse_event(event: str, data) -> str:
+    """Formata um evento server-sent events com payload JSON"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def generate_answer(query: str, chat_id: str, query_vector: List[float], chunk_ids: List[int],
+                          results, pipeline: str = "query"):
+    """Gera (ou reaproveita do cache) a resposta para os documentos recuperados e salva o turno"""
+    # Pergunta equivalente já respondida neste chat com o mesmo contexto: pular o LLM
+    answer = answer_cache.get(chat_id, query_vector, chunk_ids)
+    cached = answer is not None
+    if not cached:
+        history = await retrieve_history(query_vector, chat_id, pipeline)
+        with stage_seconds.time(pipeline=pipeline, stage="prompt_build"):
+            context = assemble_context(results)
+        with stage_seconds.time(pipeline=pipeline, stage="llm"):
+            answer = await answer_chain.ainvoke({"input": query, "context": context, "history": history})
+        cache_answer(chat_id, query_vector, chunk_ids, results, answer)
+    logger.debug("resposta chat_id=%s cached=%s answer=%r", chat_id, cached, answer)
+
+    await save_chat_turn(chat_id, query, answer, pipeline)
+    return answer, cached
+
+@app.post("/query")
+async def query_document(request: QueryRequest):
+    start_time = time.perf_counter()
+
+    try:
+        query_vector, chunk_ids, results = await retrieve_documents(request.query)
+        answer, cached = await generate_answer(request.query, request.chat_id, query_vector, chunk_ids, results)
+
+        elapsed = time.perf_counter() - start_time
+        stage_seconds.observe(elapsed, pipeline="query", stage="total")
+        logger.debug("query chat_id=%s cached=%s docs=%d seconds=%.3f",
+                     request.chat_id, cached, len(results), elapsed)
+        return {"answer": answer}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
-@app.get("/history/{chat_id}")
-async def get_chat_history_endpoint(chat_id: str):
+async def embed_queries(queries: List[str]) -> List[List[float]]:
+    """Embeddings de muitas perguntas em lotes de até QUERY_EMBEDDING_MAX_BATCH, enviados juntos"""
+    batches = await asyncio.gather(*(
+        embed_query_batch(queries[start:start + QUERY_EMBEDDING_MAX_BATCH])
+        for start in range(0, len(queries), QUERY_EMBEDDING_MAX_BATCH)
+    ))
+    return [vector for batch in batches for vector in batch]
+
+async def answer_queries(items: List[QueryRequest],
+                         concurrency: int = BATCH_QUERY_LLM_CONCURRENCY) -> AsyncIterator[Dict]:
+    """
+    Responde várias perguntas de uma vez e gera um resultado por item, na ordem em que ficam prontos.
+
+    Os embeddings saem em lote e a recuperação é uma única busca matricial no FAISS;
+    a geração das respostas roda com no máximo ``concurrency`` itens ao mesmo tempo.
+    Um item que falha gera um resultado com ``error`` sem interromper os demais.
+    """
+    start_time = time.perf_counter()
+    queries = [item.query for item in items]
+    with stage_seconds.time(pipeline="batch", stage="query_embedding"):
+        query_vectors = await embed_queries(queries)
+    with stage_seconds.time(pipeline="batch", stage="doc_search"):
+        retrieved = await run_blocking(search_documents_batch, queries, query_vectors)
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def answer_item(index: int) -> Dict:
+        item = items[index]
+        chunk_ids, results = retrieved[index]
+        result = {
+            "index": index,
+            "chat_id": item.chat_id,
+            "sources": [
+                {"file_name": doc.metadata["file_name"], "page_number": doc.metadata["page_number"]}
+                for doc, score in results
+            ],
+        }
+        try:
+            async with slots:
+                result["answer"], result["cached"] = await generate_answer(
+                    item.query, item.chat_id, query_vectors[index], chunk_ids, results, pipeline="batch"
+                )
+        except Exception as e:
+            result["error"] = f"Erro: {str(e)}"
+        return result
+
+    tasks = [asyncio.create_task(answer_item(index)) for index in range(len(items))]
     try:
-        history = get_chat_history(chat_id)
-        history_sorted = sorted(history, key=lambda x: x["timestamp"])
-        return {"history": history_sorted}
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        # Consumidor parou antes do fim (cliente desconectado): não gerar o restante
+        for task in tasks:
+            task.cancel()
+
+    elapsed = time.perf_counter() - start_time
+    stage_seconds.observe(elapsed, pipeline="batch", stage="total")
+    logger.debug("query_batch items=%d seconds=%.3f", len(items), elapsed)
+
+@app.post("/query/stream",
+          summary="Consulta com resposta em streaming (server-sent events)",
+          description="Envia um evento `sources` com os arquivos/páginas recuperados, eventos `token` "
+                      "com os trechos da resposta à medida que são gerados e um evento `done` ao final.")
+async def query_document_stream(request: QueryRequest):
+    start_time = time.perf_counter()
+
+    async def event_stream():
+        try:
+            query_vector, chunk_ids, results = await retrieve_documents(request.query)
+            yield sse_event("sources", [
+                {"file_name": doc.metadata["file_name"], "page_number": doc.metadata["page_number"]}
+                for doc, score in results
+            ])
+
+            answer = answer_cache.get(request.chat_id, query_vector, chunk_ids)
+            if answer is not None:
+                # Resposta do cache: enviada em um único evento token
+                yield sse_event("token", {"text": answer})
+            else:
+                history = await retrieve_history(query_vector, request.chat_id)
+                with stage_seconds.time(pipeline="query", stage="prompt_build"):
+                    context = assemble_context(results)
+                chunks = []
+                llm_start = time.perf_counter()
+                async for chunk in answer_chain.astream({"input": request.query, "context": context, "history": history}):
+                    if not chunks:
+                        stage_seconds.observe(time.perf_counter() - llm_start,
+                                              pipeline="query", stage="llm_first_token")
+                    chunks.append(chunk)
+                    yield sse_event("token", {"text": chunk})
+                stage_seconds.observe(time.perf_counter() - llm_start, pipeline="query", stage="llm")
+                answer = "".join(chunks)
+                cache_answer(request.chat_id, query_vector, chunk_ids, results, answer)
+
+            # Histórico só é gravado quando a resposta completa já foi gerada
+            await save_chat_turn(request.chat_id, request.query, answer)
+
+            elapsed = time.perf_counter() - start_time
+            stage_seconds.observe(elapsed, pipeline="query", stage="total")
+            logger.debug("query_stream chat_id=%s docs=%d seconds=%.3f", request.chat_id, len(results), elapsed)
+            yield sse_event("done", {"answer": answer})
+
+        except Exception as e:
+            yield sse_event("error", {"detail": f"Erro: {str(e)}"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.post("/query/batch",
+          summary="Várias perguntas em uma requisição (server-sent events)",
+          description="Recebe até `BATCH_QUERY_MAX_ITEMS` pares (query, chat_id) e envia um evento `result` "
+                      "por item assim que a resposta fica pronta (`index` indica a posição do item; `error` "
+                      "aparece no lugar de `answer` se o item falhar) e um evento `done` ao final.")
+async def query_batch(request: BatchQueryRequest):
+    async def event_stream():
+        count = 0
+        try:
+            results = answer_queries(request.items)
+            try:
+                async for result in results:
+                    count += 1
+                    yield sse_event("result", result)
+            finally:
+                await results.aclose()
+            yield sse_event("done", {"count": count})
+
+        except Exception as e:
+            yield sse_event("error", {"detail": f"Erro: {str(e)}"})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/history/{chat_id}",
+         summary="Histórico de um chat, paginado",
+         description="Retorna até `limit` turnos em ordem cronológica. Para a próxima página, "
+                     "envie o `next_cursor` recebido como `cursor` (nulo na última página).")
+async def get_chat_history_endpoint(chat_id: str, limit: int = Query(HISTORY_PAGE_SIZE, ge=1),
+                                    cursor: Optional[str] = None):
+    try:
+        history, next_cursor = await run_blocking(chat_store.history, chat_id, limit, cursor)
+        return {"history": history, "next_cursor": next_cursor}
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Cursor inválido: {cursor}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
-@app.get("/all_chat_ids")
-def list_all_chats():
+@app.get("/all_chat_ids",
+         summary="Lista os ids de chat, paginado",
+         description="Retorna até `limit` ids em ordem alfabética; use `next_cursor` como `cursor` na próxima página.")
+async def list_all_chats(limit: int = Query(CHAT_IDS_PAGE_SIZE, ge=1), cursor: Optional[str] = None):
     try:
-        chat_ids = get_all_chat_ids()
-        return {"chat_ids": chat_ids}
+        chat_ids, next_cursor = await run_blocking(chat_store.chat_ids, limit, cursor)
+        return {"chat_ids": chat_ids, "next_cursor": next_cursor}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
 @app.delete("/history/{chat_id}")
 async def clear_chat_history_endpoint(chat_id: str):
     try:
-        # Limpar histórico local
-        clear_chat_history(chat_id)
-        
-        # Recriar índice FAISS sem o histórico deste chat
-        # Esta é uma implementação simplificada - em produção você pode querer uma abordagem mais sofisticada
-        new_chat_history_db = get_or_create_faiss_index("chat_history")
-        save_faiss_index(new_chat_history_db, "chat_history")
-        
+        await apply_write("clear_chat", chat_id=chat_id)
         return {"message": f"Histórico do chat {chat_id} limpo."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
@@ -236,9 +871,8 @@ async def clear_chat_history_endpoint(chat_id: str):
 @app.get("/documents")
 async def list_all_document_names():
     try:
-        # Buscar todos os documentos no índice FAISS
-        results = db.similarity_search_with_score("contrato", k=1000)
-        file_names = sorted({doc.metadata["file_name"] for doc, score in results})
+        # Índice de metadados: O(arquivos), sem embedding nem busca vetorial
+        file_names = sorted(db.values("file_name"))
         return {"file_names": file_names}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
@@ -246,28 +880,44 @@ async def list_all_document_names():
 @app.delete("/documents/{file_name}")
 async def delete_document(file_name: str):
     try:
-        # Buscar documentos com o nome do arquivo
-        results = db.similarity_search_with_score(file_name, k=1000)
-        documents_to_delete = [doc for doc, score in results if doc.metadata["file_name"] == file_name]
-        
-        if documents_to_delete:
-            # Recriar índice sem os documentos deletados
-            remaining_docs = [doc for doc, score in results if doc.metadata["file_name"] != file_name]
-            
-            if remaining_docs:
-                new_db = FAISS.from_documents(remaining_docs, embeddings)
-            else:
-                new_db = get_or_create_faiss_index("my_docs")
-            
-            save_faiss_index(new_db, "my_docs")
-            # Atualizar a referência global
-            globals()['db'] = new_db
-            
+        await apply_write("delete_document", file_name=file_name)
         return {"message": f"Arquivo {file_name} deletado."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro: {str(e)}")
 
-
+@app.get("/cache/embeddings")
+def embedding_cache_stats():
+    return {"embedding_cache": embeddings.stats()}
+
+@app.get("/cache/answers")
+def answer_cache_stats():
+    return {"answer_cache": answer_cache.stats()}
+
+@app.get("/healthz", summary="Liveness: o processo está respondendo")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz",
+         summary="Readiness: índices e clientes carregados",
+         description="503 enquanto os índices carregam (ou se o carregamento falhou); "
+                     "inclui a duração de cada etapa da inicialização.")
+async def readyz():
+    task = getattr(app.state, "services", None)
+    if task is None or not task.done():
+        return JSONResponse({"status": "loading", "startup_seconds": startup_seconds}, status_code=503)
+    if task.cancelled() or task.exception() is not None:
+        return JSONResponse({"status": "failed", "startup_seconds": startup_seconds}, status_code=503)
+    return {"status": "ready", "is_writer": is_writer, "startup_seconds": startup_seconds}
+
+@app.get("/metrics",
+         response_class=PlainTextResponse,
+         summary="Métricas no formato do Prometheus",
+         description="Histogramas de duração por etapa de `/query` e `/upload` (`rag_stage_seconds`), "
+                     "vetores e tamanho em disco dos índices e contadores dos caches deste processo.")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+startup_seconds["import"] = time.perf_counter() - IMPORT_STARTED
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="127.0.0.1", port=5000, reload=True)
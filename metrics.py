@@ -0,0 +1,129 @@
+"""
+Métricas do pipeline no formato de texto do Prometheus (endpoint /metrics)
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+# Segundos: de uma busca no índice (ms) até uma resposta longa do LLM
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[str, ...]
+CallbackValue = Union[float, Dict[Labels, float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """Histograma com buckets fixos por combinação de labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[name] for name in self.labelnames)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[position] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Mede o bloco (inclusive com ``await`` dentro) e registra a duração em segundos"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total[0]) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                labels = _format_labels((*self.labelnames, "le"), (*key, _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge ou contador lido de outra estrutura (cache, índice) no momento da coleta"""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], CallbackValue],
+                 labelnames: Sequence[str] = (), metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.metric_type = metric_type
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        try:
+            value = self.callback()
+        except Exception:
+            # Fonte indisponível no momento (ex.: coleção sendo reaberta): a métrica sai sem amostras
+            return lines
+        values = value if isinstance(value, dict) else {(): value}
+        for key, sample in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(sample)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Conjunto de métricas exposto em /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Histogram, CallbackMetric]] = {}
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable[[], CallbackValue],
+                 labelnames: Sequence[str] = (), metric_type: str = "gauge") -> CallbackMetric:
+        return self._register(CallbackMetric(name, documentation, callback, labelnames, metric_type))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica {metric.name} já registrada")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Texto no formato de exposição do Prometheus (version=0.0.4)"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,76 @@
+"""
+Extração de páginas de PDF em paralelo (faixas de páginas em um pool de processos)
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Iterator, List
+
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+from config import PDF_PAGES_PER_TASK, PDF_PREFETCH_TASKS
+from utils import clean_text_data
+
+
+def watch_parent(interval: float = 1.0):
+    """
+    Inicializador dos processos do pool: encerra o processo quando o servidor morre.
+
+    Sem isso, um servidor finalizado à força (sem passar pelo shutdown do pool)
+    deixa os processos de extração órfãos, esperando tarefas para sempre.
+    """
+    parent = os.getppid()
+
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(interval)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def count_pdf_pages(path: str) -> int:
+    """Número de páginas do PDF (lê só a estrutura do arquivo)"""
+    return len(PdfReader(path).pages)
+
+
+def extract_page_range(path: str, start: int, stop: int) -> List[str]:
+    """Texto limpo das páginas [start, stop) — executado em um processo do pool"""
+    reader = PdfReader(path)
+    return [clean_text_data(reader.pages[number].extract_text()) for number in range(start, stop)]
+
+
+def iter_pdf_pages(path: str, file_name: str, pool: Executor, total_pages: int,
+                   pages_per_task: int = PDF_PAGES_PER_TASK, prefetch: int = PDF_PREFETCH_TASKS) -> Iterator[Document]:
+    """
+    Gera as páginas do PDF em ordem, extraídas em paralelo por faixas.
+
+    No máximo ``prefetch`` faixas ficam em andamento ou aguardando consumo, então
+    a memória acompanha o consumidor (lotes de embedding), não o tamanho do
+    documento, e as próximas faixas continuam sendo extraídas enquanto o
+    consumidor processa as anteriores.
+    """
+    ranges = deque(
+        (start, min(start + pages_per_task, total_pages))
+        for start in range(0, total_pages, pages_per_task)
+    )
+    pending = deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < prefetch:
+                start, stop = ranges.popleft()
+                pending.append((start, pool.submit(extract_page_range, path, start, stop)))
+            start, future = pending.popleft()
+            for offset, text in enumerate(future.result()):
+                yield Document(
+                    page_content=text,
+                    metadata={"page_number": start + offset + 1, "file_name": file_name}
+                )
+    finally:
+        # Gerador fechado antes do fim (erro no embedding): não extrair o resto
+        for start, future in pending:
+            future.cancel()
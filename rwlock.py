@@ -0,0 +1,62 @@
+"""
+Lock de leitores/escritor para as estruturas em memória das coleções
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    Vários leitores simultâneos ou um único escritor.
+
+    Escritores têm preferência: um escritor esperando impede novos leitores, para
+    uma sequência de buscas não adiar as escritas indefinidamente. A leitura é
+    reentrante na mesma thread, e a thread que tem a escrita também pode ler.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def reading(self):
+        depth = getattr(self._local, "depth", 0)
+        me = threading.get_ident()
+        if depth == 0 and self._writer != me:
+            with self._condition:
+                while self._writer is not None or self._writers_waiting:
+                    self._condition.wait()
+                self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0 and self._writer != me:
+                with self._condition:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
@@ -0,0 +1,277 @@
+"""
+Coleções FAISS divididas em shards, com busca paralela (scatter-gather)
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import zlib
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from config import FAISS_CHECKPOINT_INTERVAL, FAISS_INDEX_DIR, HYBRID_CANDIDATES_K, MMR_LAMBDA
+from faiss_store import FaissCollection, fuse_candidates, mmr_select_batch
+from utils import atomic_write_json
+
+logger = logging.getLogger("rag.shards")
+
+MIGRATION_BATCH_SIZE = 10000
+
+
+def shard_position(value, shards: int) -> int:
+    """Shard dono de um valor da chave de roteamento (estável entre processos, ao contrário de hash())"""
+    return zlib.crc32(str(value).encode("utf-8")) % shards
+
+
+class ShardedCollection:
+    """
+    Coleção dividida em ``FaissCollection`` independentes (shards).
+
+    Layout em disco (``<FAISS_INDEX_DIR>/<nome>.shards/``): ``shards.json`` com o
+    número de shards e a chave de roteamento, e ``<n>/<nome>/`` para cada shard.
+
+    Cada documento vai para o shard do crc32 do metadado ``key`` (ex.: file_name):
+    todos os chunks e versões de um arquivo ficam juntos, então uploads, remoções,
+    checkpoints e compactação tocam só o shard dono e o custo de cada escrita
+    acompanha o tamanho do shard, não o da coleção. As buscas consultam todos os
+    shards em paralelo no ``pool`` (o FAISS libera o GIL) e combinam os top-k de
+    cada um com um heap.
+
+    Os ids expostos são globais (``id_local * shards + shard``); as operações de um
+    único arquivo usam o shard de ``shard_for`` diretamente, com os ids locais dele.
+    """
+
+    def __init__(self, name: str, shards: List[FaissCollection], key: str, path: str,
+                 pool: Optional[Executor] = None):
+        self.name = name
+        self.shards = shards
+        self.key = key
+        self.path = path
+        self.pool = pool
+
+    @classmethod
+    def open(cls, name: str, embeddings: Embeddings, shards: int, key: str, directory: str = FAISS_INDEX_DIR,
+             indexed_fields: Sequence[str] = (), keyword_index: bool = False, read_only: bool = False,
+             pool: Optional[Executor] = None) -> "ShardedCollection":
+        """Abre os shards (criando-os e migrando a coleção não dividida, se preciso)"""
+        path = os.path.join(directory, f"{name}.shards")
+        layout_path = os.path.join(path, "shards.json")
+        migrate = False
+        if os.path.exists(layout_path):
+            with open(layout_path, "r", encoding="utf-8") as f:
+                layout = json.load(f)
+            if (layout["shards"], layout["key"]) != (shards, key):
+                # Mudar a divisão exigiria redistribuir todos os vetores: vale a gravada na criação
+                logger.warning("Coleção %s mantém %s shards por %s (configurado: %s por %s)",
+                               name, layout["shards"], layout["key"], shards, key)
+            shards, key = layout["shards"], layout["key"]
+        elif not read_only:
+            # Sem shards.json a divisão nunca foi concluída: recomeçar do zero
+            shutil.rmtree(path, ignore_errors=True)
+            migrate = True
+
+        collection = cls(name, [
+            FaissCollection.open(name, embeddings, os.path.join(path, str(position)), indexed_fields,
+                                 keyword_index, read_only, migrate=False)
+            for position in range(shards)
+        ], key, path, pool)
+        for shard in collection.shards:
+            # O resto do segmento (reaplicado ao abrir e buscado no BM25 sem snapshot) fica, somado
+            # entre os shards, do mesmo tamanho que o de uma coleção única; cada checkpoint é menor
+            shard.checkpoint_interval = max(1, FAISS_CHECKPOINT_INTERVAL // shards)
+        if migrate:
+            collection._migrate_unsharded(embeddings, directory)
+            atomic_write_json(layout_path, {"shards": shards, "key": key})
+        return collection
+
+    def _migrate_unsharded(self, embeddings: Embeddings, directory: str):
+        """Redistribui entre os shards a coleção não dividida (que por sua vez importa o .pkl antigo)"""
+        legacy = FaissCollection.open(self.name, embeddings, directory)
+        ids = sorted(legacy.docstore)
+        for start in range(0, len(ids), MIGRATION_BATCH_SIZE):
+            batch = ids[start:start + MIGRATION_BATCH_SIZE]
+            self.add_embeddings([legacy.docstore[vector_id] for vector_id in batch], legacy.get_vectors(batch))
+            self.commit()
+        if ids:
+            # Renomear em vez de apagar: a versão não dividida continua disponível, mas não é reimportada
+            os.replace(legacy.path, f"{legacy.path}.migrated")
+            logger.info("Coleção %s dividida em %s shards (%s vetores)", self.name, len(self.shards), len(ids))
+        else:
+            shutil.rmtree(legacy.path, ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    # Roteamento
+    # ------------------------------------------------------------------
+
+    def shard_for(self, value) -> FaissCollection:
+        """Shard que guarda os documentos com este valor da chave (ex.: um file_name)"""
+        return self.shards[shard_position(value, len(self.shards))]
+
+    def _global(self, position: int, vector_id: int) -> int:
+        return vector_id * len(self.shards) + position
+
+    def _split(self, ids: List[int]) -> Dict[int, List[int]]:
+        """Ids globais agrupados por shard, já convertidos em ids locais"""
+        grouped: Dict[int, List[int]] = {}
+        for vector_id in ids:
+            local, position = divmod(vector_id, len(self.shards))
+            grouped.setdefault(position, []).append(local)
+        return grouped
+
+    # ------------------------------------------------------------------
+    # Escrita
+    # ------------------------------------------------------------------
+
+    def add_embeddings(self, documents: List[Document], vectors) -> List[int]:
+        """Adiciona cada documento ao shard dono; retorna os ids globais na ordem recebida"""
+        grouped: Dict[int, List[int]] = {}
+        for offset, document in enumerate(documents):
+            position = shard_position(document.metadata.get(self.key), len(self.shards))
+            grouped.setdefault(position, []).append(offset)
+        ids: List[int] = [0] * len(documents)
+        for position, offsets in grouped.items():
+            local_ids = self.shards[position].add_embeddings(
+                [documents[offset] for offset in offsets], [vectors[offset] for offset in offsets]
+            )
+            for offset, local_id in zip(offsets, local_ids):
+                ids[offset] = self._global(position, local_id)
+        return ids
+
+    def delete(self, ids: List[int]):
+        for position, local_ids in self._split(ids).items():
+            self.shards[position].delete(local_ids)
+
+    def commit(self):
+        """Confirma os shards com alterações pendentes (os demais não gravam nada)"""
+        for shard in self.shards:
+            shard.commit()
+
+    # ------------------------------------------------------------------
+    # Versões (processos leitores)
+    # ------------------------------------------------------------------
+
+    @property
+    def version(self) -> Tuple[int, ...]:
+        return tuple(shard.version for shard in self.shards)
+
+    def manifest_version(self) -> Tuple[int, ...]:
+        return tuple(shard.manifest_version() for shard in self.shards)
+
+    def reopen(self) -> "ShardedCollection":
+        """Nova instância que reabre só os shards com versão nova; os demais são compartilhados"""
+        return type(self)(self.name, [
+            shard.reopen() if shard.manifest_version() != shard.version else shard
+            for shard in self.shards
+        ], self.key, self.path, self.pool)
+
+    # ------------------------------------------------------------------
+    # Leitura
+    # ------------------------------------------------------------------
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.ntotal for shard in self.shards)
+
+    def ids_where(self, field: str, value) -> List[int]:
+        """Ids globais com o metadado ``field`` igual a ``value``; pela chave, consulta só o shard dono"""
+        if field == self.key:
+            position = shard_position(value, len(self.shards))
+            return [self._global(position, vector_id) for vector_id in self.shards[position].ids_where(field, value)]
+        return sorted(
+            self._global(position, vector_id)
+            for position, shard in enumerate(self.shards)
+            for vector_id in shard.ids_where(field, value)
+        )
+
+    def values(self, field: str) -> List:
+        return list({value for shard in self.shards for value in shard.values(field)})
+
+    def hybrid_search_batch(self, embeddings, queries: List[str], k: int = 4,
+                            candidates: int = HYBRID_CANDIDATES_K) -> List[List[Tuple[int, Document, float]]]:
+        """
+        Busca híbrida (vetorial + BM25) de várias perguntas em todos os shards.
+
+        Retorna, por pergunta, trios (id global, documento, distância L2) na ordem da
+        fusão. Os candidatos de cada shard já vêm ordenados: ``heapq.merge`` intercala
+        as listas e o reciprocal rank fusion é aplicado como em uma coleção única.
+        """
+        candidates = max(k, candidates)
+        per_shard = self._scatter(self._shard_candidates, embeddings, queries, k, candidates)
+        results = []
+        for position in range(len(queries)):
+            dense_lists, lexical_lists = [], []
+            distances: Dict[int, float] = {}
+            documents: Dict[int, Document] = {}
+            for shard_results in per_shard:
+                dense, lexical, shard_distances, shard_documents = shard_results[position]
+                dense_lists.append(dense)
+                lexical_lists.append(lexical)
+                distances.update(shard_distances)
+                documents.update(shard_documents)
+            dense = list(itertools.islice(heapq.merge(*dense_lists, key=lambda hit: hit[1]), candidates))
+            lexical = list(itertools.islice(heapq.merge(*lexical_lists, key=lambda hit: -hit[1]), candidates))
+            results.append([
+                (vector_id, documents[vector_id], distance)
+                for vector_id, distance in fuse_candidates(dense, lexical, distances, k)
+            ])
+        return results
+
+    def mmr_batch(self, query_vectors, hits_batch: List[List[Tuple[int, Document, float]]], k: int,
+                  lambda_mult: float = MMR_LAMBDA) -> List[List[Tuple[int, Document, float]]]:
+        """
+        Reduz os resultados de ``hybrid_search_batch`` a ``k`` por pergunta por maximal marginal relevance.
+
+        Os vetores dos candidatos são lidos dos shards (os gravados, sem recalcular embeddings)
+        e a seleção de todas as perguntas é feita com operações de matriz (``mmr_select_batch``).
+        Candidatos removidos desde a busca ficam de fora.
+        """
+        vectors: Dict[int, np.ndarray] = {}
+        ids = sorted({vector_id for hits in hits_batch for vector_id, document, distance in hits})
+        for position, local_ids in self._split(ids).items():
+            live, rows = self.shards[position].get_live_vectors(local_ids)
+            for vector_id, row in zip(live, rows):
+                vectors[self._global(position, vector_id)] = row
+        hits_batch = [[hit for hit in hits if hit[0] in vectors] for hits in hits_batch]
+        size = max((len(hits) for hits in hits_batch), default=0)
+        if not size:
+            return hits_batch
+
+        dim = len(next(iter(vectors.values())))
+        candidate_vectors = np.zeros((len(hits_batch), size, dim), dtype=np.float32)
+        valid = np.zeros((len(hits_batch), size), dtype=bool)
+        for row, hits in enumerate(hits_batch):
+            if hits:
+                candidate_vectors[row, :len(hits)] = [vectors[vector_id] for vector_id, document, distance in hits]
+                valid[row, :len(hits)] = True
+        picks = mmr_select_batch(query_vectors, candidate_vectors, valid, k, lambda_mult)
+        return [[hits[position] for position in chosen] for hits, chosen in zip(hits_batch, picks)]
+
+    def _shard_candidates(self, position: int, embeddings, queries: List[str], k: int, candidates: int):
+        shard = self.shards[position]
+        count = len(self.shards)
+        results = []
+        # Busca e leitura dos documentos na mesma seção: uma remoção concorrente não os separa
+        with shard.reading():
+            for dense, lexical, distances in shard.hybrid_candidates_batch(embeddings, queries, k, candidates):
+                # Documentos só dos ids que podem entrar no top-k da fusão (os que têm distância)
+                results.append((
+                    [(vector_id * count + position, distance) for vector_id, distance in dense],
+                    [(vector_id * count + position, score) for vector_id, score in lexical],
+                    {vector_id * count + position: distance for vector_id, distance in distances.items()},
+                    {vector_id * count + position: shard.docstore[vector_id] for vector_id in distances},
+                ))
+        return results
+
+    def _scatter(self, func, *args) -> List:
+        """Executa ``func(shard, *args)`` em todos os shards, em paralelo quando há um pool"""
+        if self.pool is None or len(self.shards) == 1:
+            return [func(position, *args) for position in range(len(self.shards))]
+        futures = [self.pool.submit(func, position, *args) for position in range(len(self.shards))]
+        return [future.result() for future in futures]
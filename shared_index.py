@@ -0,0 +1,93 @@
+"""
+Compartilhamento dos índices entre processos (uvicorn --workers): um único escritor
+"""
+
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from utils import atomic_write_json
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class WriterLock:
+    """
+    Lock de arquivo que elege o processo escritor.
+
+    O primeiro processo a obter o lock grava nos índices; os demais abrem as
+    coleções somente para leitura. O lock é liberado pelo sistema operacional
+    quando o processo termina, então outro worker pode assumir após um reinício.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        """Tenta obter o lock sem bloquear; retorna se este processo é o escritor"""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock_file = open(self.path, "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+class WriteSpool:
+    """
+    Fila de escritas em disco, dos workers de leitura para o processo escritor.
+
+    Cada comando é um arquivo JSON gravado atomicamente; o escritor os consome em
+    ordem de criação e remove cada arquivo depois de aplicá-lo.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, op: str, **payload: Any) -> str:
+        """Enfileira um comando para o escritor"""
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+        atomic_write_json(os.path.join(self.directory, name), {"op": op, **payload})
+        return name
+
+    def pending(self) -> List[str]:
+        """Comandos ainda não aplicados, em ordem de criação"""
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+
+    def read(self, name: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def done(self, name: str):
+        os.remove(os.path.join(self.directory, name))
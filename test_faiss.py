@@ -7,11 +7,25 @@ import os
 import sys
 import tempfile
 
+# Diretório de trabalho da API usada nos testes de endpoints: os caminhos de config.py são
+# relativos, então o main importado uma única vez grava sempre dentro deste diretório
+API_WORKDIR = tempfile.TemporaryDirectory(prefix="rag-test-api-")
+
+def load_api():
+    """Importa a API com os substitutos locais do benchmark, sem carregar os índices"""
+    from benchmark import DeterministicEmbeddings, load_app
+
+    # Os módulos da API continuam importáveis depois da troca de diretório
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(API_WORKDIR.name)
+    return load_app(DeterministicEmbeddings(dim=16), llm_latency=0.0, load=False)
+
 def test_imports():
     """Testa se todas as importações estão funcionando"""
     try:
         from config import validate_config
-        from utils import clean_text_data, save_faiss_index, load_faiss_index
+        from utils import clean_text_data, atomic_write_json, load_faiss_index
+        from faiss_store import FaissCollection
         from langchain_community.vectorstores import FAISS
         from langchain_google_genai import GoogleGenerativeAIEmbeddings
         print("✅ Todas as importações estão funcionando")
@@ -96,6 +110,1439 @@ def test_faiss_basic():
         print(f"❌ Erro no teste FAISS: {e}")
         return False
 
+def test_embedding_cache():
+    """Testa o cache persistente de embeddings"""
+    try:
+        from embedding_cache import KEY_SIZE, CachedEmbeddings
+
+        class CountingEmbeddings:
+            def __init__(self):
+                self.calls = 0
+            def embed_query(self, text):
+                self.calls += 1
+                return [float(len(text)), 0.5, 0.25]
+            def embed_documents(self, texts):
+                self.calls += len(texts)
+                return [[float(len(text)), 0.5, 0.25] for text in texts]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            underlying = CountingEmbeddings()
+            cached = CachedEmbeddings(underlying, "mock", directory=cache_dir, memory_size=1)
+            first = cached.embed_documents(["contrato A", "contrato  A", "contrato B"])
+            cached.embed_documents(["contrato A", "contrato B"])
+
+            # Nova instância: memória vazia, mas o disco deve responder
+            reopened = CachedEmbeddings(underlying, "mock", directory=cache_dir)
+            again = reopened.embed_documents(["contrato A"])
+
+            if underlying.calls != 2 or again[0] != first[0]:
+                print("❌ Cache de embeddings chamou o modelo mais do que o necessário")
+                return False
+            if reopened.stats()["disk_hits"] != 1:
+                print("❌ Cache de embeddings não contabilizou o acerto em disco")
+                return False
+            if os.path.getsize(reopened.disk.keys_path) != len(reopened.disk) * (KEY_SIZE + 1):
+                print("❌ Arquivo de chaves fora do tamanho fixo por linha")
+                return False
+
+        print("✅ Cache de embeddings funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no cache de embeddings: {e}")
+        return False
+
+def test_faiss_collection():
+    """Testa a persistência incremental da coleção FAISS"""
+    try:
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [float(len(text)), 1.0, 0.0]
+            def embed_documents(self, texts):
+                return [[float(len(text)), 1.0, 0.0] for text in texts]
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            collection = FaissCollection.open(
+                "docs", MockEmbeddings(), directory=index_dir, indexed_fields=("file_name",)
+            )
+            ids = collection.add_documents([
+                Document(page_content="a", metadata={"file_name": "a.pdf"}),
+                Document(page_content="bbbb", metadata={"file_name": "b.pdf"}),
+            ])
+            collection.commit()
+            collection.delete([ids[0]])
+            collection.add_documents([Document(page_content="cc", metadata={"file_name": "c.pdf"})])
+            collection.commit()
+            collection.write_checkpoint()
+            collection.add_documents([Document(page_content="ddddddd", metadata={"file_name": "d.pdf"})])
+            collection.commit()
+
+            # Simular um commit interrompido: bytes soltos no fim do segmento
+            with open(collection.segment_path, "ab") as f:
+                f.write(b'{"op": "add", "id": 99')
+
+            reopened = FaissCollection.open(
+                "docs", MockEmbeddings(), directory=index_dir, indexed_fields=("file_name",)
+            )
+            results = reopened.similarity_search_with_score("bbb", k=10)
+            names = [doc.metadata["file_name"] for doc, score in results]
+
+            if names != ["b.pdf", "c.pdf", "d.pdf"] or reopened.ntotal != 3:
+                print(f"❌ Coleção FAISS reaberta com conteúdo inesperado: {names}")
+                return False
+            if sorted(reopened.values("file_name")) != ["b.pdf", "c.pdf", "d.pdf"] or reopened.ids_where("file_name", "a.pdf"):
+                print("❌ Índice de metadados da coleção FAISS inconsistente")
+                return False
+
+        print("✅ Persistência incremental do FAISS funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na coleção FAISS: {e}")
+        return False
+
+def test_faiss_compaction():
+    """Testa a remoção por metadado e a compactação de tombstones"""
+    try:
+        from langchain_core.documents import Document
+        import faiss_store
+        from faiss_store import FaissCollection
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [float(len(text)), 0.0]
+            def embed_documents(self, texts):
+                return [[float(len(text)), 0.0] for text in texts]
+
+        original = (faiss_store.FAISS_COMPACTION_MIN_TOMBSTONES, faiss_store.FAISS_COMPACTION_TOMBSTONE_RATIO)
+        faiss_store.FAISS_COMPACTION_MIN_TOMBSTONES, faiss_store.FAISS_COMPACTION_TOMBSTONE_RATIO = 4, 0.5
+        try:
+            with tempfile.TemporaryDirectory() as index_dir:
+                collection = FaissCollection.open(
+                    "chats", MockEmbeddings(), directory=index_dir, indexed_fields=("chat_id",)
+                )
+                collection.add_documents([
+                    Document(page_content="x" * (i + 1), metadata={"chat_id": "a" if i < 6 else "b"})
+                    for i in range(8)
+                ])
+                collection.commit()
+                kept_ids = collection.ids_where("chat_id", "b")
+                collection.delete(collection.ids_where("chat_id", "a"))
+                collection.commit()
+
+                if collection.generation != 1 or collection.tombstones != 0:
+                    print("❌ Compactação não foi disparada após os tombstones")
+                    return False
+
+                reopened = FaissCollection.open(
+                    "chats", MockEmbeddings(), directory=index_dir, indexed_fields=("chat_id",)
+                )
+                scoped = reopened.similarity_search_with_score("x", k=5, filter={"chat_id": "b"})
+                if [doc.metadata["chat_id"] for doc, score in scoped] != ["b", "b"]:
+                    print("❌ Busca filtrada por chat_id retornou turnos de outro chat")
+                    return False
+                if reopened.ids_where("chat_id", "b") != kept_ids or reopened.ntotal != 2:
+                    print("❌ Coleção compactada perdeu ou renumerou vetores")
+                    return False
+                # Flat: o checkpoint não tem arquivo de índice (a busca usa vectors.f32)
+                if sorted(os.listdir(reopened.path)) != sorted([
+                    "manifest.json", reopened.vectors_file, reopened.segment_file
+                ]) or "file" in reopened.checkpoint:
+                    print("❌ Compactação deixou arquivos antigos para trás")
+                    return False
+        finally:
+            faiss_store.FAISS_COMPACTION_MIN_TOMBSTONES, faiss_store.FAISS_COMPACTION_TOMBSTONE_RATIO = original
+
+        print("✅ Compactação do FAISS funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na compactação FAISS: {e}")
+        return False
+
+def test_faiss_index_types():
+    """Testa a reconstrução da coleção em índices IVF e HNSW"""
+    try:
+        import numpy as np
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+
+        vectors = np.random.default_rng(0).random((300, 8)).astype("float32")
+        specs = [
+            {"type": "ivf_flat", "nlist": 4, "nprobe": 4},
+            {"type": "hnsw", "M": 8, "efSearch": 64},
+        ]
+        for spec in specs:
+            with tempfile.TemporaryDirectory() as index_dir:
+                collection = FaissCollection.open("docs", None, directory=index_dir)
+                ids = collection.add_embeddings(
+                    [Document(page_content=str(i), metadata={}) for i in range(300)], vectors
+                )
+                collection.rebuild(spec)
+                collection.delete(ids[:10])
+                collection.commit()
+
+                reopened = FaissCollection.open("docs", None, directory=index_dir)
+                found = [vector_id for vector_id, distance in reopened.search_ids(vectors[0], k=5)]
+                if reopened.index_spec["type"] != spec["type"] or reopened.ntotal != 290:
+                    print(f"❌ Índice {spec['type']} não foi reaberto corretamente")
+                    return False
+                if set(found) & set(ids[:10]) or len(found) != 5:
+                    print(f"❌ Índice {spec['type']} retornou vetores removidos")
+                    return False
+
+        # Leitor de um IVF: listas do checkpoint via mmap (somente leitura) e o resto em memória
+        from faiss_store import MappedIVFIndex
+        with tempfile.TemporaryDirectory() as index_dir:
+            writer = FaissCollection.open("docs", None, directory=index_dir)
+            writer.checkpoint_interval = 10 ** 9
+            ids = writer.add_embeddings([Document(page_content=str(i), metadata={}) for i in range(250)], vectors[:250])
+            writer.rebuild(specs[0])
+            reader = FaissCollection.open("docs", None, directory=index_dir, read_only=True)
+            queries = vectors[:6]
+            for step in range(2):
+                writer.add_embeddings([Document(page_content="novo", metadata={})] * 25,
+                                      vectors[250 + 25 * step:275 + 25 * step])
+                writer.delete(ids[10 * step:10 * step + 10])
+                writer.commit()
+                if step:
+                    writer.write_checkpoint()
+                if reader.reopen() is not reader or not isinstance(reader.index, MappedIVFIndex):
+                    print("❌ Leitor do IVF não usa as listas do checkpoint via mmap")
+                    return False
+                if reader.search_ids_batch(queries, k=5) != writer.search_ids_batch(queries, k=5) \
+                        or reader.ntotal != writer.ntotal:
+                    print(f"❌ Leitor do IVF difere do escritor (passo {step})")
+                    return False
+
+        print("✅ Índices IVF/HNSW funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro nos tipos de índice FAISS: {e}")
+        return False
+
+def test_chunking():
+    """Testa o chunking com sobreposição e a montagem do contexto"""
+    try:
+        from langchain_core.documents import Document
+        from chunking import chunk_documents, assemble_context, estimate_tokens
+
+        text = " ".join(f"Cláusula {i} define a obrigação número {i} das partes." for i in range(40))
+        page = Document(page_content=text, metadata={"file_name": "c.pdf", "page_number": 3})
+        chunks = chunk_documents([page], chunk_size=60, chunk_overlap=20)
+
+        if len(chunks) < 2 or any(estimate_tokens(chunk.page_content) > 60 for chunk in chunks):
+            print("❌ Chunks fora do tamanho configurado")
+            return False
+        for chunk in chunks:
+            start, end = chunk.metadata["start_index"], chunk.metadata["end_index"]
+            if text[start:end] != chunk.page_content or chunk.metadata["page_number"] != 3:
+                print("❌ Offsets/metadados do chunk incorretos")
+                return False
+        if chunks[1].metadata["start_index"] >= chunks[0].metadata["end_index"]:
+            print("❌ Chunks consecutivos sem sobreposição")
+            return False
+
+        context = assemble_context([(chunks[0], 0.1), (chunks[1], 0.2)], token_budget=1000)
+        joined = context[0].page_content + context[1].page_content
+        if len(joined) != chunks[1].metadata["end_index"] - chunks[0].metadata["start_index"]:
+            print("❌ Sobreposição entre chunks não foi removida do contexto")
+            return False
+        if assemble_context([(chunk, 0.0) for chunk in chunks], token_budget=60) != [chunks[0]]:
+            print("❌ Contexto excedeu o orçamento de tokens")
+            return False
+
+        print("✅ Chunking e montagem de contexto funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no chunking: {e}")
+        return False
+
+def test_answer_cache():
+    """Testa o cache semântico de respostas"""
+    try:
+        from answer_cache import AnswerCache
+
+        now = [0.0]
+        cache = AnswerCache(threshold=0.95, ttl=60, max_entries=2, clock=lambda: now[0])
+        cache.put("c1", [1.0, 0.0], [1, 2], {"a.pdf"}, "12 meses")
+
+        if cache.get("c1", [0.99, 0.05], [2, 1]) != "12 meses":
+            print("❌ Pergunta equivalente não reaproveitou a resposta")
+            return False
+        # Mesma pergunta e mesmo contexto em outro chat: a resposta dependeu do histórico do c1
+        if cache.get("c2", [1.0, 0.0], [1, 2]) is not None:
+            print("❌ Resposta de um chat reaproveitada em outro chat")
+            return False
+        if cache.get("c1", [0.0, 1.0], [1, 2]) is not None or cache.get("c1", [1.0, 0.0], [1, 3]) is not None:
+            print("❌ Cache respondeu para pergunta ou contexto diferente")
+            return False
+        if cache.invalidate("a.pdf") != 1 or cache.get("c1", [1.0, 0.0], [1, 2]) is not None:
+            print("❌ Invalidação por arquivo não funcionou")
+            return False
+
+        cache.put("c1", [1.0, 0.0], [1], {"a.pdf"}, "r1")
+        cache.put("c1", [1.0, 0.0], [2], {"b.pdf"}, "r2")
+        cache.get("c1", [1.0, 0.0], [1])
+        cache.put("c1", [1.0, 0.0], [3], {"c.pdf"}, "r3")
+        if cache.get("c1", [1.0, 0.0], [2]) is not None or cache.get("c1", [1.0, 0.0], [1]) != "r1":
+            print("❌ Evicção LRU incorreta")
+            return False
+        now[0] = 120
+        if cache.get("c1", [1.0, 0.0], [1]) is not None:
+            print("❌ Entrada expirada foi retornada")
+            return False
+
+        stats = cache.stats()
+        if stats["hits"] != 3 or stats["evictions"] != 1 or stats["expirations"] != 1:
+            print(f"❌ Contadores incorretos: {stats}")
+            return False
+
+        print("✅ Cache de respostas funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no cache de respostas: {e}")
+        return False
+
+def test_hybrid_search():
+    """Testa o índice BM25 incremental e a busca híbrida"""
+    try:
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+        from keyword_index import tokenize, reciprocal_rank_fusion
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [1.0, 0.0]
+            def embed_documents(self, texts):
+                return [[1.0, float(i)] for i, text in enumerate(texts)]
+
+        if "12345678000190" not in tokenize("CNPJ 12.345.678/0001-90") or tokenize("Vigência") != ["vigencia"]:
+            print("❌ Tokenização de identificadores incorreta")
+            return False
+        if reciprocal_rank_fusion([[1, 2, 3], [3, 1]])[:2] != [1, 3]:
+            print("❌ Reciprocal rank fusion incorreto")
+            return False
+
+        texts = [
+            "O contrato tem vigência de doze meses.",
+            "A contratada, CNPJ 12.345.678/0001-90, presta os serviços.",
+            "A multa por rescisão é de dez por cento.",
+            "Cláusula 7.2: o foro é São Paulo.",
+        ]
+        with tempfile.TemporaryDirectory() as index_dir:
+            def open_collection():
+                return FaissCollection.open("docs", MockEmbeddings(), directory=index_dir, keyword_index=True)
+
+            collection = open_collection()
+            ids = collection.add_documents([Document(page_content=t, metadata={}) for t in texts[:2]])
+            collection.commit()
+            collection.write_checkpoint()
+            ids += collection.add_documents([Document(page_content=t, metadata={}) for t in texts[2:]])
+            collection.commit()
+
+            # O vetor da pergunta é mais próximo do primeiro texto; o BM25 traz o CNPJ
+            hits = collection.hybrid_search_ids([1.0, 0.0], "CNPJ 12345678000190", k=2)
+            if ids[1] not in [vector_id for vector_id, distance in hits]:
+                print(f"❌ Busca híbrida não encontrou o identificador exato: {hits}")
+                return False
+
+            collection.delete([ids[1], ids[3]])
+            collection.commit()
+            reopened = open_collection()
+            for keywords in (collection.keywords, reopened.keywords):
+                found = [vector_id for vector_id, score in keywords.search("cnpj cláusula 7.2 multa", k=10)]
+                if found != [ids[2]] or len(keywords) != 2:
+                    print(f"❌ BM25 inconsistente após remoção/reabertura: {found}")
+                    return False
+
+            reopened.write_checkpoint()
+            if [i for i, score in open_collection().keywords.search("vigencia", k=5)] != [ids[0]]:
+                print("❌ Snapshot BM25 fundido incorretamente")
+                return False
+
+        print("✅ Busca híbrida BM25 + vetorial funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na busca híbrida: {e}")
+        return False
+
+def test_shared_index():
+    """Testa o escritor único e os snapshots somente leitura entre processos"""
+    try:
+        import asyncio
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+        from shared_index import WriterLock, WriteSpool
+        from ingestion import IngestionJob, IngestionQueue
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [float(len(text)), 1.0]
+            def embed_documents(self, texts):
+                return [[float(len(text)), 1.0] for text in texts]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            lock_path = os.path.join(data_dir, "writer.lock")
+            first, second = WriterLock(lock_path), WriterLock(lock_path)
+            if not first.try_acquire() or second.try_acquire():
+                print("❌ Lock do escritor não é exclusivo")
+                return False
+            first.release()
+            if not second.try_acquire():
+                print("❌ Lock do escritor não foi liberado")
+                return False
+            second.release()
+
+            writer = FaissCollection.open("docs", MockEmbeddings(), directory=data_dir)
+            writer.add_documents([Document(page_content="a", metadata={})])
+            writer.commit()
+            reader = FaissCollection.open("docs", MockEmbeddings(), directory=data_dir, read_only=True)
+            writer.add_documents([Document(page_content="bb", metadata={})])
+            writer.commit()
+
+            if reader.ntotal != 1 or reader.manifest_version() == reader.version:
+                print("❌ Leitor não enxerga a nova versão como pendente")
+                return False
+            try:
+                reader.add_documents([Document(page_content="c", metadata={})])
+                print("❌ Coleção somente leitura aceitou escrita")
+                return False
+            except RuntimeError:
+                pass
+            reader = reader.reopen()
+            if reader.ntotal != 2 or reader.version != writer.version or not reader.read_only:
+                print("❌ Leitor não trocou para a nova versão")
+                return False
+
+            spool = WriteSpool(os.path.join(data_dir, "spool"))
+            spool.submit("delete_document", file_name="a.pdf")
+            spool.submit("clear_chat", chat_id="c1")
+            commands = [spool.read(name)["op"] for name in spool.pending()]
+            for name in spool.pending():
+                spool.done(name)
+            if commands != ["delete_document", "clear_chat"] or spool.pending():
+                print(f"❌ Fila de escritas fora de ordem: {commands}")
+                return False
+
+            status_dir = os.path.join(data_dir, "jobs")
+            job = IngestionJob("a.pdf", None)
+            asyncio.run(IngestionQueue(None, None, None, status_dir=status_dir).record(job))
+            if IngestionQueue(None, None, None, status_dir=status_dir).get(job.id)["status"] != "queued":
+                print("❌ Estado do job não foi compartilhado entre processos")
+                return False
+
+        print("✅ Escritor único e snapshots somente leitura funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no compartilhamento dos índices: {e}")
+        return False
+
+def test_reader_memory():
+    """Testa que um leitor não copia os vetores para a memória privada (busca flat via mmap)"""
+    if not os.path.exists("/proc/self/status"):
+        print("✅ Memória do leitor: sem /proc, medição ignorada")
+        return True
+    try:
+        import subprocess
+        import numpy as np
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+
+        # Abre a coleção somente para leitura em outro processo, busca e informa quanto
+        # cresceu a memória anônima (privada); páginas do arquivo mapeado não entram nela
+        reader = (
+            "import sys, numpy as np\n"
+            "sys.path.insert(0, sys.argv[2])\n"
+            "from faiss_store import FaissCollection\n"
+            "def anon():\n"
+            "    return next(int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('RssAnon:'))\n"
+            "before = anon()\n"
+            "collection = FaissCollection.open('docs', None, directory=sys.argv[1], read_only=True)\n"
+            "collection.search_ids_batch(np.ones((4, collection.dim), dtype=np.float32), k=5)\n"
+            "print(anon() - before)\n"
+        )
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        dim = 4096
+        growth = {}
+        for count in (500, 8000):
+            with tempfile.TemporaryDirectory() as index_dir:
+                collection = FaissCollection.open("docs", None, directory=index_dir)
+                for start in range(0, count, 1000):
+                    size = min(1000, count - start)
+                    collection.add_embeddings(
+                        [Document(page_content=f"Cláusula {start + i}", metadata={}) for i in range(size)],
+                        np.random.default_rng(start).random((size, dim), dtype=np.float32),
+                    )
+                    collection.commit()
+                output = subprocess.run([sys.executable, "-c", reader, index_dir, package_dir],
+                                        capture_output=True, text=True, check=True).stdout
+                growth[count] = int(output.split()[-1]) / 1024
+
+        vectors_mb = (8000 - 500) * dim * 4 / (1024 * 1024)
+        if growth[8000] - growth[500] > 0.25 * vectors_mb:
+            print(f"❌ Memória privada do leitor cresce com os vetores: {growth} MB para {vectors_mb:.0f} MB de vetores")
+            return False
+
+        print("✅ Leitor busca nos vetores via mmap, sem cópia privada")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na medição de memória do leitor: {e}")
+        return False
+
+
+def test_incremental_reopen():
+    """Testa a atualização incremental dos leitores (só o trecho novo do segmento)"""
+    try:
+        import numpy as np
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [0.0] * 8
+            def embed_documents(self, texts):
+                return [[0.0] * 8 for text in texts]
+
+        rng = np.random.default_rng(11)
+
+        def add(collection, start, count):
+            documents = [Document(page_content=f"cláusula termo{i} contrato", metadata={"file_name": f"doc{i % 4}.pdf"})
+                         for i in range(start, start + count)]
+            collection.add_embeddings(documents, rng.random((count, 8)).astype(np.float32))
+            collection.commit()
+
+        def snapshot(collection, queries):
+            return (
+                {vector_id: (doc.page_content, doc.metadata) for vector_id, doc in collection.docstore.items()},
+                sorted(collection.ids_where("file_name", "doc1.pdf")),
+                collection.ntotal,
+                [[(i, round(d, 4)) for i, d in hits] for hits in collection.search_ids_batch(queries, 5)],
+                [[(i, round(d, 4)) for i, d in hits]
+                 for hits in collection.hybrid_search_ids_batch(queries, ["termo7", "termo23"], 5)],
+            )
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            def open_collection(read_only):
+                collection = FaissCollection.open("docs", MockEmbeddings(), directory=data_dir,
+                                                  indexed_fields=("file_name",), keyword_index=True,
+                                                  read_only=read_only)
+                collection.checkpoint_interval = 3
+                return collection
+
+            writer = open_collection(False)
+            add(writer, 0, 10)
+            reader = open_collection(True)
+
+            # Adições, atualização de metadados e remoções, passando por checkpoints do escritor
+            add(writer, 10, 5)
+            writer.update_metadata({2: {"file_name": "doc1.pdf", "revisado": True}})
+            writer.commit()
+            writer.delete(writer.ids_where("file_name", "doc3.pdf")[:2] + [12])
+            writer.commit()
+            add(writer, 15, 10)
+
+            queries = rng.random((2, 8)).astype(np.float32)
+            updated = reader.reopen()
+            if updated is not reader or reader.version != writer.version:
+                print("❌ Leitor reabriu a coleção inteira em vez de aplicar o trecho novo")
+                return False
+            if snapshot(reader, queries) != snapshot(open_collection(True), queries):
+                print("❌ Leitor atualizado difere de uma abertura completa")
+                return False
+
+            # Compactação troca a geração: o leitor abre uma instância nova
+            writer.compact()
+            if reader.reopen() is reader:
+                print("❌ Leitor aplicou trecho sobre uma geração compactada")
+                return False
+
+        print("✅ Atualização incremental dos leitores funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na atualização incremental dos leitores: {e}")
+        return False
+
+def test_concurrent_access():
+    """Testa buscas concorrentes com escritas na mesma coleção"""
+    try:
+        import threading
+        import numpy as np
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+        from rwlock import ReadWriteLock
+
+        lock = ReadWriteLock()
+        with lock.reading():
+            with lock.reading():
+                pass
+        with lock.writing():
+            with lock.reading():
+                pass
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            collection = FaissCollection.open(
+                "docs", None, directory=index_dir, indexed_fields=("file_name",), keyword_index=True
+            )
+            rng = np.random.default_rng(0)
+            errors, done = [], threading.Event()
+
+            def search():
+                query = np.ones(4, dtype=np.float32)
+                while not done.is_set():
+                    try:
+                        with collection.reading():
+                            hits = collection.hybrid_search_ids(query, "prazo", k=3)
+                            [collection.docstore[vector_id] for vector_id, distance in hits]
+                    except Exception as e:
+                        errors.append(e)
+
+            readers = [threading.Thread(target=search) for _ in range(3)]
+            for reader in readers:
+                reader.start()
+            for i in range(60):
+                collection.add_embeddings(
+                    [Document(page_content=f"prazo {i}", metadata={"file_name": f"{i}.pdf"})],
+                    rng.random((1, 4))
+                )
+                collection.commit()
+                if i % 2:
+                    collection.delete(collection.ids_where("file_name", f"{i - 1}.pdf"))
+                    collection.commit()
+                if i == 30:
+                    collection.write_checkpoint()
+            done.set()
+            for reader in readers:
+                reader.join()
+
+            if errors or collection.ntotal != 30:
+                print(f"❌ Busca concorrente viu o índice no meio de uma escrita: {errors[:1]}")
+                return False
+
+        print("✅ Leitores concorrentes e escritor serializado funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no acesso concorrente: {e}")
+        return False
+
+def test_chat_store():
+    """Testa o histórico de chat em SQLite"""
+    try:
+        import json
+        from chat_store import ChatHistoryStore
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            legacy_dir = os.path.join(data_dir, "chat_history")
+            os.makedirs(legacy_dir)
+            with open(os.path.join(legacy_dir, "antigo.json"), "w", encoding="utf-8") as f:
+                json.dump([
+                    {"user": "b", "ai": "2", "timestamp": "2024-01-02T00:00:00"},
+                    {"user": "a", "ai": "1", "timestamp": "2024-01-01T00:00:00"},
+                ], f)
+
+            store = ChatHistoryStore(os.path.join(data_dir, "chat.sqlite3"))
+            if store.migrate_json(legacy_dir) != 1 or store.migrate_json(legacy_dir) != 0:
+                print("❌ Migração do histórico JSON incorreta")
+                return False
+            for i in range(5):
+                store.append("c1", f"pergunta {i}", f"resposta {i}")
+
+            pages, cursor = [], None
+            while True:
+                turns, cursor = store.history("c1", limit=2, cursor=cursor)
+                pages.append([turn["user"] for turn in turns])
+                if cursor is None:
+                    break
+            if pages != [["pergunta 0", "pergunta 1"], ["pergunta 2", "pergunta 3"], ["pergunta 4"]]:
+                print(f"❌ Paginação do histórico incorreta: {pages}")
+                return False
+            if [turn["user"] for turn in store.history("antigo")[0]] != ["a", "b"]:
+                print("❌ Histórico migrado fora de ordem")
+                return False
+
+            first, cursor = store.chat_ids(limit=1)
+            rest, last_cursor = store.chat_ids(limit=1, cursor=cursor)
+            if first + rest != ["antigo", "c1"] or last_cursor is not None:
+                print("❌ Listagem de chats por cursor incorreta")
+                return False
+            if not store.clear("c1") or store.history("c1")[0] or store.chat_ids()[0] != ["antigo"]:
+                print("❌ Limpeza do histórico incorreta")
+                return False
+
+        print("✅ Histórico de chat em SQLite funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no histórico de chat: {e}")
+        return False
+
+def test_pdf_streaming():
+    """Testa a extração paralela de páginas e o embedding durante a extração"""
+    try:
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+        from langchain_core.documents import Document
+        from pdf_parser import count_pdf_pages, iter_pdf_pages
+        from ingestion import IngestionQueue
+        from benchmark import make_pdf
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc.pdf")
+            with open(path, "wb") as f:
+                f.write(make_pdf([f"Pagina {i} do contrato" for i in range(11)]))
+            with ProcessPoolExecutor(max_workers=2) as pool:
+                total = count_pdf_pages(path)
+                pages = list(iter_pdf_pages(path, "doc.pdf", pool, total, pages_per_task=3, prefetch=2))
+            if total != 11 or [page.metadata["page_number"] for page in pages] != list(range(1, 12)):
+                print("❌ Páginas fora de ordem ou faltando")
+                return False
+            if pages[4].page_content.strip() != "Pagina 4 do contrato":
+                print(f"❌ Texto extraído incorreto: {pages[4].page_content!r}")
+                return False
+
+        events, closed = [], []
+
+        async def parse(job):
+            try:
+                for i in range(5):
+                    events.append("parse")
+                    yield Document(page_content=f"chunk {i}", metadata={"file_name": job.file_name})
+            finally:
+                closed.append(job.file_name)
+
+        async def embed(texts):
+            events.append("embed")
+            return [[float(len(text))] for text in texts]
+
+        committed = []
+
+        async def commit(documents, vectors, reused):
+            committed.append((len(documents), len(vectors)))
+
+        async def run():
+            queue = IngestionQueue(parse, embed, commit, workers=1, batch_size=2)
+            job = await queue.submit("a.pdf", None)
+            await queue._queue.join()
+            return job
+
+        job = asyncio.run(run())
+        if job.status != "done" or committed != [(5, 5)] or job.chunks_embedded != 5:
+            print(f"❌ Ingestão em fluxo incorreta: {job.to_dict()}")
+            return False
+        if events.index("embed") > 2 or closed != ["a.pdf"]:
+            print("❌ Embedding não começou durante a extração")
+            return False
+
+        print("✅ Extração paralela e ingestão em fluxo funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na extração de PDF: {e}")
+        return False
+
+def test_deduplication():
+    """Testa o descarte de chunks repetidos/já indexados e a atualização de metadados"""
+    try:
+        import asyncio
+        from langchain_core.documents import Document
+        from chunking import content_hash
+        from faiss_store import FaissCollection
+        from ingestion import IngestionQueue
+
+        texts = ["cláusula 1", "cláusula 2", "cláusula 1", "cláusula 3", "cláusula 2"]
+
+        async def parse(job):
+            for i, text in enumerate(texts):
+                yield Document(page_content=text, metadata={"chunk_index": i, "content_hash": content_hash(text)})
+
+        embedded, committed = [], []
+
+        async def embed(batch):
+            embedded.extend(batch)
+            return [[float(len(text))] for text in batch]
+
+        async def commit(documents, vectors, reused):
+            committed.append(([doc.page_content for doc in documents], [doc.page_content for doc in reused]))
+
+        async def indexed(job):
+            return {content_hash("cláusula 2")}
+
+        async def run():
+            queue = IngestionQueue(parse, embed, commit, workers=1, batch_size=2, indexed=indexed)
+            job = await queue.submit("a.pdf", None)
+            await queue._queue.join()
+            return job, await queue.skip("a.pdf")
+
+        job, skipped = asyncio.run(run())
+        if embedded != ["cláusula 1", "cláusula 3"] or committed != [(["cláusula 1", "cláusula 3"], ["cláusula 2"])]:
+            print(f"❌ Chunks repetidos ou já indexados passaram pelo embedding: {embedded}")
+            return False
+        if (job.chunks_total, job.chunks_reused, job.chunks_duplicated) != (5, 1, 2) or skipped.status != "skipped":
+            print(f"❌ Contadores de deduplicação incorretos: {job.to_dict()}")
+            return False
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [float(len(text)), 1.0]
+            def embed_documents(self, texts):
+                return [[float(len(text)), 1.0] for text in texts]
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            collection = FaissCollection.open("docs", MockEmbeddings(), directory=index_dir,
+                                              indexed_fields=("file_name", "file_hash"))
+            ids = collection.add_documents([
+                Document(page_content="a", metadata={"file_name": "a.pdf", "file_hash": "v1", "page_number": 1}),
+                Document(page_content="b", metadata={"file_name": "a.pdf", "file_hash": "v1", "page_number": 2}),
+            ])
+            collection.commit()
+            vectors = collection.get_vectors(ids)
+            collection.update_metadata({ids[1]: {"file_name": "a.pdf", "file_hash": "v2", "page_number": 3}})
+            collection.commit()
+
+            reopened = FaissCollection.open("docs", MockEmbeddings(), directory=index_dir,
+                                            indexed_fields=("file_name", "file_hash"))
+            if reopened.ids_where("file_hash", "v2") != [ids[1]] or reopened.ids_where("file_hash", "v1") != [ids[0]]:
+                print("❌ Índice de metadados não acompanhou a atualização")
+                return False
+            if reopened.docstore[ids[1]].metadata["page_number"] != 3 or (reopened.get_vectors(ids) != vectors).any():
+                print("❌ Atualização de metadados não persistiu ou alterou os vetores")
+                return False
+
+        print("✅ Deduplicação de chunks e atualização de metadados funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na deduplicação: {e}")
+        return False
+
+def test_benchmark_fakes():
+    """Testa os substitutos determinísticos e as métricas do benchmark"""
+    try:
+        import numpy as np
+        from benchmark import DeterministicEmbeddings, synthetic_text, summarize
+
+        embeddings = DeterministicEmbeddings(dim=64)
+        first = embeddings.embed_query("prazo de vigencia do contrato")
+        if first != DeterministicEmbeddings(dim=64).embed_query("prazo de vigencia do contrato") or len(first) != 64:
+            print("❌ Embeddings do benchmark não são determinísticos")
+            return False
+        related = np.dot(first, embeddings.embed_query("vigencia do contrato"))
+        unrelated = np.dot(first, embeddings.embed_query("foro da comarca"))
+        if related <= unrelated:
+            print("❌ Textos com termos em comum não ficaram mais próximos")
+            return False
+        if synthetic_text(np.random.default_rng(1), 50) != synthetic_text(np.random.default_rng(1), 50):
+            print("❌ Corpus sintético não é determinístico")
+            return False
+        stats = summarize([0.001 * i for i in range(1, 101)], wall_seconds=2.0)
+        if stats["count"] != 100 or stats["p50_ms"] != 50.5 or stats["throughput_per_s"] != 50.0:
+            print(f"❌ Percentis/throughput incorretos: {stats}")
+            return False
+
+        print("✅ Substitutos e métricas do benchmark funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no benchmark: {e}")
+        return False
+
+def test_metrics():
+    """Testa o histograma e a exposição das métricas no formato do Prometheus"""
+    try:
+        from metrics import MetricsRegistry
+
+        registry = MetricsRegistry()
+        stages = registry.histogram("rag_stage_seconds", "Duração", ("pipeline", "stage"), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            stages.observe(value, pipeline="query", stage="llm")
+        with stages.time(pipeline="upload", stage="parse"):
+            pass
+        registry.callback("rag_index_vectors", "Vetores", lambda: {("my_docs",): 3}, ("collection",))
+        registry.callback("rag_broken", "Fonte indisponível", lambda: 1 / 0)
+        text = registry.render()
+
+        expected = [
+            'rag_stage_seconds_bucket{pipeline="query",stage="llm",le="0.1"} 2',
+            'rag_stage_seconds_bucket{pipeline="query",stage="llm",le="1.0"} 3',
+            'rag_stage_seconds_bucket{pipeline="query",stage="llm",le="+Inf"} 4',
+            'rag_stage_seconds_sum{pipeline="query",stage="llm"} 3.65',
+            'rag_stage_seconds_count{pipeline="query",stage="llm"} 4',
+            'rag_stage_seconds_count{pipeline="upload",stage="parse"} 1',
+            'rag_index_vectors{collection="my_docs"} 3.0',
+            '# TYPE rag_broken gauge',
+        ]
+        missing = [line for line in expected if line not in text.splitlines()]
+        if missing:
+            print(f"❌ Linhas ausentes em /metrics: {missing}")
+            return False
+        try:
+            registry.histogram("rag_stage_seconds", "Duplicada")
+            print("❌ Métrica duplicada foi aceita")
+            return False
+        except ValueError:
+            pass
+
+        print("✅ Métricas no formato do Prometheus funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro nas métricas: {e}")
+        return False
+
+def test_query_batching():
+    """Testa o agrupamento de perguntas concorrentes em uma única chamada de embedding"""
+    try:
+        import asyncio
+        import tempfile
+        from langchain_core.embeddings import Embeddings
+        from batching import MicroBatcher
+        from embedding_cache import CachedEmbeddings
+
+        class CountingEmbeddings(Embeddings):
+            def __init__(self):
+                self.batches = []
+
+            def embed_documents(self, texts):
+                self.batches.append(list(texts))
+                return [[float(len(text)), 1.0] for text in texts]
+
+            def embed_query(self, text):
+                raise AssertionError("perguntas devem ser calculadas em lote")
+
+        async def scenario():
+            with tempfile.TemporaryDirectory() as tmp:
+                query_model = CountingEmbeddings()
+                cached = CachedEmbeddings(CountingEmbeddings(), "fake", directory=tmp, query_underlying=query_model)
+                batcher = MicroBatcher(cached.aembed_queries, window=0.05, max_size=4)
+                # Seis perguntas simultâneas (uma repetida): um lote cheio de 4 e o restante na janela
+                queries = ["a", "bb", "ccc", "a", "dddd", "eeeee"]
+                vectors = await asyncio.gather(*(batcher.submit(query) for query in queries))
+                cached_again = await batcher.submit("bb")
+
+                async def failing(items):
+                    raise RuntimeError("falha no lote")
+
+                errors = await asyncio.gather(
+                    *(MicroBatcher(failing, window=0.01).submit(i) for i in range(3)), return_exceptions=True
+                )
+                return query_model.batches, vectors, cached_again, errors
+
+        batches, vectors, cached_again, errors = asyncio.run(scenario())
+        if batches != [["a", "bb", "ccc"], ["dddd", "eeeee"]]:
+            print(f"❌ Lotes inesperados: {batches}")
+            return False
+        if [vector[0] for vector in vectors] != [1.0, 2.0, 3.0, 1.0, 4.0, 5.0] or cached_again != [2.0, 1.0]:
+            print("❌ Vetores devolvidos ao chamador errado")
+            return False
+        if not all(isinstance(error, RuntimeError) for error in errors):
+            print("❌ Erro do lote não chegou a todos os chamadores")
+            return False
+
+        print("✅ Agrupamento de embeddings de perguntas funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no agrupamento de perguntas: {e}")
+        return False
+
+def test_batch_search():
+    """Testa a busca em lote (uma chamada ao FAISS para várias perguntas)"""
+    try:
+        import numpy as np
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [0.0] * 8
+            def embed_documents(self, texts):
+                return [[0.0] * 8 for text in texts]
+
+        rng = np.random.default_rng(7)
+        words = ["prazo", "multa", "foro", "vigência", "rescisão", "reajuste"]
+        documents = [
+            Document(page_content=f"Cláusula {i}: {words[i % len(words)]} do contrato", metadata={})
+            for i in range(60)
+        ]
+        with tempfile.TemporaryDirectory() as index_dir:
+            collection = FaissCollection.open("docs", MockEmbeddings(), directory=index_dir, keyword_index=True)
+            ids = collection.add_embeddings(documents, rng.random((60, 8)).astype(np.float32))
+            collection.delete(ids[:10])
+            collection.commit()
+
+            vectors = rng.random((5, 8)).astype(np.float32)
+            queries = [f"{words[i]} cláusula {i}" for i in range(5)]
+            dense = collection.search_ids_batch(vectors, k=6)
+            hybrid = collection.hybrid_search_ids_batch(vectors, queries, k=6)
+            for i in range(5):
+                if dense[i] != collection.search_ids(vectors[i], k=6):
+                    print(f"❌ Busca vetorial em lote difere da individual na pergunta {i}")
+                    return False
+                if hybrid[i] != collection.hybrid_search_ids(vectors[i], queries[i], k=6):
+                    print(f"❌ Busca híbrida em lote difere da individual na pergunta {i}")
+                    return False
+                if any(vector_id in ids[:10] for vector_id, distance in dense[i]):
+                    print("❌ Busca em lote retornou ids removidos")
+                    return False
+            if collection.search_ids_batch(np.empty((0, 8), dtype=np.float32)) != []:
+                print("❌ Lote vazio deveria retornar lista vazia")
+                return False
+
+        print("✅ Busca em lote funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na busca em lote: {e}")
+        return False
+
+def test_sharded_collection():
+    """Testa a coleção dividida em shards: migração, busca combinada e escritas por shard"""
+    try:
+        import os
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+        from langchain_core.documents import Document
+        from faiss_store import FaissCollection
+        from sharded_store import ShardedCollection
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [0.0] * 8
+            def embed_documents(self, texts):
+                return [[0.0] * 8 for text in texts]
+
+        rng = np.random.default_rng(3)
+        documents = [
+            Document(page_content=f"Contrato {i // 5}, cláusula {i % 5}, código X{i:03d}",
+                     metadata={"file_name": f"doc{i // 5}.pdf"})
+            for i in range(60)
+        ]
+        vectors = rng.random((60, 8)).astype(np.float32)
+        queries = rng.random((4, 8)).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as index_dir, ThreadPoolExecutor(3) as pool:
+            reference = FaissCollection.open("reference", MockEmbeddings(), directory=index_dir)
+            reference.add_embeddings(documents, vectors)
+            reference.commit()
+            legacy = FaissCollection.open("docs", MockEmbeddings(), directory=index_dir)
+            legacy.add_embeddings(documents, vectors)
+            legacy.commit()
+
+            def open_sharded(keyword_index=False):
+                return ShardedCollection.open("docs", MockEmbeddings(), shards=3, key="file_name",
+                                              directory=index_dir, indexed_fields=("file_name",),
+                                              keyword_index=keyword_index, pool=pool)
+
+            # A coleção não dividida é redistribuída e renomeada
+            sharded = open_sharded()
+            if sharded.ntotal != 60 or not os.path.isdir(os.path.join(index_dir, "docs.migrated")):
+                print(f"❌ Migração para shards incorreta: {sharded.ntotal} vetores")
+                return False
+            if sum(1 for shard in sharded.shards if shard.ids_where("file_name", "doc0.pdf")) != 1:
+                print("❌ Chunks de um arquivo espalhados entre shards")
+                return False
+
+            # Sem BM25 a fusão preserva a ordem vetorial: o resultado combinado é o da coleção única
+            hits = sharded.hybrid_search_batch(queries, [""] * 4, k=7)
+            expected = reference.hybrid_search_ids_batch(queries, [""] * 4, k=7)
+            for found, wanted in zip(hits, expected):
+                if [(doc.page_content, round(d, 4)) for _, doc, d in found] != \
+                        [(reference.docstore[i].page_content, round(d, 4)) for i, d in wanted]:
+                    print("❌ Top-k combinado dos shards difere da coleção única")
+                    return False
+
+            # Remoção pelo id global toca só o shard dono do arquivo
+            before = sharded.version
+            sharded.delete(sharded.ids_where("file_name", "doc3.pdf"))
+            sharded.commit()
+            changed = [old != new for old, new in zip(before, sharded.version)]
+            reopened = open_sharded(keyword_index=True)
+            if changed.count(True) != 1 or reopened.ntotal != 55 or "doc3.pdf" in reopened.values("file_name"):
+                print(f"❌ Remoção em shards incorreta: {changed}, {reopened.ntotal}")
+                return False
+            found = reopened.hybrid_search_batch(queries[:1], ["X037"], k=3)[0]
+            if not any(doc.page_content.endswith("X037") for _, doc, d in found):
+                print("❌ Busca híbrida em shards não encontrou o termo exato")
+                return False
+
+        print("✅ Coleção em shards funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na coleção em shards: {e}")
+        return False
+
+def test_build_index():
+    """Testa a reconstrução do índice: o BM25 é preservado e o lock do escritor é respeitado"""
+    try:
+        import os
+        import sys
+        import numpy as np
+        from unittest import mock
+        from langchain_core.documents import Document
+        import build_index
+        from config import FAISS_SHARDS, FAISS_COLLECTION_OPTIONS
+        from shared_index import WriterLock
+        from sharded_store import ShardedCollection
+
+        documents = [
+            Document(page_content=f"Contrato {i}, código Z{i:03d}", metadata={"file_name": f"doc{i}.pdf", "file_hash": str(i)})
+            for i in range(20)
+        ]
+        vectors = np.random.default_rng(5).random((20, 8)).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            sharded = ShardedCollection.open("my_docs", None, **FAISS_SHARDS["my_docs"], directory=index_dir,
+                                             **FAISS_COLLECTION_OPTIONS["my_docs"])
+            sharded.add_embeddings(documents, vectors)
+            sharded.commit()
+
+            for shard in build_index.open_shards("my_docs", index_dir):
+                if shard.ntotal:
+                    shard.rebuild({"type": "flat"})
+
+            reopened = build_index.open_shards("my_docs", index_dir)
+            for shard in reopened:
+                if shard.ntotal and "keywords" not in shard.checkpoint:
+                    print("❌ Reconstrução descartou o índice BM25 do checkpoint")
+                    return False
+            found = [hit for shard in reopened for hit in shard.keywords.search("z007", k=3)]
+            if len(found) != 1:
+                print(f"❌ BM25 incorreto após a reconstrução: {found}")
+                return False
+
+            lock_path = os.path.join(index_dir, "writer.lock")
+            holder = WriterLock(lock_path)
+            holder.try_acquire()
+            try:
+                with mock.patch.object(build_index, "WRITER_LOCK_PATH", lock_path), \
+                        mock.patch.object(sys, "argv", ["build_index.py", "my_docs"]), \
+                        mock.patch.object(build_index, "rebuild") as rebuild:
+                    if build_index.main() != 1 or rebuild.called:
+                        print("❌ Reconstrução executada com o lock do escritor em uso")
+                        return False
+            finally:
+                holder.release()
+
+        print("✅ Reconstrução do índice funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na reconstrução do índice: {e}")
+        return False
+
+
+def test_readiness_gate():
+    """Testa o /readyz e a recusa das rotas enquanto os índices carregam em segundo plano"""
+    cwd = os.getcwd()
+    try:
+        import threading
+        import time
+        from unittest import mock
+        from fastapi.testclient import TestClient
+
+        api = load_api()
+        release = threading.Event()
+        open_collections = api.open_collections
+
+        def slow_open_collections(read_only):
+            release.wait(10)
+            return open_collections(read_only)
+
+        payload = {"query": "prazo de vigência do contrato", "chat_id": "prontidao"}
+        with mock.patch.object(api, "open_collections", slow_open_collections), TestClient(api.app) as client:
+            loading = client.get("/readyz")
+            if loading.status_code != 503 or loading.json()["status"] != "loading":
+                print(f"❌ /readyz durante o carregamento: {loading.status_code} {loading.text}")
+                return False
+            rejected = client.post("/query", json=payload)
+            if rejected.status_code != 503 or "retry-after" not in rejected.headers:
+                print(f"❌ /query aceito antes do carregamento: {rejected.status_code}")
+                return False
+            if client.get("/healthz").status_code != 200:
+                print("❌ /healthz indisponível durante o carregamento")
+                return False
+
+            release.set()
+            deadline = time.monotonic() + 10
+            while client.get("/readyz").status_code != 200 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            ready = client.get("/readyz")
+            if ready.status_code != 200 or "indexes" not in ready.json()["startup_seconds"]:
+                print(f"❌ /readyz após o carregamento: {ready.status_code} {ready.text}")
+                return False
+            answered = client.post("/query", json=payload)
+            if answered.status_code != 200 or not answered.json().get("answer"):
+                print(f"❌ /query após o carregamento: {answered.status_code} {answered.text}")
+                return False
+
+        print("✅ Prontidão da API funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na prontidão da API: {e}")
+        return False
+    finally:
+        os.chdir(cwd)
+
+
+def test_query_stream():
+    """Testa a sequência de eventos de /query/stream e a gravação do turno só ao final"""
+    cwd = os.getcwd()
+    try:
+        import asyncio
+        import json
+        from langchain_core.documents import Document
+
+        api = load_api()
+        api.load_services()
+        texts = ["Cláusula 3.1: o prazo de vigência do contrato é de 24 meses.",
+                 "Cláusula 9.2: o foro eleito é o da comarca de Curitiba."]
+        api.db.add_embeddings(
+            [Document(page_content=text, metadata={"file_name": "stream.pdf", "file_hash": "stream",
+                                                   "page_number": page})
+             for page, text in enumerate(texts, start=1)],
+            api.embeddings.embed_documents(texts),
+        )
+        api.db.commit()
+        chat_id = "stream-chat"
+        query = "Qual o prazo de vigência do contrato?"
+
+        async def consume():
+            response = await api.query_document_stream(api.QueryRequest(query=query, chat_id=chat_id))
+            events, history_during_stream = [], None
+            async for message in response.body_iterator:
+                lines = dict(line.split(": ", 1) for line in message.strip().splitlines())
+                events.append((lines["event"], json.loads(lines["data"])))
+                if lines["event"] == "token" and history_during_stream is None:
+                    history_during_stream, _ = await api.run_blocking(api.chat_store.history, chat_id)
+            return events, history_during_stream
+
+        events, history_during_stream = asyncio.run(consume())
+        names = [name for name, data in events]
+        tokens = [data["text"] for name, data in events if name == "token"]
+        if names[0] != "sources" or names[-1] != "done" or set(names[1:-1]) != {"token"} or len(tokens) < 2:
+            print(f"❌ Sequência de eventos incorreta: {names}")
+            return False
+        if {source["file_name"] for source in events[0][1]} != {"stream.pdf"}:
+            print(f"❌ Evento sources incorreto: {events[0][1]}")
+            return False
+        answer = events[-1][1]["answer"]
+        if "".join(tokens) != answer or not answer:
+            print("❌ Tokens não compõem a resposta final")
+            return False
+        if history_during_stream != []:
+            print("❌ Turno gravado no histórico antes do fim do stream")
+            return False
+        history, _ = api.chat_store.history(chat_id)
+        if [(turn["user"], turn["ai"]) for turn in history] != [(query, answer)] or \
+                not api.chat_history_db.ids_where("chat_id", chat_id):
+            print(f"❌ Turno não gravado ao final do stream: {history}")
+            return False
+
+        print("✅ Streaming de /query funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro no streaming de /query: {e}")
+        return False
+    finally:
+        os.chdir(cwd)
+
+
+def test_query_batch():
+    """Testa /query/batch: um evento por item assim que fica pronto, erro isolado e limite do LLM"""
+    cwd = os.getcwd()
+    try:
+        import asyncio
+        import json
+        from unittest import mock
+        from config import BATCH_QUERY_LLM_CONCURRENCY
+
+        api = load_api()
+        api.load_services()
+        total = BATCH_QUERY_LLM_CONCURRENCY + 4
+        state = {"running": 0, "peak": 0}
+        finished = []
+
+        class StubChain:
+            # Itens do começo do lote demoram mais; a pergunta "falha" gera erro
+            async def ainvoke(self, inputs):
+                index = int(inputs["input"].split()[-1])
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+                try:
+                    await asyncio.sleep(0.02 * (total - index))
+                    if inputs["input"].startswith("falha"):
+                        raise RuntimeError("LLM indisponível")
+                    return f"resposta {index}"
+                finally:
+                    state["running"] -= 1
+                    finished.append(index)
+
+        items = [api.QueryRequest(query=f"{'falha' if index == 3 else 'prazo'} do lote {index}",
+                                  chat_id=f"lote-{index}") for index in range(total)]
+
+        async def consume():
+            response = await api.query_batch(api.BatchQueryRequest(items=items))
+            events = []
+            async for message in response.body_iterator:
+                lines = dict(line.split(": ", 1) for line in message.strip().splitlines())
+                events.append((lines["event"], json.loads(lines["data"]), len(finished)))
+            return events
+
+        with mock.patch.object(api, "answer_chain", StubChain()):
+            events = asyncio.run(consume())
+
+        results = [data for name, data, _ in events if name == "result"]
+        if [name for name, _, _ in events] != ["result"] * total + ["done"] or events[-1][1]["count"] != total:
+            print(f"❌ Sequência de eventos incorreta: {[name for name, _, _ in events]}")
+            return False
+        if sorted(result["index"] for result in results) != list(range(total)):
+            print("❌ Itens faltando ou repetidos no lote")
+            return False
+        if results[0]["index"] != finished[0] or events[0][2] == total:
+            print(f"❌ Resultados não saíram à medida que ficaram prontos: {[r['index'] for r in results]}")
+            return False
+        failed = [result for result in results if "error" in result]
+        answered = {result["index"]: result["answer"] for result in results if "answer" in result}
+        if [result["index"] for result in failed] != [3] or "answer" in failed[0] or \
+                answered != {index: f"resposta {index}" for index in range(total) if index != 3}:
+            print(f"❌ Falha de um item afetou os demais: {failed}")
+            return False
+        if state["peak"] != BATCH_QUERY_LLM_CONCURRENCY:
+            print(f"❌ Gerações simultâneas: {state['peak']} (limite {BATCH_QUERY_LLM_CONCURRENCY})")
+            return False
+
+        print("✅ Perguntas em lote funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro nas perguntas em lote: {e}")
+        return False
+    finally:
+        os.chdir(cwd)
+
+
+def test_replace_delete_race():
+    """Testa a remoção de um arquivo concorrente com a gravação da nova versão dele"""
+    cwd = os.getcwd()
+    try:
+        import threading
+        from langchain_core.documents import Document
+        from chunking import content_hash
+        from faiss_store import FaissCollection
+
+        api = load_api()
+
+        def chunk(text):
+            return Document(page_content=text, metadata={"file_name": "a.pdf", "content_hash": content_hash(text)})
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            collection = FaissCollection.open("docs", None, directory=index_dir, indexed_fields=("file_name",))
+            collection.add_embeddings([chunk("cláusula 1"), chunk("cláusula 2")], [[1.0, 0.0], [0.0, 1.0]])
+            collection.commit()
+
+            # A nova versão para no meio do commit; a remoção do arquivo chega nesse intervalo
+            paused, release = threading.Event(), threading.Event()
+            add_embeddings = collection.add_embeddings
+
+            def slow_add_embeddings(documents, vectors):
+                paused.set()
+                release.wait(10)
+                return add_embeddings(documents, vectors)
+
+            collection.add_embeddings = slow_add_embeddings
+            replace = threading.Thread(target=api.replace_file_documents,
+                                       args=(collection, "a.pdf", [chunk("cláusula 3")], [[1.0, 1.0]], [chunk("cláusula 1")]))
+            delete = threading.Thread(target=api.delete_file_documents, args=(collection, "a.pdf"))
+            replace.start()
+            paused.wait(10)
+            delete.start()
+            delete.join(0.3)
+            blocked = delete.is_alive()
+            release.set()
+            replace.join(10)
+            delete.join(10)
+
+            if not blocked:
+                print("❌ Remoção gravou no meio da substituição do mesmo arquivo")
+                return False
+            reopened = FaissCollection.open("docs", None, directory=index_dir, indexed_fields=("file_name",))
+            if collection.ids_where("file_name", "a.pdf") or reopened.ids_where("file_name", "a.pdf"):
+                print(f"❌ Chunks sobraram após a remoção: {reopened.ids_where('file_name', 'a.pdf')}")
+                return False
+
+        print("✅ Remoção e substituição do mesmo arquivo serializadas")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na remoção concorrente: {e}")
+        return False
+    finally:
+        os.chdir(cwd)
+
+def test_mmr_selection():
+    """Testa a seleção por maximal marginal relevance (vetorizada e sobre os shards)"""
+    try:
+        import numpy as np
+        from langchain_core.documents import Document
+        from faiss_store import mmr_select_batch
+        from sharded_store import ShardedCollection
+
+        class MockEmbeddings:
+            def embed_query(self, text):
+                return [0.0] * 8
+            def embed_documents(self, texts):
+                return [[0.0] * 8 for text in texts]
+
+        def reference_mmr(query, candidates, k, lambda_mult):
+            # Versão direta, par a par, para comparar com a vetorizada
+            unit = lambda v: v / np.linalg.norm(v)
+            chosen = []
+            while len(chosen) < min(k, len(candidates)):
+                best, best_score = None, -np.inf
+                for i, candidate in enumerate(candidates):
+                    if i in chosen:
+                        continue
+                    redundancy = max((float(unit(candidate) @ unit(candidates[j])) for j in chosen), default=0.0)
+                    score = lambda_mult * float(unit(candidate) @ unit(query)) - (1 - lambda_mult) * redundancy
+                    if score > best_score:
+                        best, best_score = i, score
+                chosen.append(best)
+            return chosen
+
+        rng = np.random.default_rng(5)
+        queries = rng.random((3, 8)).astype(np.float32)
+        candidates = rng.random((3, 10, 8)).astype(np.float32)
+        valid = np.ones((3, 10), dtype=bool)
+        valid[1, 6:] = False  # pergunta com menos candidatos
+        picks = mmr_select_batch(queries, candidates, valid, 4, 0.5)
+        expected = [reference_mmr(queries[row], candidates[row][valid[row]], 4, 0.5) for row in range(3)]
+        if picks != expected:
+            print(f"❌ MMR vetorizado difere da referência: {picks} != {expected}")
+            return False
+
+        # Quase duplicatas mais próximas da pergunta: só uma delas entra
+        query = np.array([1.0, 1.0, 0, 0, 0, 0, 0, 0], dtype=np.float32)
+        duplicate = np.array([1.0, 0.8, 0, 0, 0, 0, 0, 0], dtype=np.float32)
+        vectors = np.stack([duplicate, duplicate + 0.001, duplicate + 0.002,
+                            [0.2, 1.0, 0.4, 0, 0, 0, 0, 0], [0.3, 0.6, 0, 0.8, 0, 0, 0, 0]]).astype(np.float32)
+        documents = [Document(page_content=f"página {i}", metadata={"file_name": f"doc{i}.pdf"}) for i in range(5)]
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            sharded = ShardedCollection.open("docs", MockEmbeddings(), shards=2, key="file_name",
+                                             directory=index_dir, indexed_fields=("file_name",))
+            ids = sharded.add_embeddings(documents, vectors)
+            sharded.commit()
+            hits = sharded.hybrid_search_batch(query[None, :], [""], k=5)
+            chosen = sharded.mmr_batch(query[None, :], hits, k=3, lambda_mult=0.5)[0]
+            names = sorted(doc.page_content for _, doc, d in chosen)
+            if names[1:] != ["página 3", "página 4"] or names[0] not in ("página 0", "página 1", "página 2"):
+                print(f"❌ MMR não descartou as quase duplicatas: {names}")
+                return False
+
+            # Candidato removido depois da busca fica de fora
+            sharded.delete([ids[3]])
+            sharded.commit()
+            chosen = sharded.mmr_batch(query[None, :], hits, k=3, lambda_mult=0.5)[0]
+            if any(vector_id == ids[3] for vector_id, _, _ in chosen) or len(chosen) != 3:
+                print("❌ MMR usou um candidato removido")
+                return False
+
+        print("✅ Seleção por MMR funcionando")
+        return True
+    except Exception as e:
+        print(f"❌ Erro na seleção por MMR: {e}")
+        return False
+
 def main():
     """Função principal de teste"""
     print("🧪 Iniciando testes da implementação FAISS")
@@ -106,6 +1553,31 @@ def main():
         ("Configuração", test_config),
         ("Funções Utilitárias", test_utils),
         ("FAISS Básico", test_faiss_basic),
+        ("Cache de Embeddings", test_embedding_cache),
+        ("Coleção FAISS Incremental", test_faiss_collection),
+        ("Compactação FAISS", test_faiss_compaction),
+        ("Tipos de Índice FAISS", test_faiss_index_types),
+        ("Chunking", test_chunking),
+        ("Cache de Respostas", test_answer_cache),
+        ("Busca Híbrida", test_hybrid_search),
+        ("Índices entre Processos", test_shared_index),
+        ("Acesso Concorrente", test_concurrent_access),
+        ("Histórico de Chat", test_chat_store),
+        ("Extração de PDF em Fluxo", test_pdf_streaming),
+        ("Deduplicação", test_deduplication),
+        ("Benchmark", test_benchmark_fakes),
+        ("Métricas", test_metrics),
+        ("Agrupamento de Perguntas", test_query_batching),
+        ("Busca em Lote", test_batch_search),
+        ("Coleção em Shards", test_sharded_collection),
+        ("Reconstrução do Índice", test_build_index),
+        ("Seleção por MMR", test_mmr_selection),
+        ("Prontidão da API", test_readiness_gate),
+        ("Streaming de /query", test_query_stream),
+        ("Perguntas em Lote", test_query_batch),
+        ("Remoção Concorrente", test_replace_delete_race),
+        ("Atualização Incremental dos Leitores", test_incremental_reopen),
+        ("Memória do Leitor", test_reader_memory),
     ]
     
     passed = 0